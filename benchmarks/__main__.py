@@ -0,0 +1,45 @@
+"""
+Runs the pipeline benchmarks, see the README.
+"""
+
+import argparse
+import sys
+
+from . import bench_pipeline
+from .harness import SAMPLES, compare, measure, write_results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a results file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fraction a case may slow down by before it regresses")
+    parser.add_argument("--samples", type=int, default=SAMPLES)
+    parser.add_argument("--filter", default="", help="only run cases containing this")
+    args = parser.parse_args()
+
+    results = {}
+    for (name, fn) in bench_pipeline.cases():
+        if args.filter not in name:
+            continue
+
+        results[name] = result = measure(fn, args.samples)
+        print(f"{name:<40} {result['rps']:>12.1f} rps "
+              f"p50 {result['p50_us']:>9.3f}us p99 {result['p99_us']:>9.3f}us",
+              file=sys.stderr)
+
+    if args.out:
+        write_results(args.out, results)
+
+    if args.compare:
+        regressed = compare(args.compare, results, args.threshold)
+        if regressed:
+            print(f"{len(regressed)} case(s) regressed", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+bench_caller measures calls made through the caller against
+the loopback upstream - throughput, fan-out latency and memory.
+"""
+
+import argparse
+import os
+import sys
+from time import perf_counter
+
+from wsgidragon import base, caller
+
+from .harness import compare, percentile, write_results
+from .bench_pipeline import NullWriter
+from .upstream import Upstream
+
+
+FAN_OUTS = (1, 10, 100)
+IN_FLIGHT = 1000
+
+# Every call of a bench is in flight at once, rather than
+# queued behind the default cap of connections per host.
+MAX_PER_HOST = max(IN_FLIGHT, *FAN_OUTS)
+MAX_IDLE_PER_HOST = max(FAN_OUTS)
+
+
+def setup():
+    base.init_application("benchmark")
+    base.INNER_LOGGER.writer = NullWriter()
+    base.INNER_CALLER = base.InnerCaller(
+        "benchmark",
+        MAX_IDLE_PER_HOST,
+        4000,
+        MAX_PER_HOST,
+        30000,
+    )
+
+
+def in_request(fn):
+    """
+    in_request runs fn in a fresh RequestState,
+    so its call ids are released afterwards.
+    """
+    state = base.RequestState()
+    token = base.REQUEST_STATE.set(state)
+    try:
+        return fn()
+    finally:
+        base.release_calls(state)
+        base.REQUEST_STATE.reset(token)
+
+
+def call(upstream, **params):
+    return caller.call(
+        "GET",
+        upstream.host,
+        port=upstream.port,
+        params=[(k, str(v)) for (k, v) in params.items()],
+    )
+
+
+def bench_sequential(upstream, calls, **params):
+    def run():
+        latencies = []
+        for _ in range(calls):
+            start = perf_counter()
+            call(upstream, **params).wait()
+            latencies.append(perf_counter() - start)
+
+        return latencies
+
+    latencies = in_request(run)
+    return summarise(latencies)
+
+
+def bench_fan_out(upstream, fan_out, rounds, **params):
+    def run():
+        futures = [call(upstream, **params) for _ in range(fan_out)]
+        for fut in futures:
+            fut.wait()
+
+    latencies = []
+    for _ in range(rounds):
+        start = perf_counter()
+        in_request(run)
+        latencies.append(perf_counter() - start)
+
+    result = summarise(latencies)
+    result["calls_per_sec"] = round(fan_out * rounds / sum(latencies), 1)
+    return result
+
+
+def bench_in_flight_memory(upstream, n):
+    """
+    bench_in_flight_memory returns the resident memory
+    per call while n calls wait on a slow upstream.
+    """
+    def run():
+        before = resident_bytes()
+        futures = [call(upstream, latency_ms=500) for _ in range(n)]
+        during = resident_bytes()
+        for fut in futures:
+            fut.wait()
+
+        return during - before
+
+    return {"bytes_per_call": round(in_request(run) / n, 1), "calls": n}
+
+
+def summarise(latencies):
+    latencies = sorted(latencies)
+    return {
+        "rps": round(len(latencies) / sum(latencies), 1),
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 3),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 3),
+        "samples": len(latencies),
+    }
+
+
+def resident_bytes():
+    # Includes the extension's (Rust) allocations,
+    # which tracemalloc can't see.
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_caller")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a results file")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    setup()
+
+    results = {}
+    with Upstream() as upstream:
+        results["sequential/size=0"] = bench_sequential(upstream, args.calls)
+        results["sequential/size=65536"] = bench_sequential(upstream, args.calls, size=65536)
+        results["sequential/fail=0.1"] = bench_sequential(upstream, args.calls, fail=0.1)
+
+        for n in FAN_OUTS:
+            results[f"fan_out/calls={n}"] = bench_fan_out(upstream, n, args.rounds)
+            results[f"fan_out/calls={n}/latency_ms=5"] = bench_fan_out(
+                upstream, n, args.rounds // 10 or 1, latency_ms=5,
+            )
+
+        if os.path.exists("/proc/self/statm"):
+            results["in_flight_memory"] = bench_in_flight_memory(upstream, IN_FLIGHT)
+
+    for (name, result) in results.items():
+        print(f"{name:<40} {result}", file=sys.stderr)
+
+    if args.out:
+        write_results(args.out, results)
+
+    if args.compare:
+        latency_results = {k: v for (k, v) in results.items() if "p50_us" in v}
+        if compare(args.compare, latency_results, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
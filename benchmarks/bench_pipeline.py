@@ -0,0 +1,133 @@
+"""
+bench_pipeline times each stage of the request pipeline,
+and the whole pipeline through DragonApp.__call__.
+"""
+
+import json as js
+from io import BytesIO
+
+from wsgidragon import DragonApp, JsonSchema, StatusCode, jsonschema
+from wsgidragon import base, routes
+from wsgidragon.api import JsonApi
+
+from .harness import build_environ, reset_environ, start_response
+
+
+ROUTE_COUNTS = (10, 1000)
+PAYLOAD_SIZES = (10, 1000)
+
+
+class Payload(JsonSchema):
+    name = jsonschema.String(required=True)
+    values = jsonschema.StaticTypeArray(element_field=jsonschema.Number())
+
+
+class NullWriter:
+    def write(self, line):
+        pass
+
+
+def payload(size):
+    return {"name": "benchmark", "values": [i * 0.5 for i in range(size)]}
+
+
+def echo(request, resp_head):
+    return request.body
+
+
+def setup_app(route_count):
+    """
+    setup_app registers route_count routes, the last
+    of which is the one the benchmarks request.
+    """
+    routes.ROUTES.clear()
+    routes.ROUTE_INDEX.clear()
+
+    app = DragonApp("benchmark")
+    for i in range(route_count):
+        app.add_json(
+            echo,
+            methods=["POST"],
+            path=("api", f"resource{i}", "items"),
+            request_schema=Payload,
+            response_schema=Payload,
+            status_codes=[StatusCode.OK],
+        )
+
+    # Benchmarks measure the cost of logging,
+    # not of writing to stdout.
+    base.INNER_LOGGER.writer = NullWriter()
+
+    return (app, f"/api/resource{route_count - 1}/items")
+
+
+def build_api():
+    return JsonApi(
+        "benchmark",
+        ["POST"],
+        ("items",),
+        None,
+        Payload,
+        Payload,
+        [StatusCode.OK],
+    )
+
+
+def cases():
+    """
+    cases yields (name, fn) for every benchmark.
+    """
+    for n in ROUTE_COUNTS:
+        (_, path) = setup_app(n)
+        path_parts = path.split("/")[1:]
+        yield (f"routing/routes={n}", lambda: routes.ROUTE_INDEX.lookup(path_parts))
+
+    api = build_api()
+    yield ("params", lambda: api.build_params("limit=10&offset=20&tag=a&tag=b"))
+
+    for size in PAYLOAD_SIZES:
+        body = js.dumps(payload(size)).encode()
+        yield (
+            f"request_body/values={size}",
+            lambda: api.build_req_body("application/json", BytesIO(body), len(body)),
+        )
+
+        resp_body = payload(size)
+        yield (f"response_body/values={size}", lambda: api.build_response(resp_body))
+
+    yield ("logging", bench_logging())
+
+    for n in ROUTE_COUNTS:
+        for size in PAYLOAD_SIZES:
+            yield (f"full/routes={n}/values={size}", bench_full(n, size))
+
+
+def bench_logging():
+    setup_app(1)
+
+    state = base.RequestState()
+    state.ctx = base.Context("0" * 32, None, "0" * 16, None)
+    base.REQUEST_STATE.set(state)
+
+    req_info = {
+        "http.method": "POST",
+        "url.path": "/api/resource0/items",
+        "url.port": 8000,
+        "url.host": "localhost",
+    }
+    resp_info = {"url.path.0": "api", "http.status": 200}
+
+    return lambda: base.logger.info_tags("request complete", req_info, resp_info)
+
+
+def bench_full(route_count, size):
+    (app, path) = setup_app(route_count)
+    body = js.dumps(payload(size)).encode()
+    environ = build_environ("POST", path, body=body, content_type="application/json")
+
+    def run():
+        reset_environ(environ)
+        for _ in app(environ, start_response):
+            pass
+
+    return run
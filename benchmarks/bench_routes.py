@@ -0,0 +1,45 @@
+"""
+bench_routes measures dispatch as the route count grows.
+"""
+
+from time import perf_counter
+
+from wsgidragon import routes
+
+
+ROUTE_COUNTS = (10, 100, 1000, 5000)
+ITERATIONS = 100000
+
+
+def register(n):
+    routes.ROUTES.clear()
+    routes.ROUTE_INDEX.clear()
+
+    for i in range(n):
+        routes.add_route(["GET"], ("api", f"resource{i}", "items"), None, None)
+
+
+def bench_lookup(n):
+    register(n)
+
+    # Look up the last registered route - the worst
+    # case for an in-order scan of the routes.
+    path_parts = "/api/resource{}/items".format(n - 1).split('/')[1:]
+    lookup = routes.ROUTE_INDEX.lookup
+
+    start = perf_counter()
+    for _ in range(ITERATIONS):
+        lookup(path_parts)
+    elapsed = perf_counter() - start
+
+    return elapsed / ITERATIONS * 1e9
+
+
+def main():
+    print(f"{'routes':>8} {'ns/dispatch':>12}")
+    for n in ROUTE_COUNTS:
+        print(f"{n:>8} {bench_lookup(n):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+harness times benchmark cases and compares results
+against a stored baseline.
+"""
+
+import json as js
+import platform
+from io import BytesIO
+from time import perf_counter
+
+
+# Each sample times a batch of calls taking at least
+# this long, so timer overhead doesn't swamp fast cases.
+MIN_BATCH_SECS = 20e-6
+
+SAMPLES = 2000
+
+
+def measure(fn, samples=SAMPLES):
+    """
+    measure returns the requests per second and the
+    p50/p99 latency (microseconds) of calling fn.
+    """
+    batch = calibrate(fn)
+
+    latencies = []
+    for _ in range(samples):
+        start = perf_counter()
+        for _ in range(batch):
+            fn()
+        latencies.append((perf_counter() - start) / batch)
+
+    latencies.sort()
+    total = sum(latencies)
+
+    return {
+        "rps": round(samples / total, 1),
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 3),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 3),
+        "batch": batch,
+        "samples": samples,
+    }
+
+
+def calibrate(fn):
+    # Warm up and estimate the cost of a call
+    n = 0
+    start = perf_counter()
+    while perf_counter() - start < 0.01:
+        fn()
+        n += 1
+
+    per_call = (perf_counter() - start) / n
+    return max(1, int(MIN_BATCH_SECS / per_call))
+
+
+def percentile(ordered, q):
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def build_environ(method, path, query="", body=b"", content_type=None, headers=None):
+    """
+    build_environ returns a WSGI environ, the body stream is
+    rewound by reset_environ before the environ is reused.
+    """
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8000",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.input": BytesIO(body),
+    }
+
+    if content_type:
+        environ["CONTENT_TYPE"] = content_type
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+    for (key, value) in (headers or {}).items():
+        environ["HTTP_" + key.upper().replace("-", "_")] = value
+
+    return environ
+
+
+def reset_environ(environ):
+    environ["wsgi.input"].seek(0)
+
+
+def start_response(status, headers):
+    pass
+
+
+def write_results(path, results):
+    with open(path, "w") as f:
+        js.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+
+
+def compare(baseline_path, results, threshold):
+    """
+    compare prints each case against the baseline and
+    returns the names of cases which regressed by more
+    than threshold (a fraction) in rps or p50 latency.
+    """
+    with open(baseline_path) as f:
+        baseline = js.load(f)["results"]
+
+    regressed = []
+    print(f"{'case':<40} {'base p50':>10} {'p50':>10} {'change':>8}")
+    for (name, result) in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<40} {'-':>10} {result['p50_us']:>10.3f} {'new':>8}")
+            continue
+
+        change = result["p50_us"] / base["p50_us"] - 1
+        flag = ""
+        if change > threshold or result["rps"] < base["rps"] * (1 - threshold):
+            regressed.append(name)
+            flag = " REGRESSED"
+
+        print(f"{name:<40} {base['p50_us']:>10.3f} {result['p50_us']:>10.3f} {change:>+8.1%}{flag}")
+
+    return regressed
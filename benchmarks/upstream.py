@@ -0,0 +1,122 @@
+"""
+upstream is a loopback HTTP upstream for the caller benchmarks.
+Query params pick how it responds: latency_ms, size, status,
+fail (a fraction) and failure (reset, hang or 500).
+
+    python -m benchmarks.upstream --port 8001
+"""
+
+import argparse
+import socket
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import random
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.respond()
+
+    def respond(self):
+        params = {
+            k: v[-1] for (k, v) in parse_qs(urlsplit(self.path).query).items()
+        }
+
+        latency = float(params.get("latency_ms", 0)) / 1000
+        size = int(params.get("size", 0))
+        status = int(params.get("status", 200))
+
+        if random() < float(params.get("fail", 0)):
+            failure = params.get("failure", "reset")
+            if failure == "reset":
+                self.reset()
+                return
+            elif failure == "hang":
+                # Longer than any sane call timeout
+                latency = 3600
+            else:
+                status = 500
+
+        if latency:
+            sleep(latency)
+
+        body = b"x" * size
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reset(self):
+        # Close with RST rather than FIN
+        self.connection.setsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_LINGER,
+            struct.pack("ii", 1, 0),
+        )
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Fan-out benchmarks open many connections at once
+    request_queue_size = 1024
+
+
+class Upstream:
+    """
+    Upstream serves Handler from a background thread.
+    Port 0 picks a free port.
+    """
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = Server((host, port), Handler)
+        (self.host, self.port) = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            name="benchmark_upstream",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    upstream = Upstream(args.host, args.port)
+    print(f"listening on {upstream.host}:{upstream.port}")
+    upstream._server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+use std::collections::{HashMap, HashSet};
+use std::os::unix::io::RawFd;
+use std::sync::mpsc::{Receiver, RecvTimeoutError};
+use std::sync::{Arc, Condvar, Mutex, MutexGuard, TryLockError};
+use std::time::Instant;
+
+use crate::{CallRecv, Notify};
+
+// Ids are unique across all requests in the process,
+// each request tracks the ids it owns and forgets
+// them once it completes.
+struct Calls {
+    pending_reqs: HashSet<i32>,
+    completed_reqs: HashMap<i32, Arc<CallRecv>>,
+    id: i32,
+}
+
+// Shared is used without the GIL held. At most one thread
+// receives on outq at a time, any other waiting threads
+// sleep on ready until a response has been added.
+//
+// The outq guard is only ever released while holding the
+// calls lock and followed by notify_all, so a waiter which
+// saw outq busy can't miss its chance to take it over.
+//
+// notify is given the ids of added responses, an event loop
+// which polled while outq was busy then takes them.
+pub struct Shared {
+    calls: Mutex<Calls>,
+    ready: Condvar,
+    outq: Mutex<Receiver<CallRecv>>,
+    notify: Arc<Notify>,
+}
+
+impl Shared {
+    pub fn new(outq: Receiver<CallRecv>, notify: Arc<Notify>) -> Self {
+        Self {
+            calls: Mutex::new(Calls {
+                pending_reqs: HashSet::new(),
+                completed_reqs: HashMap::new(),
+                id: 0,
+            }),
+            ready: Condvar::new(),
+            outq: Mutex::new(outq),
+            notify,
+        }
+    }
+
+    fn lock_calls(&self) -> Result<MutexGuard<'_, Calls>, String> {
+        self.calls
+            .lock()
+            .map_err(|_| "calls lock poisoned".to_string())
+    }
+
+    // next_id returns the id of a new pending call
+    pub fn next_id(&self) -> Result<i32, String> {
+        let mut calls = self.lock_calls()?;
+        let id = calls.id.wrapping_add(1).max(1);
+        calls.id = id;
+        calls.pending_reqs.insert(id);
+        Ok(id)
+    }
+
+    pub fn is_pending(&self, id: i32) -> Result<bool, String> {
+        Ok(self.lock_calls()?.pending_reqs.contains(&id))
+    }
+
+    // forget drops the given ids, any response
+    // which arrives for them later is discarded.
+    pub fn forget(&self, ids: &[i32]) -> Result<(), String> {
+        let mut calls = self.lock_calls()?;
+        for id in ids.iter() {
+            calls.pending_reqs.remove(id);
+            calls.completed_reqs.remove(id);
+        }
+
+        Ok(())
+    }
+
+    // poll_ready returns the response of id,
+    // if it has arrived, without waiting.
+    pub fn poll_ready(&self, id: i32) -> Result<Option<Arc<CallRecv>>, String> {
+        self.tick()?;
+        Ok(self.lock_calls()?.completed_reqs.get(&id).cloned())
+    }
+
+    // take_ready returns the ids completed since the
+    // notify reader fd last took them, see Notify.
+    pub fn take_ready(&self, fd: RawFd) -> Result<Option<Vec<i32>>, String> {
+        self.tick()?;
+        Ok(self.notify.take_ready(fd))
+    }
+
+    // tick moves anything on the outq into completed_reqs,
+    // unless another thread is already receiving.
+    fn tick(&self) -> Result<(), String> {
+        let outq = match self.outq.try_lock() {
+            Ok(outq) => outq,
+            Err(TryLockError::WouldBlock) => return Ok(()),
+            Err(TryLockError::Poisoned(_)) => return Err("outq lock poisoned".to_string()),
+        };
+
+        let mut calls = self.lock_calls()?;
+        let mut added = Vec::new();
+        while let Ok(r) = outq.try_recv() {
+            let id = r.id;
+            if add_call_recv(&mut calls, r) {
+                added.push(id);
+            }
+        }
+
+        drop(outq);
+        self.ready.notify_all();
+        drop(calls);
+
+        if !added.is_empty() {
+            self.notify.completed(&added);
+        }
+        Ok(())
+    }
+
+    // wait_any blocks until any of ids completes and returns
+    // it, or None once deadline passes. It returns None
+    // straight away if there are no ids to wait on.
+    pub fn wait_any(&self, ids: &[i32], deadline: Option<Instant>) -> Result<Option<i32>, String> {
+        fn poisoned<T>(_: T) -> String {
+            "calls lock poisoned".to_string()
+        }
+
+        if ids.is_empty() {
+            return Ok(None);
+        }
+
+        let mut calls = self.calls.lock().map_err(poisoned)?;
+
+        loop {
+            if let Some(&id) = ids
+                .iter()
+                .find(|&&id| calls.completed_reqs.contains_key(&id))
+            {
+                return Ok(Some(id));
+            }
+
+            let remaining = match deadline {
+                None => None,
+                Some(d) => match d.checked_duration_since(Instant::now()) {
+                    Some(r) if !r.is_zero() => Some(r),
+                    _ => return Ok(None),
+                },
+            };
+
+            match self.outq.try_lock() {
+                Ok(outq) => {
+                    // We're the receiver - block without the calls lock
+                    drop(calls);
+                    let r = match remaining {
+                        None => outq.recv().map_err(|_| RecvTimeoutError::Disconnected),
+                        Some(t) => outq.recv_timeout(t),
+                    };
+
+                    calls = self.calls.lock().map_err(poisoned)?;
+                    let added = match r {
+                        Ok(r) => {
+                            let id = r.id;
+                            add_call_recv(&mut calls, r).then_some(id)
+                        }
+                        Err(RecvTimeoutError::Timeout) => None,
+                        Err(RecvTimeoutError::Disconnected) => {
+                            return Err("recv q crashed".to_string())
+                        }
+                    };
+
+                    drop(outq);
+                    self.ready.notify_all();
+                    if let Some(id) = added {
+                        self.notify.completed(&[id]);
+                    }
+                }
+                Err(TryLockError::WouldBlock) => {
+                    // Someone else is receiving, wait for them
+                    calls = match remaining {
+                        None => self.ready.wait(calls).map_err(poisoned)?,
+                        Some(t) => self.ready.wait_timeout(calls, t).map_err(poisoned)?.0,
+                    };
+                }
+                Err(TryLockError::Poisoned(_)) => return Err("outq lock poisoned".to_string()),
+            }
+        }
+    }
+}
+
+// add_call_recv keeps r if its call is pending
+fn add_call_recv(calls: &mut Calls, r: CallRecv) -> bool {
+    if !calls.pending_reqs.contains(&r.id) {
+        return false;
+    }
+
+    calls.completed_reqs.insert(r.id, Arc::new(r));
+    true
+}
+
+#[cfg(test)]
+mod tests {
+    use std::sync::mpsc::{channel, Sender};
+    use std::thread;
+    use std::time::Duration;
+
+    use super::*;
+    use crate::CallResponse;
+
+    fn complete(outq: &Sender<CallRecv>, id: i32) {
+        outq.send(CallRecv {
+            id,
+            call_result: Ok(CallResponse {
+                code: 200,
+                headers: vec![],
+                body: id.to_string().into_bytes(),
+                json: None,
+                stream: None,
+            }),
+            reused: false,
+            completed: Instant::now(),
+            pool_hits: 0,
+            pool_misses: 0,
+        })
+        .unwrap();
+    }
+
+    fn after(ms: u64) -> Option<Instant> {
+        Some(Instant::now() + Duration::from_millis(ms))
+    }
+
+    #[test]
+    fn wait_on_nothing_returns() {
+        let (_outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, Arc::default());
+        assert_eq!(shared.wait_any(&[], None), Ok(None));
+    }
+
+    #[test]
+    fn wait_returns_completed() {
+        let (outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, Arc::default());
+        let a = shared.next_id().unwrap();
+        let b = shared.next_id().unwrap();
+        assert_ne!(a, b);
+
+        complete(&outq_s, b);
+        assert_eq!(shared.wait_any(&[a, b], None), Ok(Some(b)));
+
+        // Completed calls stay until they're forgotten
+        assert_eq!(shared.wait_any(&[a, b], None), Ok(Some(b)));
+        assert_eq!(shared.wait_any(&[a], after(10)), Ok(None));
+
+        shared.forget(&[b]).unwrap();
+        assert!(!shared.is_pending(b).unwrap());
+        assert!(shared.poll_ready(b).unwrap().is_none());
+    }
+
+    #[test]
+    fn poll_ready_takes_outq() {
+        let (outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, Arc::default());
+        let id = shared.next_id().unwrap();
+
+        assert!(shared.poll_ready(id).unwrap().is_none());
+        complete(&outq_s, id);
+
+        let call_recv = shared.poll_ready(id).unwrap().unwrap();
+        assert_eq!(call_recv.call_result.as_ref().unwrap().body, b"1");
+    }
+
+    #[test]
+    fn forgotten_responses_dropped() {
+        let (outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, Arc::default());
+        let a = shared.next_id().unwrap();
+        let b = shared.next_id().unwrap();
+
+        shared.forget(&[a]).unwrap();
+        complete(&outq_s, a);
+        complete(&outq_s, b);
+
+        assert_eq!(shared.wait_any(&[a, b], None), Ok(Some(b)));
+        assert!(shared.poll_ready(a).unwrap().is_none());
+    }
+
+    #[test]
+    fn wait_times_out() {
+        let (_outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, Arc::default());
+        let id = shared.next_id().unwrap();
+
+        let start = Instant::now();
+        assert_eq!(shared.wait_any(&[id], after(50)), Ok(None));
+        assert!(start.elapsed() >= Duration::from_millis(50));
+    }
+
+    #[test]
+    fn wait_fails_once_loop_gone() {
+        let (outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, Arc::default());
+        let id = shared.next_id().unwrap();
+
+        drop(outq_s);
+        assert!(shared.wait_any(&[id], None).is_err());
+    }
+
+    #[test]
+    fn added_responses_notify() {
+        use std::io::Read;
+        use std::os::unix::io::{AsRawFd, FromRawFd};
+        use std::os::unix::net::UnixStream;
+
+        let notify = Arc::new(Notify::default());
+        let mut reader = unsafe { UnixStream::from_raw_fd(notify.reader().unwrap()) };
+        let fd = reader.as_raw_fd();
+
+        let (outq_s, outq_r) = channel();
+        let shared = Shared::new(outq_r, notify);
+        let a = shared.next_id().unwrap();
+        let b = shared.next_id().unwrap();
+
+        // Nothing to read until a pending call's response is added
+        let mut buf = [0u8; 16];
+        shared.forget(&[a]).unwrap();
+        complete(&outq_s, a);
+        assert!(shared.poll_ready(a).unwrap().is_none());
+        assert_eq!(
+            reader.read(&mut buf).unwrap_err().kind(),
+            std::io::ErrorKind::WouldBlock
+        );
+
+        complete(&outq_s, b);
+        assert_eq!(shared.take_ready(fd).unwrap(), Some(vec![b]));
+        assert_eq!(reader.read(&mut buf).unwrap(), 1);
+        assert!(shared.poll_ready(b).unwrap().is_some());
+        assert_eq!(shared.take_ready(fd).unwrap(), Some(vec![]));
+
+        // A closed reader is dropped, not an error
+        drop(reader);
+        complete(&outq_s, b);
+        assert!(shared.poll_ready(b).unwrap().is_some());
+    }
+
+    #[test]
+    fn concurrent_waiters() {
+        let (outq_s, outq_r) = channel();
+        let shared = Arc::new(Shared::new(outq_r, Arc::default()));
+        let ids: Vec<i32> = (0..8).map(|_| shared.next_id().unwrap()).collect();
+
+        // Each thread waits on its own id, only one of
+        // them receives on outq at a time.
+        let waiters: Vec<_> = ids
+            .iter()
+            .map(|&id| {
+                let shared = shared.clone();
+                thread::spawn(move || shared.wait_any(&[id], after(5000)))
+            })
+            .collect();
+
+        thread::sleep(Duration::from_millis(20));
+        for &id in ids.iter().rev() {
+            complete(&outq_s, id);
+        }
+
+        for (waiter, &id) in waiters.into_iter().zip(ids.iter()) {
+            assert_eq!(waiter.join().unwrap(), Ok(Some(id)));
+        }
+    }
+}
@@ -0,0 +1,99 @@
+// Host names are resolved on their own threads, getaddrinfo
+// would otherwise block every call on the loop.
+
+use std::collections::{HashMap, HashSet};
+use std::io::{self, ErrorKind};
+use std::net::{IpAddr, SocketAddr, ToSocketAddrs};
+use std::sync::{Arc, Mutex, PoisonError};
+use std::thread::Builder as ThreadBuilder;
+use std::time::{Duration, Instant};
+
+use crate::stream::LoopWaker;
+
+const DNS_TTL: Duration = Duration::from_secs(60);
+
+pub type Name = (String, u16);
+
+type Lookups = Arc<Mutex<Vec<(Name, io::Result<SocketAddr>)>>>;
+
+pub struct Resolver {
+    cache: HashMap<Name, (SocketAddr, Instant)>,
+    resolving: HashSet<Name>,
+    done: Lookups,
+    waker: Arc<LoopWaker>,
+}
+
+impl Resolver {
+    pub fn new(waker: Arc<LoopWaker>) -> Self {
+        Self {
+            cache: HashMap::new(),
+            resolving: HashSet::new(),
+            done: Arc::new(Mutex::new(vec![])),
+            waker,
+        }
+    }
+
+    // lookup returns the address of name if it's known,
+    // otherwise None and the loop is woken once it is.
+    pub fn lookup(&mut self, name: &Name) -> Option<io::Result<SocketAddr>> {
+        if let Ok(ip) = name.0.parse::<IpAddr>() {
+            return Some(Ok(SocketAddr::new(ip, name.1)));
+        }
+
+        if let Some((addr, at)) = self.cache.get(name) {
+            if at.elapsed() < DNS_TTL {
+                return Some(Ok(*addr));
+            }
+        }
+
+        if self.resolving.contains(name) {
+            return None;
+        }
+
+        let done = self.done.clone();
+        let waker = self.waker.clone();
+        let lookup = name.clone();
+        let spawned = ThreadBuilder::new()
+            .name("call_loop_dns".to_string())
+            .spawn(move || {
+                let addr = resolve(&lookup);
+                done.lock()
+                    .unwrap_or_else(PoisonError::into_inner)
+                    .push((lookup, addr));
+                waker.wake();
+            });
+
+        match spawned {
+            Ok(_) => {
+                self.resolving.insert(name.clone());
+                None
+            }
+            Err(e) => Some(Err(e)),
+        }
+    }
+
+    // resolved takes the lookups which have completed
+    pub fn resolved(&mut self) -> Vec<(Name, io::Result<SocketAddr>)> {
+        let done = std::mem::take(&mut *self.done.lock().unwrap_or_else(PoisonError::into_inner));
+
+        let now = Instant::now();
+        self.cache
+            .retain(|_, (_, at)| now.duration_since(*at) < DNS_TTL);
+
+        for (name, addr) in done.iter() {
+            self.resolving.remove(name);
+            if let Ok(addr) = addr {
+                self.cache.insert(name.clone(), (*addr, now));
+            }
+        }
+
+        done
+    }
+}
+
+fn resolve(name: &Name) -> io::Result<SocketAddr> {
+    (name.0.as_str(), name.1)
+        .to_socket_addrs()?
+        .next()
+        .ok_or_else(|| io::Error::new(ErrorKind::NotFound, "host not found"))
+}
@@ -0,0 +1,393 @@
+// HTTP/1.1 framing, requests are written and responses
+// parsed incrementally as the connection is read.
+
+use std::io::{self, ErrorKind};
+
+use crate::CallSend;
+
+pub const MAX_HEAD_SIZE: usize = 64 * 1024;
+const MAX_HEADERS: usize = 128;
+
+pub struct Head {
+    pub len: usize,
+    pub code: u16,
+    pub headers: Vec<(String, String)>,
+    pub framing: Framing,
+    pub keep_alive: bool,
+}
+
+pub enum Framing {
+    Length(usize),
+    Chunked(ChunkState),
+    Close,
+}
+
+#[derive(Copy, Clone)]
+pub enum ChunkState {
+    Size,
+    Data(usize),
+    DataEnd,
+    Trailers,
+    Done,
+}
+
+// build_request returns the request
+pub fn build_request(call_send: &CallSend) -> Vec<u8> {
+    let mut target = String::new();
+    for segm in call_send.path_segms.iter() {
+        target.push('/');
+        target.push_str(&percent_encode(segm));
+    }
+
+    if target.is_empty() {
+        target.push('/');
+    }
+
+    for (n, (key, value)) in call_send.params.iter().enumerate() {
+        target.push(if n == 0 { '?' } else { '&' });
+        target.push_str(&percent_encode(key));
+        target.push('=');
+        target.push_str(&percent_encode(value));
+    }
+
+    let mut head = format!("{} {} HTTP/1.1\r\n", call_send.method, target);
+    let default_port = if call_send.use_ssl { 443 } else { 80 };
+    if call_send.port == default_port {
+        head.push_str(&format!("Host: {}\r\n", call_send.host));
+    } else {
+        head.push_str(&format!("Host: {}:{}\r\n", call_send.host, call_send.port));
+    }
+
+    for (key, value) in call_send.headers.iter() {
+        if key.eq_ignore_ascii_case("content-length")
+            || key.eq_ignore_ascii_case("connection")
+            || key.eq_ignore_ascii_case("host")
+        {
+            continue;
+        }
+
+        head.push_str(&format!("{}: {}\r\n", key, value));
+    }
+
+    // Tell the server we don't have a cache
+    head.push_str("Cache-Control: no-cache\r\n");
+    head.push_str(&format!("Content-Length: {}\r\n\r\n", call_send.body.len()));
+
+    let mut request = head.into_bytes();
+    request.extend_from_slice(&call_send.body);
+    request
+}
+
+// parse_head returns the response head at the start of buf,
+// or None until it has all arrived.
+pub fn parse_head(buf: &[u8], head_only: bool) -> io::Result<Option<Head>> {
+    let mut headers = [httparse::EMPTY_HEADER; MAX_HEADERS];
+    let mut resp = httparse::Response::new(&mut headers);
+
+    let len = match resp.parse(buf) {
+        Ok(httparse::Status::Complete(len)) => len,
+        Ok(httparse::Status::Partial) if buf.len() > MAX_HEAD_SIZE => {
+            return Err(invalid("response head too large"))
+        }
+        Ok(httparse::Status::Partial) => return Ok(None),
+        Err(e) => {
+            return Err(io::Error::new(
+                ErrorKind::InvalidData,
+                format!("invalid response head - {}", e),
+            ))
+        }
+    };
+
+    let code = resp.code.unwrap_or(0);
+    let mut keep_alive = resp.version == Some(1);
+    let mut content_length = None;
+    let mut chunked = false;
+
+    let headers = resp
+        .headers
+        .iter()
+        .map(|h| {
+            (
+                h.name.to_string(),
+                String::from_utf8_lossy(h.value).into_owned(),
+            )
+        })
+        .collect::<Vec<(String, String)>>();
+
+    for (name, value) in headers.iter() {
+        let value = value.trim();
+        if name.eq_ignore_ascii_case("content-length") {
+            let len = value
+                .parse::<usize>()
+                .map_err(|_| invalid("invalid content length"))?;
+
+            if content_length.map_or(false, |l| l != len) {
+                return Err(invalid("conflicting content lengths"));
+            }
+            content_length = Some(len);
+        } else if name.eq_ignore_ascii_case("transfer-encoding") {
+            chunked = value
+                .rsplit(',')
+                .next()
+                .map_or(false, |v| v.trim().eq_ignore_ascii_case("chunked"));
+        } else if name.eq_ignore_ascii_case("connection") {
+            for token in value.split(',') {
+                if token.trim().eq_ignore_ascii_case("close") {
+                    keep_alive = false;
+                } else if token.trim().eq_ignore_ascii_case("keep-alive") {
+                    keep_alive = true;
+                }
+            }
+        }
+    }
+
+    let framing = if head_only || code / 100 == 1 || code == 204 || code == 304 {
+        Framing::Length(0)
+    } else if chunked {
+        Framing::Chunked(ChunkState::Size)
+    } else if let Some(len) = content_length {
+        Framing::Length(len)
+    } else {
+        keep_alive = false;
+        Framing::Close
+    };
+
+    Ok(Some(Head {
+        len,
+        code,
+        headers,
+        framing,
+        keep_alive,
+    }))
+}
+
+impl Framing {
+    // take decodes the body at the start of buf into data,
+    // returning the bytes of buf it consumed.
+    pub fn take(&mut self, buf: &[u8], data: &mut Vec<u8>) -> io::Result<usize> {
+        match self {
+            Framing::Length(left) => {
+                let n = (*left).min(buf.len());
+                data.extend_from_slice(&buf[..n]);
+                *left -= n;
+                Ok(n)
+            }
+            Framing::Close => {
+                data.extend_from_slice(buf);
+                Ok(buf.len())
+            }
+            Framing::Chunked(state) => take_chunked(state, buf, data),
+        }
+    }
+
+    pub fn is_done(&self) -> bool {
+        matches!(
+            self,
+            Framing::Length(0) | Framing::Chunked(ChunkState::Done)
+        )
+    }
+}
+
+// take_chunked decodes what it can of a chunked body from
+// buf into data, picking up from state. It returns the bytes
+// consumed, the rest are kept until more arrive.
+fn take_chunked(state: &mut ChunkState, buf: &[u8], data: &mut Vec<u8>) -> io::Result<usize> {
+    let mut pos = 0;
+
+    loop {
+        match *state {
+            ChunkState::Size => {
+                let line_end = match find_crlf(&buf[pos..]) {
+                    Some(i) => pos + i,
+                    None if buf.len() - pos > MAX_HEAD_SIZE => {
+                        return Err(invalid("invalid chunk size"))
+                    }
+                    None => return Ok(pos),
+                };
+
+                let size = parse_chunk_size(&buf[pos..line_end])?;
+                pos = line_end + 2;
+                *state = if size == 0 {
+                    ChunkState::Trailers
+                } else {
+                    ChunkState::Data(size)
+                };
+            }
+            ChunkState::Data(left) => {
+                let n = left.min(buf.len() - pos);
+                data.extend_from_slice(&buf[pos..pos + n]);
+                pos += n;
+
+                if n < left {
+                    *state = ChunkState::Data(left - n);
+                    return Ok(pos);
+                }
+
+                *state = ChunkState::DataEnd;
+            }
+            ChunkState::DataEnd => {
+                if buf.len() - pos < 2 {
+                    return Ok(pos);
+                }
+
+                if &buf[pos..pos + 2] != b"\r\n" {
+                    return Err(invalid("invalid chunk"));
+                }
+
+                pos += 2;
+                *state = ChunkState::Size;
+            }
+            ChunkState::Trailers => {
+                // Skip any trailers, up to the blank line
+                let end = match find_crlf(&buf[pos..]) {
+                    Some(i) => pos + i,
+                    None if buf.len() - pos > MAX_HEAD_SIZE => {
+                        return Err(invalid("trailers too large"))
+                    }
+                    None => return Ok(pos),
+                };
+
+                if end == pos {
+                    *state = ChunkState::Done;
+                }
+
+                pos = end + 2;
+            }
+            ChunkState::Done => return Ok(pos),
+        }
+    }
+}
+
+fn parse_chunk_size(line: &[u8]) -> io::Result<usize> {
+    let line = std::str::from_utf8(line).map_err(|_| invalid("invalid chunk size"))?;
+    usize::from_str_radix(line.split(';').next().unwrap_or("").trim(), 16)
+        .map_err(|_| invalid("invalid chunk size"))
+}
+
+// head_end returns where the head in buf ends, if it
+// has. Only buf[from..] is searched, from is where the
+// previous search left off.
+pub fn head_end(buf: &[u8], from: usize) -> Option<usize> {
+    let from = from.saturating_sub(3);
+    buf[from..]
+        .windows(4)
+        .position(|w| w == b"\r\n\r\n")
+        .map(|i| from + i + 4)
+}
+
+fn find_crlf(buf: &[u8]) -> Option<usize> {
+    buf.windows(2).position(|w| w == b"\r\n")
+}
+
+fn percent_encode(s: &str) -> String {
+    let mut encoded = String::with_capacity(s.len());
+    for b in s.bytes() {
+        match b {
+            b'A'..=b'Z' | b'a'..=b'z' | b'0'..=b'9' | b'-' | b'.' | b'_' | b'~' => {
+                encoded.push(b as char)
+            }
+            _ => encoded.push_str(&format!("%{:02X}", b)),
+        }
+    }
+
+    encoded
+}
+
+pub fn invalid(msg: &'static str) -> io::Error {
+    io::Error::new(ErrorKind::InvalidData, msg)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn decode(parts: &[&[u8]]) -> io::Result<(Vec<u8>, bool)> {
+        let mut framing = Framing::Chunked(ChunkState::Size);
+        let mut buf = Vec::new();
+        let mut data = Vec::new();
+
+        for part in parts {
+            buf.extend_from_slice(part);
+            let used = framing.take(&buf, &mut data)?;
+            buf.drain(..used);
+        }
+
+        Ok((data, framing.is_done()))
+    }
+
+    #[test]
+    fn chunked_in_one_read() {
+        let (data, done) = decode(&[b"5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\n"]).unwrap();
+        assert_eq!(data, b"hello world");
+        assert!(done);
+    }
+
+    #[test]
+    fn chunked_split_anywhere() {
+        let body: &[u8] = b"5\r\nhello\r\n6\r\n world\r\n0\r\nX-Sum: 1\r\n\r\n";
+        for i in 0..body.len() {
+            let (data, done) = decode(&[&body[..i], &body[i..]]).unwrap();
+            assert_eq!(data, b"hello world");
+            assert!(done);
+        }
+    }
+
+    #[test]
+    fn chunked_incomplete() {
+        let (data, done) = decode(&[b"5\r\nhel"]).unwrap();
+        assert_eq!(data, b"hel");
+        assert!(!done);
+    }
+
+    #[test]
+    fn chunked_invalid() {
+        assert!(decode(&[b"zz\r\n"]).is_err());
+        assert!(decode(&[b"1\r\nab\r\n"]).is_err());
+    }
+
+    #[test]
+    fn head_framing() {
+        let head = parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc", false)
+            .unwrap()
+            .unwrap();
+        assert_eq!(head.len, 38);
+        assert!(matches!(head.framing, Framing::Length(3)));
+        assert!(head.keep_alive);
+
+        let head = parse_head(b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n", true)
+            .unwrap()
+            .unwrap();
+        assert!(head.framing.is_done());
+
+        let head = parse_head(b"HTTP/1.0 200 OK\r\n\r\n", false)
+            .unwrap()
+            .unwrap();
+        assert!(matches!(head.framing, Framing::Close));
+        assert!(!head.keep_alive);
+
+        let head = parse_head(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: gzip, chunked\r\nContent-Length: 3\r\n\r\n",
+            false,
+        )
+        .unwrap()
+        .unwrap();
+        assert!(matches!(head.framing, Framing::Chunked(_)));
+
+        assert!(parse_head(b"HTTP/1.1 200 OK\r\nContent-Len", false)
+            .unwrap()
+            .is_none());
+        assert!(parse_head(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\nContent-Length: 2\r\n\r\n",
+            false
+        )
+        .is_err());
+    }
+
+    #[test]
+    fn head_end_resumes() {
+        let buf = b"HTTP/1.1 200 OK\r\n\r\nbody";
+        assert_eq!(head_end(&buf[..17], 0), None);
+        assert_eq!(head_end(buf, 17), Some(19));
+        assert_eq!(head_end(buf, 0), Some(19));
+    }
+}
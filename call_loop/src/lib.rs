@@ -0,0 +1,246 @@
+use std::collections::HashSet;
+use std::io;
+use std::sync::mpsc::{Receiver, Sender, TryRecvError};
+use std::sync::{Arc, Mutex, PoisonError};
+use std::thread::Builder as ThreadBuilder;
+use std::time::{Duration, Instant};
+
+use mio::{Events, Poll, Waker};
+
+mod calls;
+mod dns;
+mod http;
+mod notify;
+mod pool;
+mod stream;
+
+pub use calls::Shared;
+pub use notify::Notify;
+use pool::{Pool, WAKE_TOKEN};
+pub use stream::{LoopWaker, Next, StreamReader};
+
+pub struct CallSend {
+    pub id: i32,
+    pub timeout_ms: u64,
+
+    // HTTP stuff
+    pub method: String,
+    pub host: String,
+    pub port: u16,
+    pub path_segms: Vec<String>,
+    pub use_ssl: bool,
+    pub params: Vec<(String, String)>,
+    pub headers: Vec<(String, String)>,
+    pub body: Vec<u8>,
+
+    // Decode the response body as JSON
+    pub decode_json: bool,
+
+    // Complete the call once the head arrives,
+    // the body follows on CallResponse.stream.
+    pub stream: bool,
+}
+
+pub struct CallRecv {
+    pub id: i32,
+    pub call_result: CallResult,
+
+    // Whether the call reused a pooled connection,
+    // and the loop's pool hits and misses so far.
+    pub reused: bool,
+    pub pool_hits: u64,
+    pub pool_misses: u64,
+
+    // When the loop completed the call
+    pub completed: Instant,
+}
+
+pub struct CallResponse {
+    pub code: u16,
+    pub headers: Vec<(String, String)>,
+    pub body: Vec<u8>,
+
+    // The body decoded as JSON, if that was
+    // requested and the body isn't empty.
+    pub json: Option<Result<serde_json::Value, String>>,
+
+    // The body of a streaming call, body is empty
+    pub stream: Option<StreamReader>,
+}
+
+impl CallResponse {
+    // decode_json decodes the body, the request only
+    // converts it to Python objects if it's used.
+    fn decode_json(&mut self) {
+        if !self.body.is_empty() {
+            let decoded = serde_json::from_slice(&self.body);
+            self.json = Some(decoded.map_err(|e| e.to_string()));
+        }
+    }
+}
+
+#[derive(Debug)]
+pub struct CallError {
+    pub action: &'static str,
+    pub err: io::Error,
+}
+
+pub type CallResult = std::result::Result<CallResponse, CallError>;
+
+#[derive(Copy, Clone, Debug)]
+pub struct Config {
+    pub max_idle_per_host: usize,
+    pub idle_timeout_ms: u64,
+    pub max_per_host: usize,
+
+    // A streamed body fails once nothing has arrived for
+    // this long, unless it's waiting on its reader.
+    pub stream_idle_ms: u64,
+}
+
+// CallLoop places calls on the call_loop thread, their
+// results are sent on outq and notify is woken.
+pub struct CallLoop {
+    inq: Mutex<Option<Sender<CallSend>>>,
+    waker: Arc<LoopWaker>,
+}
+
+impl CallLoop {
+    // spawn starts the loop, which is restarted
+    // after on_error is called with any error.
+    pub fn spawn<F>(
+        cfg: Config,
+        outq: Sender<CallRecv>,
+        notify: Arc<Notify>,
+        on_error: F,
+    ) -> io::Result<Self>
+    where
+        F: Fn(io::Error) + Send + 'static,
+    {
+        let (inq_s, inq_r) = std::sync::mpsc::channel();
+        let waker = Arc::new(LoopWaker::default());
+        let loop_waker = waker.clone();
+
+        ThreadBuilder::new()
+            .name("call_loop".to_string())
+            .spawn(move || loop {
+                match run_forever(&inq_r, &outq, &notify, &loop_waker, cfg) {
+                    Ok(()) => break,
+                    Err(e) => {
+                        on_error(e);
+
+                        // restart the loop
+                        std::thread::sleep(Duration::from_secs(1));
+                    }
+                }
+            })?;
+
+        Ok(Self {
+            inq: Mutex::new(Some(inq_s)),
+            waker,
+        })
+    }
+
+    pub fn send(&self, call_send: CallSend) -> Result<(), String> {
+        self.inq
+            .lock()
+            .unwrap_or_else(PoisonError::into_inner)
+            .as_ref()
+            .ok_or_else(|| "call loop closed".to_string())?
+            .send(call_send)
+            .map_err(|_| "call loop exited".to_string())?;
+
+        self.waker.wake();
+        Ok(())
+    }
+}
+
+impl Drop for CallLoop {
+    fn drop(&mut self) {
+        // The loop exits once it sees inq has closed
+        self.inq
+            .lock()
+            .unwrap_or_else(PoisonError::into_inner)
+            .take();
+        self.waker.wake();
+    }
+}
+
+fn run_forever(
+    inq: &Receiver<CallSend>,
+    outq: &Sender<CallRecv>,
+    notify: &Notify,
+    waker: &Arc<LoopWaker>,
+    cfg: Config,
+) -> io::Result<()> {
+    let mut poll = Poll::new()?;
+    let mut events = Events::with_capacity(128);
+    waker.set(Some(Arc::new(Waker::new(poll.registry(), WAKE_TOKEN)?)));
+
+    let mut pool = Pool::new(cfg, poll.registry().try_clone()?, waker.clone());
+    let mut done = vec![];
+    let mut json_ids = HashSet::new();
+
+    loop {
+        for ev in events.iter() {
+            if ev.token() != WAKE_TOKEN {
+                pool.event(ev.token(), &mut done);
+            }
+        }
+
+        // Take every call which is waiting
+        loop {
+            match inq.try_recv() {
+                Ok(call_send) => {
+                    if call_send.decode_json {
+                        json_ids.insert(call_send.id);
+                    }
+                    pool.submit(call_send, &mut done);
+                }
+                Err(TryRecvError::Empty) => break,
+                Err(TryRecvError::Disconnected) => return Ok(()),
+            }
+        }
+
+        pool.resolved(&mut done);
+        pool.resume(&mut done);
+        pool.expire(&mut done);
+        pool.start_ready(&mut done);
+
+        let delivered = !done.is_empty();
+        for mut finished in done.drain(..) {
+            // Decoded here, off the request thread
+            if json_ids.remove(&finished.id) {
+                if let Ok(ref mut resp) = finished.result {
+                    resp.decode_json();
+                }
+            }
+
+            let r = outq.send(CallRecv {
+                id: finished.id,
+                call_result: finished.result,
+                reused: finished.reused,
+                pool_hits: pool.hits,
+                pool_misses: pool.misses,
+                completed: Instant::now(),
+            });
+
+            if r.is_err() {
+                // Couldn't send - close loop
+                return Ok(());
+            }
+        }
+
+        if delivered {
+            notify.notify();
+        }
+
+        // Sleep until there's an event, a call is sent
+        // or something in flight expires.
+        if let Err(e) = poll.poll(&mut events, pool.next_timeout()) {
+            if e.kind() != io::ErrorKind::Interrupted {
+                return Err(e);
+            }
+        }
+    }
+}
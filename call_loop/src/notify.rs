@@ -0,0 +1,127 @@
+// Event loops waiting on calls watch the reading end of a
+// socket pair, a byte is written to each writing end as
+// calls complete. Each reader also queues the ids which
+// completed since it last took them, so an event loop
+// only looks at the calls which are done.
+
+use std::io::{ErrorKind, Write};
+use std::os::unix::io::{IntoRawFd, RawFd};
+use std::os::unix::net::UnixStream;
+use std::sync::{Mutex, PoisonError};
+
+// A reader which doesn't take its ids stops queueing
+// them past this, it has to look at all its calls.
+const MAX_READY: usize = 4096;
+
+struct Reader {
+    fd: RawFd,
+    writer: UnixStream,
+    ready: Vec<i32>,
+    overflowed: bool,
+}
+
+#[derive(Default)]
+pub struct Notify {
+    readers: Mutex<Vec<Reader>>,
+}
+
+impl Notify {
+    // reader returns the reading end of a new socket pair,
+    // the caller owns it and closes it once it's done.
+    pub fn reader(&self) -> std::io::Result<RawFd> {
+        let (reader, writer) = UnixStream::pair()?;
+        reader.set_nonblocking(true)?;
+        writer.set_nonblocking(true)?;
+        let fd = reader.into_raw_fd();
+
+        let mut readers = self.readers.lock().unwrap_or_else(PoisonError::into_inner);
+
+        // A closed reader's fd may be reused before we've
+        // noticed it's closed
+        readers.retain(|r| r.fd != fd);
+        readers.push(Reader {
+            fd,
+            writer,
+            ready: Vec::new(),
+            overflowed: false,
+        });
+        Ok(fd)
+    }
+
+    // notify wakes every reader. A full socket already has
+    // a wake-up pending, a closed one is dropped.
+    pub fn notify(&self) {
+        self.completed(&[]);
+    }
+
+    // completed queues ids on every reader and wakes them
+    pub fn completed(&self, ids: &[i32]) {
+        let mut readers = self.readers.lock().unwrap_or_else(PoisonError::into_inner);
+
+        readers.retain_mut(|r| {
+            if !r.overflowed {
+                if r.ready.len() + ids.len() > MAX_READY {
+                    r.ready = Vec::new();
+                    r.overflowed = true;
+                } else {
+                    r.ready.extend_from_slice(ids);
+                }
+            }
+
+            match r.writer.write(&[1]) {
+                Ok(_) => true,
+                Err(e) => matches!(e.kind(), ErrorKind::WouldBlock | ErrorKind::Interrupted),
+            }
+        });
+    }
+
+    // take_ready returns the ids completed since fd last took
+    // them. None means fd has to look at all of its calls.
+    pub fn take_ready(&self, fd: RawFd) -> Option<Vec<i32>> {
+        let mut readers = self.readers.lock().unwrap_or_else(PoisonError::into_inner);
+
+        let r = readers.iter_mut().find(|r| r.fd == fd)?;
+        if r.overflowed {
+            r.overflowed = false;
+            return None;
+        }
+
+        Some(std::mem::take(&mut r.ready))
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn readers_take_their_ids() {
+        let notify = Notify::default();
+        let a = notify.reader().unwrap();
+        let b = notify.reader().unwrap();
+
+        notify.completed(&[1, 2]);
+        notify.notify();
+        assert_eq!(notify.take_ready(a), Some(vec![1, 2]));
+        assert_eq!(notify.take_ready(a), Some(vec![]));
+
+        notify.completed(&[3]);
+        assert_eq!(notify.take_ready(b), Some(vec![1, 2, 3]));
+        assert_eq!(notify.take_ready(-1), None);
+    }
+
+    #[test]
+    fn overflowed_reader_checks_everything() {
+        let notify = Notify::default();
+        let fd = notify.reader().unwrap();
+
+        let ids: Vec<i32> = (0..MAX_READY as i32).collect();
+        notify.completed(&ids);
+        notify.completed(&[1]);
+        assert_eq!(notify.take_ready(fd), None);
+
+        // Queueing starts again once it's caught up
+        notify.completed(&[2]);
+        assert_eq!(notify.take_ready(fd), Some(vec![2]));
+    }
+}
@@ -0,0 +1,875 @@
+// Keep-alive connection pools. Calls are made over per host
+// pools of idle connections, plain or TLS, and at most
+// max_per_host connections are open to a host at once.
+
+use std::collections::{HashMap, VecDeque};
+use std::io::{self, ErrorKind, Read, Write};
+use std::net::SocketAddr;
+use std::sync::Arc;
+use std::time::{Duration, Instant};
+
+use mio::net::TcpStream;
+use mio::{Interest, Registry, Token};
+use openssl::ssl::{HandshakeError, MidHandshakeSslStream, SslConnector, SslMethod, SslStream};
+
+use crate::dns::{Name, Resolver};
+use crate::http::{self, Framing, Head};
+use crate::stream::{BodyStream, LoopWaker, StreamReader};
+use crate::{CallError, CallResponse, CallResult, CallSend, Config};
+
+// Token 0 is the loop's waker
+pub const WAKE_TOKEN: Token = Token(0);
+
+const READ_SIZE: usize = 16 * 1024;
+
+#[derive(Clone, Debug, Hash, PartialEq, Eq)]
+struct HostKey {
+    host: String,
+    port: u16,
+    use_ssl: bool,
+}
+
+impl HostKey {
+    fn of(call_send: &CallSend) -> Self {
+        Self {
+            host: call_send.host.clone(),
+            port: call_send.port,
+            use_ssl: call_send.use_ssl,
+        }
+    }
+
+    fn name(&self) -> Name {
+        (self.host.clone(), self.port)
+    }
+}
+
+// Finished is a completed call, successful or not
+pub struct Finished {
+    pub id: i32,
+    pub result: CallResult,
+    pub reused: bool,
+}
+
+enum Io {
+    Plain(TcpStream),
+    Tls(SslStream<TcpStream>),
+}
+
+impl Io {
+    fn tcp(&mut self) -> &mut TcpStream {
+        match self {
+            Io::Plain(s) => s,
+            Io::Tls(s) => s.get_mut(),
+        }
+    }
+
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        match self {
+            Io::Plain(s) => s.read(buf),
+            Io::Tls(s) => s.read(buf),
+        }
+    }
+
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        match self {
+            Io::Plain(s) => s.write(buf),
+            Io::Tls(s) => s.write(buf),
+        }
+    }
+
+    // is_alive is false once the server has closed an idle
+    // connection, or sent on it when it shouldn't have.
+    fn is_alive(&mut self) -> bool {
+        let mut byte = [0u8; 1];
+        loop {
+            match self.read(&mut byte) {
+                Err(e) if e.kind() == ErrorKind::WouldBlock => return true,
+                Err(e) if e.kind() == ErrorKind::Interrupted => continue,
+                _ => return false,
+            }
+        }
+    }
+}
+
+struct Conn {
+    io: Io,
+    idle_since: Instant,
+}
+
+enum Link {
+    Connecting(TcpStream),
+    Handshaking(MidHandshakeSslStream<TcpStream>),
+    Ready(Io),
+    Broken,
+}
+
+impl Link {
+    fn tcp(&mut self) -> Option<&mut TcpStream> {
+        match self {
+            Link::Connecting(s) => Some(s),
+            Link::Handshaking(s) => Some(s.get_mut()),
+            Link::Ready(io) => Some(io.tcp()),
+            Link::Broken => None,
+        }
+    }
+}
+
+struct Call {
+    id: i32,
+    key: HostKey,
+    link: Link,
+    request: Vec<u8>,
+    written: usize,
+    idempotent: bool,
+    head_only: bool,
+    stream: bool,
+    stream_idle: Duration,
+
+    // Past the head, a streamed body's deadline is
+    // reset whenever more of it arrives.
+    deadline: Instant,
+    reused: bool,
+    retried: bool,
+
+    // The response read so far, buf holds what's
+    // been read but not yet parsed.
+    buf: Vec<u8>,
+    scanned: usize,
+    received: bool,
+    head: Option<Head>,
+    body: Vec<u8>,
+
+    // Set once a streaming call has completed with its head
+    body_stream: Option<Arc<BodyStream>>,
+    stalled: bool,
+}
+
+enum Step {
+    Pending,
+    Head(CallResponse),
+    Complete(Option<CallResponse>, bool),
+    Failed(io::Error),
+}
+
+pub struct Pool {
+    cfg: Config,
+    registry: Registry,
+    waker: Arc<LoopWaker>,
+    resolver: Resolver,
+    tls: Option<SslConnector>,
+
+    idle: HashMap<HostKey, Vec<Conn>>,
+    busy: HashMap<HostKey, usize>,
+    waiting: HashMap<HostKey, VecDeque<(CallSend, Instant)>>,
+    resolving: HashMap<Name, Vec<Call>>,
+    calls: HashMap<Token, Call>,
+    next_token: usize,
+
+    // Calls admitted from the waiting queues,
+    // which are yet to be started.
+    ready: VecDeque<CallSend>,
+
+    pub hits: u64,
+    pub misses: u64,
+}
+
+impl Pool {
+    pub fn new(cfg: Config, registry: Registry, waker: Arc<LoopWaker>) -> Self {
+        Self {
+            cfg,
+            registry,
+            resolver: Resolver::new(waker.clone()),
+            waker,
+            tls: None,
+            idle: HashMap::new(),
+            busy: HashMap::new(),
+            waiting: HashMap::new(),
+            resolving: HashMap::new(),
+            calls: HashMap::new(),
+            next_token: 1,
+            ready: VecDeque::new(),
+            hits: 0,
+            misses: 0,
+        }
+    }
+
+    // submit starts the call, or queues it until the
+    // host has a free connection.
+    pub fn submit(&mut self, call_send: CallSend, done: &mut Vec<Finished>) {
+        let key = HostKey::of(&call_send);
+        let idle = self.idle.get(&key).map_or(0, |conns| conns.len());
+        let queued = self.waiting.contains_key(&key);
+        let busy = self.busy.entry(key.clone()).or_insert(0);
+
+        if !queued && (idle > 0 || *busy + idle < self.cfg.max_per_host) {
+            *busy += 1;
+            self.start(call_send, done);
+            return;
+        }
+
+        let deadline = Instant::now() + Duration::from_millis(call_send.timeout_ms);
+        self.waiting
+            .entry(key)
+            .or_insert_with(VecDeque::new)
+            .push_back((call_send, deadline));
+    }
+
+    // start_ready starts the calls admitted as others completed
+    pub fn start_ready(&mut self, done: &mut Vec<Finished>) {
+        while let Some(call_send) = self.ready.pop_front() {
+            self.start(call_send, done);
+        }
+    }
+
+    // release frees a connection slot of key, keeping conn for
+    // reuse if there's room, and admits the next waiting call.
+    fn release(&mut self, key: &HostKey, conn: Option<Io>) {
+        if let Some(busy) = self.busy.get_mut(key) {
+            *busy = busy.saturating_sub(1);
+        }
+
+        if let Some(mut io) = conn {
+            let _ = self.registry.deregister(io.tcp());
+            let idle = self.idle.entry(key.clone()).or_insert_with(Vec::new);
+            if idle.len() < self.cfg.max_idle_per_host {
+                idle.push(Conn {
+                    io,
+                    idle_since: Instant::now(),
+                });
+            }
+        }
+
+        if let Some(queue) = self.waiting.get_mut(key) {
+            if let Some((call_send, _)) = queue.pop_front() {
+                *self.busy.entry(key.clone()).or_insert(0) += 1;
+                self.ready.push_back(call_send);
+            }
+
+            if queue.is_empty() {
+                self.waiting.remove(key);
+            }
+        }
+    }
+
+    // start places an admitted call, on an idle connection
+    // if the host has one.
+    fn start(&mut self, call_send: CallSend, done: &mut Vec<Finished>) {
+        let key = HostKey::of(&call_send);
+        let method = call_send.method.to_ascii_uppercase();
+
+        let mut call = Call {
+            id: call_send.id,
+            key,
+            link: Link::Broken,
+            request: http::build_request(&call_send),
+            written: 0,
+            idempotent: matches!(
+                method.as_str(),
+                "GET" | "HEAD" | "PUT" | "DELETE" | "OPTIONS" | "TRACE"
+            ),
+            head_only: method == "HEAD",
+            stream: call_send.stream,
+            stream_idle: Duration::from_millis(self.cfg.stream_idle_ms),
+            deadline: Instant::now() + Duration::from_millis(call_send.timeout_ms),
+            reused: false,
+            retried: false,
+            buf: Vec::with_capacity(READ_SIZE),
+            scanned: 0,
+            received: false,
+            head: None,
+            body: vec![],
+            body_stream: None,
+            stalled: false,
+        };
+
+        if let Some(io) = self.take_idle(&call.key) {
+            self.hits += 1;
+            call.link = Link::Ready(io);
+            call.reused = true;
+            self.register(call, done);
+            return;
+        }
+
+        self.misses += 1;
+        self.connect(call, done);
+    }
+
+    fn take_idle(&mut self, key: &HostKey) -> Option<Io> {
+        let idle_timeout = Duration::from_millis(self.cfg.idle_timeout_ms);
+        let conns = self.idle.get_mut(key)?;
+
+        while let Some(mut conn) = conns.pop() {
+            if conn.idle_since.elapsed() < idle_timeout && conn.io.is_alive() {
+                return Some(conn.io);
+            }
+        }
+
+        None
+    }
+
+    // connect opens a new connection for call, once
+    // its host has been resolved.
+    fn connect(&mut self, call: Call, done: &mut Vec<Finished>) {
+        let name = call.key.name();
+        match self.resolver.lookup(&name) {
+            None => self
+                .resolving
+                .entry(name)
+                .or_insert_with(Vec::new)
+                .push(call),
+            Some(addr) => self.connect_to(call, addr, done),
+        }
+    }
+
+    fn connect_to(
+        &mut self,
+        mut call: Call,
+        addr: io::Result<SocketAddr>,
+        done: &mut Vec<Finished>,
+    ) {
+        let stream = addr.and_then(|addr| {
+            let stream = TcpStream::connect(addr)?;
+            stream.set_nodelay(true)?;
+            Ok(stream)
+        });
+
+        match stream {
+            Ok(stream) => {
+                call.link = Link::Connecting(stream);
+                self.register(call, done);
+            }
+            Err(e) => self.fail(call, "couldn't connect", e, done),
+        }
+    }
+
+    // resolved connects the calls whose host has been resolved
+    pub fn resolved(&mut self, done: &mut Vec<Finished>) {
+        for (name, addr) in self.resolver.resolved() {
+            for call in self.resolving.remove(&name).unwrap_or_default() {
+                let addr = match addr {
+                    Ok(ref addr) => Ok(*addr),
+                    Err(ref e) => Err(io::Error::new(e.kind(), e.to_string())),
+                };
+                self.connect_to(call, addr, done);
+            }
+        }
+    }
+
+    fn register(&mut self, mut call: Call, done: &mut Vec<Finished>) {
+        let token = Token(self.next_token);
+        self.next_token = if self.next_token == usize::MAX {
+            1
+        } else {
+            self.next_token + 1
+        };
+
+        let registered = match call.link.tcp() {
+            Some(tcp) => {
+                self.registry
+                    .register(tcp, token, Interest::READABLE | Interest::WRITABLE)
+            }
+            None => Err(io::Error::new(ErrorKind::NotConnected, "no connection")),
+        };
+
+        if let Err(e) = registered {
+            self.fail(call, "couldn't register connection", e, done);
+            return;
+        }
+
+        let reused = call.reused;
+        self.calls.insert(token, call);
+
+        // A reused connection is writable straight away
+        if reused {
+            self.event(token, done);
+        }
+    }
+
+    // event progresses the call registered with token
+    pub fn event(&mut self, token: Token, done: &mut Vec<Finished>) {
+        let tls = &mut self.tls;
+        let step = match self.calls.get_mut(&token) {
+            Some(call) => call.step(tls, &self.waker),
+            None => return,
+        };
+
+        match step {
+            Step::Pending => {}
+            Step::Head(resp) => {
+                let call = self.calls.get(&token).expect("expected pooled call");
+                done.push(Finished {
+                    id: call.id,
+                    result: Ok(resp),
+                    reused: call.reused,
+                });
+
+                // Pass on any of the body already read
+                self.event(token, done);
+            }
+            Step::Complete(resp, keep_alive) => {
+                let mut call = self.calls.remove(&token).expect("expected pooled call");
+                let io = match std::mem::replace(&mut call.link, Link::Broken) {
+                    Link::Ready(io) if keep_alive => Some(io),
+                    mut link => {
+                        if let Some(tcp) = link.tcp() {
+                            let _ = self.registry.deregister(tcp);
+                        }
+                        None
+                    }
+                };
+                self.release(&call.key, io);
+
+                match (resp, call.body_stream.take()) {
+                    (_, Some(stream)) => stream.finish(Ok(())),
+                    (Some(resp), None) => done.push(Finished {
+                        id: call.id,
+                        result: Ok(resp),
+                        reused: call.reused,
+                    }),
+                    (None, None) => unreachable!("expected a response"),
+                }
+            }
+            Step::Failed(e) => {
+                let mut call = self.calls.remove(&token).expect("expected pooled call");
+                if let Some(tcp) = call.link.tcp() {
+                    let _ = self.registry.deregister(tcp);
+                }
+                call.link = Link::Broken;
+
+                if call.may_retry() {
+                    // The server closed the idle connection
+                    // before it saw the request, retry once
+                    // on a new one.
+                    call.reset();
+                    self.misses += 1;
+                    self.connect(call, done);
+                    return;
+                }
+
+                self.fail(call, "couldn't complete call", e, done);
+            }
+        }
+    }
+
+    fn fail(
+        &mut self,
+        mut call: Call,
+        action: &'static str,
+        e: io::Error,
+        done: &mut Vec<Finished>,
+    ) {
+        self.release(&call.key, None);
+
+        let err = CallError { action, err: e };
+        match call.body_stream.take() {
+            Some(stream) => stream.finish(Err(err)),
+            None => done.push(Finished {
+                id: call.id,
+                result: Err(err),
+                reused: call.reused,
+            }),
+        }
+    }
+
+    // expire fails calls past their timeout and
+    // closes connections idle for too long.
+    pub fn expire(&mut self, done: &mut Vec<Finished>) {
+        let now = Instant::now();
+
+        let expired: Vec<Token> = self
+            .calls
+            .iter()
+            .filter(|(_, call)| call.expires_at().map_or(false, |at| at <= now))
+            .map(|(token, _)| *token)
+            .collect();
+
+        for token in expired {
+            let mut call = self.calls.remove(&token).expect("expected pooled call");
+            if let Some(tcp) = call.link.tcp() {
+                let _ = self.registry.deregister(tcp);
+            }
+
+            let action = if call.body_stream.is_some() {
+                "streamed body idle past its timeout"
+            } else {
+                "call timed out"
+            };
+            self.fail(call, action, timed_out(), done);
+        }
+
+        let mut resolving = vec![];
+        for calls in self.resolving.values_mut() {
+            let (expired, kept) = calls.drain(..).partition(|call| call.deadline <= now);
+            *calls = kept;
+            resolving.extend(expired);
+        }
+
+        for call in resolving {
+            self.fail(call, "call timed out resolving its host", timed_out(), done);
+        }
+
+        let mut queued = vec![];
+        for queue in self.waiting.values_mut() {
+            queue.retain(|(call_send, deadline)| {
+                if *deadline <= now {
+                    queued.push(call_send.id);
+                    return false;
+                }
+
+                true
+            });
+        }
+        self.waiting.retain(|_, queue| !queue.is_empty());
+
+        for id in queued {
+            done.push(Finished {
+                id,
+                result: Err(CallError {
+                    action: "call queued past its timeout",
+                    err: timed_out(),
+                }),
+                reused: false,
+            });
+        }
+
+        let idle_timeout = Duration::from_millis(self.cfg.idle_timeout_ms);
+        for conns in self.idle.values_mut() {
+            conns.retain(|conn| now.duration_since(conn.idle_since) < idle_timeout);
+        }
+        self.idle.retain(|_, conns| !conns.is_empty());
+    }
+
+    // next_timeout is how long the loop may sleep before
+    // a call or idle connection expires. A stalled stream
+    // waits on its reader, the reader wakes the loop.
+    pub fn next_timeout(&self) -> Option<Duration> {
+        let idle_timeout = Duration::from_millis(self.cfg.idle_timeout_ms);
+
+        let next = self
+            .calls
+            .values()
+            .chain(self.resolving.values().flatten())
+            .filter_map(|call| call.expires_at())
+            .chain(
+                self.waiting
+                    .values()
+                    .flatten()
+                    .map(|(_, deadline)| *deadline),
+            )
+            .chain(
+                self.idle
+                    .values()
+                    .flatten()
+                    .map(|conn| conn.idle_since + idle_timeout),
+            )
+            .min()?;
+
+        Some(next.saturating_duration_since(Instant::now()))
+    }
+
+    // resume steps the streaming calls whose reader has
+    // caught up with them, or closed the stream.
+    pub fn resume(&mut self, done: &mut Vec<Finished>) {
+        let resumed: Vec<Token> = self
+            .calls
+            .iter()
+            .filter(|(_, call)| match call.body_stream {
+                Some(ref stream) => call.stalled || stream.is_closed(),
+                None => false,
+            })
+            .map(|(token, _)| *token)
+            .collect();
+
+        for token in resumed {
+            self.event(token, done);
+        }
+    }
+}
+
+impl Call {
+    // expires_at is None while the call's reader is behind
+    fn expires_at(&self) -> Option<Instant> {
+        if self.stalled {
+            return None;
+        }
+
+        Some(self.deadline)
+    }
+
+    fn step(&mut self, tls: &mut Option<SslConnector>, waker: &Arc<LoopWaker>) -> Step {
+        loop {
+            let link = std::mem::replace(&mut self.link, Link::Broken);
+            self.link = match link {
+                Link::Connecting(tcp) => {
+                    if let Ok(Some(e)) | Err(e) = tcp.take_error() {
+                        return Step::Failed(e);
+                    }
+
+                    match tcp.peer_addr() {
+                        Ok(_) if self.key.use_ssl => match handshake(tls, &self.key.host, tcp) {
+                            Ok(link) => link,
+                            Err(e) => return Step::Failed(e),
+                        },
+                        Ok(_) => Link::Ready(Io::Plain(tcp)),
+                        Err(e) if e.kind() == ErrorKind::NotConnected => {
+                            self.link = Link::Connecting(tcp);
+                            return Step::Pending;
+                        }
+                        Err(e) => return Step::Failed(e),
+                    }
+                }
+                Link::Handshaking(mid) => match mid.handshake() {
+                    Ok(tls) => Link::Ready(Io::Tls(tls)),
+                    Err(HandshakeError::WouldBlock(mid)) => {
+                        self.link = Link::Handshaking(mid);
+                        return Step::Pending;
+                    }
+                    Err(e) => return Step::Failed(handshake_error(e)),
+                },
+                Link::Ready(io) => {
+                    self.link = Link::Ready(io);
+                    break;
+                }
+                Link::Broken => return Step::Failed(closed()),
+            };
+        }
+
+        let io = match self.link {
+            Link::Ready(ref mut io) => io,
+            _ => unreachable!("expected a connection"),
+        };
+
+        while self.written < self.request.len() {
+            match io.write(&self.request[self.written..]) {
+                Ok(0) => return Step::Failed(io::Error::from(ErrorKind::WriteZero)),
+                Ok(n) => self.written += n,
+                Err(e) if e.kind() == ErrorKind::WouldBlock => return Step::Pending,
+                Err(e) if e.kind() == ErrorKind::Interrupted => continue,
+                Err(e) => return Step::Failed(e),
+            }
+        }
+
+        let mut chunk = [0u8; READ_SIZE];
+        loop {
+            match self.progress(waker) {
+                Step::Pending => {}
+                step => return step,
+            }
+
+            if self.stalled {
+                return Step::Pending;
+            }
+
+            let io = match self.link {
+                Link::Ready(ref mut io) => io,
+                _ => unreachable!("expected a connection"),
+            };
+
+            match io.read(&mut chunk) {
+                Ok(0) => return self.eof(),
+                Ok(n) => {
+                    self.received = true;
+                    if self.body_stream.is_some() {
+                        self.deadline = Instant::now() + self.stream_idle;
+                    }
+                    self.buf.extend_from_slice(&chunk[..n]);
+                }
+                Err(e) if e.kind() == ErrorKind::WouldBlock => return Step::Pending,
+                Err(e) if e.kind() == ErrorKind::Interrupted => continue,
+                Err(e) => return Step::Failed(e),
+            }
+        }
+    }
+
+    // progress parses what's been read so far, it's
+    // Pending until the response has all arrived.
+    fn progress(&mut self, waker: &Arc<LoopWaker>) -> Step {
+        while self.head.is_none() {
+            let end = match http::head_end(&self.buf, self.scanned) {
+                Some(end) => end,
+                None if self.buf.len() > http::MAX_HEAD_SIZE => {
+                    return Step::Failed(http::invalid("response head too large"))
+                }
+                None => {
+                    self.scanned = self.buf.len();
+                    return Step::Pending;
+                }
+            };
+
+            let head = match http::parse_head(&self.buf[..end], self.head_only) {
+                Ok(Some(head)) => head,
+                Ok(None) => return Step::Failed(http::invalid("invalid response head")),
+                Err(e) => return Step::Failed(e),
+            };
+            self.buf.drain(..head.len);
+            self.scanned = 0;
+
+            if head.code / 100 == 1 {
+                if head.code == 101 {
+                    return Step::Failed(http::invalid("unexpected protocol switch"));
+                }
+
+                // Skip interim responses, 100 Continue etc.
+                continue;
+            }
+
+            if self.stream && !head.framing.is_done() {
+                let stream = BodyStream::new(waker.clone());
+                let resp = CallResponse {
+                    code: head.code,
+                    headers: head.headers.clone(),
+                    body: vec![],
+                    json: None,
+                    stream: Some(StreamReader::new(stream.clone())),
+                };
+
+                self.body_stream = Some(stream);
+                self.head = Some(head);
+                self.deadline = Instant::now() + self.stream_idle;
+                return Step::Head(resp);
+            }
+
+            self.head = Some(head);
+        }
+
+        let head = self.head.as_mut().expect("expected response head");
+        let used = match self.body_stream {
+            Some(ref stream) => {
+                if stream.is_closed() {
+                    return Step::Failed(io::Error::new(ErrorKind::Other, "stream abandoned"));
+                }
+
+                let mut data = Vec::with_capacity(self.buf.len());
+                let used = head.framing.take(&self.buf, &mut data);
+                stream.push(data);
+
+                // The idle timeout restarts once the reader catches up
+                let stalled = !stream.wants_more();
+                if self.stalled && !stalled {
+                    self.deadline = Instant::now() + self.stream_idle;
+                }
+                self.stalled = stalled;
+                used
+            }
+            None => head.framing.take(&self.buf, &mut self.body),
+        };
+
+        match used {
+            Ok(used) => {
+                self.buf.drain(..used);
+            }
+            Err(e) => return Step::Failed(e),
+        }
+
+        if !head.framing.is_done() {
+            return Step::Pending;
+        }
+
+        // Never reuse a connection with unexpected bytes on it
+        let keep_alive = head.keep_alive && self.buf.is_empty();
+        self.complete(keep_alive)
+    }
+
+    fn complete(&mut self, keep_alive: bool) -> Step {
+        let head = self.head.take().expect("expected response head");
+        if self.body_stream.is_some() {
+            return Step::Complete(None, keep_alive);
+        }
+
+        Step::Complete(
+            Some(CallResponse {
+                code: head.code,
+                headers: head.headers,
+                body: std::mem::take(&mut self.body),
+                json: None,
+                stream: None,
+            }),
+            keep_alive,
+        )
+    }
+
+    fn eof(&mut self) -> Step {
+        match self.head {
+            Some(Head {
+                framing: Framing::Close,
+                ..
+            }) => {
+                // Delimited by the connection closing
+                if let Some(ref stream) = self.body_stream {
+                    stream.push(std::mem::take(&mut self.buf));
+                } else {
+                    self.body.append(&mut self.buf);
+                }
+                self.complete(false)
+            }
+            _ => Step::Failed(closed()),
+        }
+    }
+
+    // may_retry is true if the call failed on a reused
+    // connection without the server having responded, and
+    // sending it again can't repeat its effect.
+    fn may_retry(&self) -> bool {
+        self.reused
+            && !self.retried
+            && !self.received
+            && (self.idempotent || self.written < self.request.len())
+    }
+
+    fn reset(&mut self) {
+        self.written = 0;
+        self.reused = false;
+        self.retried = true;
+        self.buf.clear();
+        self.scanned = 0;
+    }
+}
+
+fn handshake(tls: &mut Option<SslConnector>, host: &str, tcp: TcpStream) -> io::Result<Link> {
+    if tls.is_none() {
+        let builder = SslConnector::builder(SslMethod::tls_client()).map_err(ssl_error)?;
+        *tls = Some(builder.build());
+    }
+
+    let config = tls
+        .as_ref()
+        .expect("expected ssl connector")
+        .configure()
+        .map_err(ssl_error)?;
+
+    match config.connect(host, tcp) {
+        Ok(tls) => Ok(Link::Ready(Io::Tls(tls))),
+        Err(HandshakeError::WouldBlock(mid)) => Ok(Link::Handshaking(mid)),
+        Err(e) => Err(handshake_error(e)),
+    }
+}
+
+fn handshake_error(e: HandshakeError<TcpStream>) -> io::Error {
+    match e {
+        HandshakeError::SetupFailure(e) => ssl_error(e),
+        HandshakeError::Failure(mid) | HandshakeError::WouldBlock(mid) => {
+            let verify = mid.ssl().verify_result();
+            let msg = if verify.as_raw() != 0 {
+                format!("tls handshake failed - {}", verify.error_string())
+            } else {
+                format!("tls handshake failed - {}", mid.error())
+            };
+            io::Error::new(ErrorKind::Other, msg)
+        }
+    }
+}
+
+fn ssl_error(e: openssl::error::ErrorStack) -> io::Error {
+    io::Error::new(ErrorKind::Other, e)
+}
+
+fn timed_out() -> io::Error {
+    io::Error::new(ErrorKind::TimedOut, "timed out")
+}
+
+fn closed() -> io::Error {
+    io::Error::new(
+        ErrorKind::UnexpectedEof,
+        "connection closed before response completed",
+    )
+}
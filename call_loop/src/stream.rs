@@ -0,0 +1,193 @@
+use std::collections::VecDeque;
+use std::sync::{Arc, Condvar, Mutex, MutexGuard, PoisonError};
+
+use mio::Waker;
+
+use crate::CallError;
+
+// A streamed body queues at most this much ahead of its
+// reader, past it the loop stops reading the connection.
+const MAX_STREAM_QUEUED: usize = 256 * 1024;
+
+// LoopWaker wakes the call loop from other threads. It's
+// empty while the loop (re)starts, the loop then picks up
+// anything sent meanwhile by itself.
+#[derive(Default)]
+pub struct LoopWaker {
+    waker: Mutex<Option<Arc<Waker>>>,
+}
+
+impl LoopWaker {
+    pub(crate) fn set(&self, waker: Option<Arc<Waker>>) {
+        *self.waker.lock().unwrap_or_else(PoisonError::into_inner) = waker;
+    }
+
+    pub fn wake(&self) {
+        let waker = self
+            .waker
+            .lock()
+            .unwrap_or_else(PoisonError::into_inner)
+            .clone();
+
+        if let Some(waker) = waker {
+            // Only fails if the loop's poll has gone
+            let _ = waker.wake();
+        }
+    }
+}
+
+// BodyStream carries a streaming call's body from the
+// loop, which fills it, to the request reading it.
+pub struct BodyStream {
+    state: Mutex<StreamState>,
+    ready: Condvar,
+    waker: Arc<LoopWaker>,
+}
+
+struct StreamState {
+    chunks: VecDeque<Vec<u8>>,
+    queued: usize,
+    finished: bool,
+    error: Option<CallError>,
+    closed: bool,
+
+    // The loop stopped reading, wake it once
+    // the reader has caught up.
+    stalled: bool,
+}
+
+pub enum Next {
+    Chunk(Vec<u8>),
+    End,
+    Failed(CallError),
+}
+
+impl BodyStream {
+    pub(crate) fn new(waker: Arc<LoopWaker>) -> Arc<Self> {
+        Arc::new(Self {
+            state: Mutex::new(StreamState {
+                chunks: VecDeque::new(),
+                queued: 0,
+                finished: false,
+                error: None,
+                closed: false,
+                stalled: false,
+            }),
+            ready: Condvar::new(),
+            waker,
+        })
+    }
+
+    fn lock(&self) -> MutexGuard<'_, StreamState> {
+        self.state.lock().unwrap_or_else(PoisonError::into_inner)
+    }
+
+    // push queues a chunk, unless the reader has gone
+    pub(crate) fn push(&self, chunk: Vec<u8>) {
+        let mut state = self.lock();
+        if state.closed || chunk.is_empty() {
+            return;
+        }
+
+        state.queued += chunk.len();
+        state.chunks.push_back(chunk);
+        self.ready.notify_all();
+    }
+
+    pub(crate) fn finish(&self, result: Result<(), CallError>) {
+        let mut state = self.lock();
+        state.finished = true;
+        state.error = result.err();
+        self.ready.notify_all();
+    }
+
+    // wants_more is false while the reader is behind,
+    // the reader then wakes the loop once it catches up.
+    pub(crate) fn wants_more(&self) -> bool {
+        let mut state = self.lock();
+        state.stalled = state.queued >= MAX_STREAM_QUEUED;
+        !state.stalled
+    }
+
+    pub(crate) fn is_closed(&self) -> bool {
+        self.lock().closed
+    }
+
+    // next blocks until a chunk arrives or the body ends
+    pub fn next(&self) -> Next {
+        let mut state = self.lock();
+        loop {
+            if let Some(chunk) = state.chunks.pop_front() {
+                state.queued -= chunk.len();
+
+                let resume = state.stalled && state.queued < MAX_STREAM_QUEUED / 2;
+                if resume {
+                    state.stalled = false;
+                }
+
+                drop(state);
+                if resume {
+                    self.waker.wake();
+                }
+
+                return Next::Chunk(chunk);
+            }
+
+            if state.finished {
+                return match state.error.take() {
+                    Some(e) => Next::Failed(e),
+                    None => Next::End,
+                };
+            }
+
+            state = self
+                .ready
+                .wait(state)
+                .unwrap_or_else(PoisonError::into_inner);
+        }
+    }
+
+    // close drops the body, the loop abandons the call
+    pub fn close(&self) {
+        let mut state = self.lock();
+        if state.closed {
+            return;
+        }
+
+        state.closed = true;
+        state.chunks.clear();
+        state.queued = 0;
+
+        let wake = !state.finished;
+        drop(state);
+        if wake {
+            self.waker.wake();
+        }
+    }
+}
+
+// StreamReader is the reading end of a BodyStream,
+// dropping it closes the stream.
+pub struct StreamReader {
+    stream: Arc<BodyStream>,
+}
+
+impl StreamReader {
+    pub(crate) fn new(stream: Arc<BodyStream>) -> Self {
+        Self { stream }
+    }
+
+    pub fn next(&self) -> Next {
+        self.stream.next()
+    }
+
+    pub fn close(&self) {
+        self.stream.close()
+    }
+}
+
+impl Drop for StreamReader {
+    fn drop(&mut self) {
+        self.stream.close();
+    }
+}
@@ -0,0 +1,869 @@
+// Calls against servers on the loopback interface
+
+use std::io::{self, BufRead, BufReader, ErrorKind, Read, Write};
+use std::net::{TcpListener, TcpStream};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::mpsc::{channel, Receiver};
+use std::sync::{Arc, Mutex, OnceLock};
+use std::thread;
+use std::time::{Duration, Instant};
+
+use call_loop::{CallLoop, CallRecv, CallSend, Config, Next, Notify};
+
+const CFG: Config = Config {
+    max_idle_per_host: 8,
+    idle_timeout_ms: 4000,
+    max_per_host: 32,
+    stream_idle_ms: 5000,
+};
+
+struct Request {
+    method: String,
+    target: String,
+    headers: Vec<(String, String)>,
+    body: Vec<u8>,
+}
+
+impl Request {
+    fn header(&self, name: &str) -> Option<&str> {
+        self.headers
+            .iter()
+            .find(|(n, _)| n.eq_ignore_ascii_case(name))
+            .map(|(_, v)| v.as_str())
+    }
+}
+
+// read_request reads a request off conn, None once it closes
+fn read_request<R: Read>(conn: &mut BufReader<R>) -> Option<Request> {
+    let mut line = String::new();
+    if conn.read_line(&mut line).ok()? == 0 {
+        return None;
+    }
+
+    let mut parts = line.split_whitespace();
+    let method = parts.next()?.to_string();
+    let target = parts.next()?.to_string();
+
+    let mut headers = vec![];
+    loop {
+        let mut line = String::new();
+        conn.read_line(&mut line).ok()?;
+        let line = line.trim_end();
+        if line.is_empty() {
+            break;
+        }
+
+        let (name, value) = line.split_once(':')?;
+        headers.push((name.trim().to_string(), value.trim().to_string()));
+    }
+
+    let mut request = Request {
+        method,
+        target,
+        headers,
+        body: vec![],
+    };
+
+    let len = request
+        .header("content-length")
+        .map_or(0, |l| l.parse().unwrap());
+    request.body = vec![0; len];
+    conn.read_exact(&mut request.body).ok()?;
+    Some(request)
+}
+
+// Server accepts connections on a loopback port,
+// handle is run on its own thread for each.
+struct Server {
+    port: u16,
+    accepted: Arc<AtomicUsize>,
+}
+
+fn serve<F>(handle: F) -> Server
+where
+    F: Fn(TcpStream) + Send + Sync + 'static,
+{
+    let listener = TcpListener::bind("127.0.0.1:0").unwrap();
+    let port = listener.local_addr().unwrap().port();
+    let accepted = Arc::new(AtomicUsize::new(0));
+    let handle = Arc::new(handle);
+
+    let count = accepted.clone();
+    thread::spawn(move || {
+        for conn in listener.incoming() {
+            let conn = match conn {
+                Ok(conn) => conn,
+                Err(_) => return,
+            };
+
+            count.fetch_add(1, Ordering::SeqCst);
+            let handle = handle.clone();
+            thread::spawn(move || handle(conn));
+        }
+    });
+
+    Server { port, accepted }
+}
+
+// serve_requests responds to each request on a
+// connection with respond, until it's closed.
+fn serve_requests<F>(respond: F) -> Server
+where
+    F: Fn(&Request) -> Vec<u8> + Send + Sync + 'static,
+{
+    serve(move |conn| {
+        let mut writer = conn.try_clone().unwrap();
+        let mut reader = BufReader::new(conn);
+        while let Some(request) = read_request(&mut reader) {
+            if writer.write_all(&respond(&request)).is_err() {
+                return;
+            }
+        }
+    })
+}
+
+fn ok(body: &str) -> Vec<u8> {
+    format!(
+        "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n{}",
+        body.len(),
+        body
+    )
+    .into_bytes()
+}
+
+struct Client {
+    call_loop: CallLoop,
+    outq: Receiver<CallRecv>,
+    notify: Arc<Notify>,
+    id: i32,
+}
+
+impl Client {
+    fn new(cfg: Config) -> Self {
+        let (outq_s, outq_r) = channel();
+        let notify = Arc::new(Notify::default());
+        let call_loop = CallLoop::spawn(cfg, outq_s, notify.clone(), |e| {
+            panic!("call loop failed - {}", e)
+        });
+
+        Self {
+            call_loop: call_loop.unwrap(),
+            outq: outq_r,
+            notify,
+            id: 0,
+        }
+    }
+
+    fn send(&mut self, mut call_send: CallSend) -> i32 {
+        self.id += 1;
+        call_send.id = self.id;
+        self.call_loop.send(call_send).unwrap();
+        self.id
+    }
+
+    fn recv(&self) -> CallRecv {
+        self.outq
+            .recv_timeout(Duration::from_secs(10))
+            .expect("call didn't complete")
+    }
+
+    fn call(&mut self, call_send: CallSend) -> CallRecv {
+        let id = self.send(call_send);
+        let recv = self.recv();
+        assert_eq!(recv.id, id);
+        recv
+    }
+}
+
+fn get(port: u16) -> CallSend {
+    CallSend {
+        id: 0,
+        timeout_ms: 5000,
+        method: "GET".to_string(),
+        host: "127.0.0.1".to_string(),
+        port,
+        path_segms: vec!["a b".to_string(), "c".to_string()],
+        use_ssl: false,
+        params: vec![("q".to_string(), "1&2".to_string())],
+        headers: vec![("X-Test".to_string(), "yes".to_string())],
+        body: vec![],
+        decode_json: false,
+        stream: false,
+    }
+}
+
+fn post(port: u16, body: &[u8]) -> CallSend {
+    CallSend {
+        method: "POST".to_string(),
+        body: body.to_vec(),
+        ..get(port)
+    }
+}
+
+fn body(recv: &CallRecv) -> &[u8] {
+    &recv.call_result.as_ref().expect("call failed").body
+}
+
+fn error_kind(recv: &CallRecv) -> ErrorKind {
+    match recv.call_result {
+        Ok(_) => panic!("call didn't fail"),
+        Err(ref e) => e.err.kind(),
+    }
+}
+
+fn header<'a>(recv: &'a CallRecv, name: &str) -> Option<&'a str> {
+    recv.call_result
+        .as_ref()
+        .expect("call failed")
+        .headers
+        .iter()
+        .find(|(n, _)| n.eq_ignore_ascii_case(name))
+        .map(|(_, v)| v.as_str())
+}
+
+// read_stream reads a streamed body to its end
+fn read_stream(recv: &CallRecv, delay: Duration) -> io::Result<Vec<u8>> {
+    let stream = recv
+        .call_result
+        .as_ref()
+        .expect("call failed")
+        .stream
+        .as_ref()
+        .expect("expected a stream");
+
+    let mut data = vec![];
+    loop {
+        match stream.next() {
+            Next::Chunk(chunk) => data.extend_from_slice(&chunk),
+            Next::End => return Ok(data),
+            Next::Failed(e) => return Err(e.err),
+        }
+        thread::sleep(delay);
+    }
+}
+
+#[test]
+fn content_length_reuses_connection() {
+    let server = serve_requests(|req| {
+        assert_eq!(req.target, "/a%20b/c?q=1%262");
+        assert_eq!(req.header("x-test"), Some("yes"));
+        assert!(req.header("host").unwrap().starts_with("127.0.0.1:"));
+        assert_eq!(req.header("cache-control"), Some("no-cache"));
+        ok(&format!("hello {}", req.method))
+    });
+
+    let mut client = Client::new(CFG);
+    for n in 0..3 {
+        let recv = client.call(get(server.port));
+        assert_eq!(body(&recv), b"hello GET");
+        assert_eq!(recv.reused, n > 0);
+        assert_eq!(recv.pool_hits, n);
+        assert_eq!(recv.pool_misses, 1);
+    }
+
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 1);
+}
+
+#[test]
+fn completed_calls_notify() {
+    use std::os::unix::io::FromRawFd;
+    use std::os::unix::net::UnixStream;
+
+    let server = serve_requests(|_| ok("hello"));
+    let mut client = Client::new(CFG);
+    let reader = unsafe { UnixStream::from_raw_fd(client.notify.reader().unwrap()) };
+    reader
+        .set_read_timeout(Some(Duration::from_secs(5)))
+        .unwrap();
+    reader.set_nonblocking(false).unwrap();
+
+    client.send(get(server.port));
+    let mut buf = [0u8; 16];
+    assert!((&reader).read(&mut buf).unwrap() > 0);
+    assert_eq!(body(&client.recv()), b"hello");
+}
+
+#[test]
+fn chunked_body() {
+    let server = serve_requests(|_| {
+        b"HTTP/1.1 100 Continue\r\n\r\n\
+          HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n\
+          5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\nX-Sum: 1\r\n\r\n"
+            .to_vec()
+    });
+
+    let mut client = Client::new(CFG);
+    for _ in 0..2 {
+        let recv = client.call(get(server.port));
+        assert_eq!(recv.call_result.as_ref().unwrap().code, 200);
+        assert_eq!(body(&recv), b"hello, world");
+    }
+
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 1);
+}
+
+#[test]
+fn large_bodies() {
+    let big = "x".repeat(3 * 1024 * 1024 + 7);
+    let expected = big.clone();
+    let server = serve_requests(move |req| {
+        assert_eq!(req.body.len(), 1024 * 1024);
+        ok(&big)
+    });
+
+    let mut client = Client::new(CFG);
+    let recv = client.call(post(server.port, &vec![1; 1024 * 1024]));
+    assert_eq!(body(&recv), expected.as_bytes());
+}
+
+#[test]
+fn close_delimited_body() {
+    let server = serve(|conn| {
+        let mut writer = conn.try_clone().unwrap();
+        read_request(&mut BufReader::new(conn)).unwrap();
+        writer
+            .write_all(b"HTTP/1.0 200 OK\r\n\r\nuntil the end")
+            .unwrap();
+    });
+
+    let mut client = Client::new(CFG);
+    for _ in 0..2 {
+        let recv = client.call(get(server.port));
+        assert_eq!(body(&recv), b"until the end");
+        assert!(!recv.reused);
+    }
+
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 2);
+}
+
+#[test]
+fn head_has_no_body() {
+    let server = serve_requests(|_| b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n".to_vec());
+
+    let mut client = Client::new(CFG);
+    for _ in 0..2 {
+        let recv = client.call(CallSend {
+            method: "HEAD".to_string(),
+            ..get(server.port)
+        });
+        assert_eq!(body(&recv), b"");
+    }
+
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 1);
+}
+
+#[test]
+fn encoded_bodies_relayed_as_sent() {
+    let server = serve_requests(|req| {
+        if req.header("accept-encoding") != Some("gzip") {
+            return ok("identity");
+        }
+
+        b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: 2\r\n\r\ngz".to_vec()
+    });
+
+    // No encoding is asked for on the caller's behalf
+    let mut client = Client::new(CFG);
+    let recv = client.call(get(server.port));
+    assert_eq!(body(&recv), b"identity");
+
+    // A caller which negotiates the encoding gets it as sent
+    let mut call_send = get(server.port);
+    call_send
+        .headers
+        .push(("Accept-Encoding".to_string(), "gzip".to_string()));
+    let recv = client.call(call_send);
+    assert_eq!(body(&recv), b"gz");
+    assert_eq!(header(&recv, "content-encoding"), Some("gzip"));
+    assert_eq!(header(&recv, "content-length"), Some("2"));
+}
+
+// closes_after_first serves a request on each connection,
+// then reads the next before closing without a response.
+fn closes_after_first(requests: Arc<Mutex<Vec<String>>>) -> Server {
+    serve(move |conn| {
+        let mut writer = conn.try_clone().unwrap();
+        let mut reader = BufReader::new(conn);
+
+        if let Some(req) = read_request(&mut reader) {
+            requests.lock().unwrap().push(req.method);
+            writer.write_all(&ok("first")).unwrap();
+        }
+
+        if let Some(req) = read_request(&mut reader) {
+            requests.lock().unwrap().push(req.method);
+        }
+    })
+}
+
+#[test]
+fn stale_connection_retried() {
+    let requests = Arc::new(Mutex::new(vec![]));
+    let server = closes_after_first(requests.clone());
+
+    let mut client = Client::new(CFG);
+    assert_eq!(body(&client.call(get(server.port))), b"first");
+
+    let recv = client.call(get(server.port));
+    assert_eq!(body(&recv), b"first");
+    assert!(!recv.reused);
+
+    assert_eq!(*requests.lock().unwrap(), ["GET", "GET", "GET"]);
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 2);
+}
+
+#[test]
+fn post_sent_once() {
+    let requests = Arc::new(Mutex::new(vec![]));
+    let server = closes_after_first(requests.clone());
+
+    let mut client = Client::new(CFG);
+    assert_eq!(body(&client.call(post(server.port, b"1"))), b"first");
+
+    // The server may have acted on the POST
+    let recv = client.call(post(server.port, b"2"));
+    assert_eq!(error_kind(&recv), ErrorKind::UnexpectedEof);
+
+    assert_eq!(*requests.lock().unwrap(), ["POST", "POST"]);
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 1);
+}
+
+#[test]
+fn closed_idle_connection_not_reused() {
+    let server = serve(|conn| {
+        let mut writer = conn.try_clone().unwrap();
+        read_request(&mut BufReader::new(conn)).unwrap();
+        writer.write_all(&ok("once")).unwrap();
+    });
+
+    let mut client = Client::new(CFG);
+    assert_eq!(body(&client.call(post(server.port, b""))), b"once");
+
+    // Give the close time to arrive
+    thread::sleep(Duration::from_millis(100));
+    let recv = client.call(post(server.port, b""));
+    assert_eq!(body(&recv), b"once");
+    assert!(!recv.reused);
+}
+
+#[test]
+fn timeout() {
+    let server = serve(|conn| {
+        thread::sleep(Duration::from_secs(2));
+        drop(conn);
+    });
+
+    let mut client = Client::new(CFG);
+    let start = Instant::now();
+    let recv = client.call(CallSend {
+        timeout_ms: 200,
+        ..get(server.port)
+    });
+    assert_eq!(error_kind(&recv), ErrorKind::TimedOut);
+    assert!(start.elapsed() < Duration::from_secs(1));
+}
+
+#[test]
+fn connection_refused() {
+    let port = {
+        let listener = TcpListener::bind("127.0.0.1:0").unwrap();
+        listener.local_addr().unwrap().port()
+    };
+
+    let mut client = Client::new(CFG);
+    let recv = client.call(get(port));
+    assert_eq!(error_kind(&recv), ErrorKind::ConnectionRefused);
+}
+
+#[test]
+fn host_names_resolved() {
+    let server = serve_requests(|_| ok("resolved"));
+
+    let mut client = Client::new(CFG);
+    for _ in 0..2 {
+        let recv = client.call(CallSend {
+            host: "localhost".to_string(),
+            ..get(server.port)
+        });
+        assert_eq!(body(&recv), b"resolved");
+    }
+
+    let recv = client.call(CallSend {
+        host: "no-such-host.invalid".to_string(),
+        ..get(server.port)
+    });
+    assert!(recv.call_result.is_err());
+}
+
+#[test]
+fn max_per_host() {
+    let open = Arc::new(AtomicUsize::new(0));
+    let most = Arc::new(AtomicUsize::new(0));
+
+    let (o, m) = (open.clone(), most.clone());
+    let server = serve(move |conn| {
+        let now = o.fetch_add(1, Ordering::SeqCst) + 1;
+        m.fetch_max(now, Ordering::SeqCst);
+
+        let mut writer = conn.try_clone().unwrap();
+        let mut reader = BufReader::new(conn);
+        while read_request(&mut reader).is_some() {
+            thread::sleep(Duration::from_millis(20));
+            writer.write_all(&ok("slow")).unwrap();
+        }
+        o.fetch_sub(1, Ordering::SeqCst);
+    });
+
+    let mut client = Client::new(Config {
+        max_per_host: 2,
+        ..CFG
+    });
+    let ids: Vec<i32> = (0..6).map(|_| client.send(get(server.port))).collect();
+    for _ in ids.iter() {
+        assert_eq!(body(&client.recv()), b"slow");
+    }
+
+    assert_eq!(most.load(Ordering::SeqCst), 2);
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 2);
+}
+
+#[test]
+fn queued_calls_time_out() {
+    let server = serve(|conn| {
+        thread::sleep(Duration::from_secs(2));
+        drop(conn);
+    });
+
+    let mut client = Client::new(Config {
+        max_per_host: 1,
+        ..CFG
+    });
+    client.send(CallSend {
+        timeout_ms: 1000,
+        ..get(server.port)
+    });
+    let queued = client.send(CallSend {
+        timeout_ms: 100,
+        ..get(server.port)
+    });
+
+    let recv = client.recv();
+    assert_eq!(recv.id, queued);
+    assert_eq!(error_kind(&recv), ErrorKind::TimedOut);
+}
+
+#[test]
+fn streamed_body_follows_head() {
+    // More than the socket buffers hold
+    let big = vec![b'z'; 32 * 1024 * 1024];
+    let body = big.clone();
+    let sent = Arc::new(AtomicUsize::new(0));
+
+    let written = sent.clone();
+    let server = serve(move |conn| {
+        let mut writer = conn.try_clone().unwrap();
+        let mut reader = BufReader::new(conn);
+        while read_request(&mut reader).is_some() {
+            let head = format!("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n", body.len());
+            writer.write_all(head.as_bytes()).unwrap();
+            for chunk in body.chunks(64 * 1024) {
+                writer.write_all(chunk).unwrap();
+                written.fetch_add(chunk.len(), Ordering::SeqCst);
+            }
+        }
+    });
+
+    // A stalled stream doesn't idle out
+    let mut client = Client::new(Config {
+        stream_idle_ms: 100,
+        ..CFG
+    });
+    let recv = client.call(CallSend {
+        stream: true,
+        ..get(server.port)
+    });
+
+    // The loop stops reading while the body isn't taken
+    thread::sleep(Duration::from_millis(300));
+    assert!(sent.load(Ordering::SeqCst) < big.len());
+
+    assert_eq!(read_stream(&recv, Duration::ZERO).unwrap(), big);
+
+    // Once read the connection is reused
+    let recv = client.call(CallSend {
+        stream: true,
+        ..get(server.port)
+    });
+    assert!(recv.reused);
+    assert_eq!(read_stream(&recv, Duration::ZERO).unwrap(), big);
+}
+
+#[test]
+fn streamed_body_idle_timeout() {
+    let server = serve(|conn| {
+        let mut writer = conn.try_clone().unwrap();
+        read_request(&mut BufReader::new(conn)).unwrap();
+        writer
+            .write_all(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n")
+            .unwrap();
+        for _ in 0..10 {
+            thread::sleep(Duration::from_millis(50));
+            writer.write_all(b"drip").unwrap();
+        }
+        thread::sleep(Duration::from_secs(5));
+    });
+
+    let mut client = Client::new(Config {
+        stream_idle_ms: 300,
+        ..CFG
+    });
+    let recv = client.call(CallSend {
+        timeout_ms: 200,
+        stream: true,
+        ..get(server.port)
+    });
+
+    // The body outlives the call's timeout while it keeps
+    // arriving, then fails once it stops.
+    let start = Instant::now();
+    let stream = recv.call_result.as_ref().unwrap().stream.as_ref().unwrap();
+    let mut data = vec![];
+    let err = loop {
+        match stream.next() {
+            Next::Chunk(chunk) => data.extend_from_slice(&chunk),
+            Next::End => panic!("body shouldn't complete"),
+            Next::Failed(e) => break e,
+        }
+    };
+
+    assert_eq!(data, b"drip".repeat(10));
+    assert_eq!(err.err.kind(), ErrorKind::TimedOut);
+    assert!(start.elapsed() < Duration::from_secs(2));
+}
+
+#[test]
+fn streamed_chunked_body() {
+    let server = serve_requests(|_| {
+        let mut resp = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n".to_vec();
+        for n in 0..100 {
+            let chunk = format!("chunk {}|", n);
+            resp.extend_from_slice(format!("{:x}\r\n{}\r\n", chunk.len(), chunk).as_bytes());
+        }
+        resp.extend_from_slice(b"0\r\n\r\n");
+        resp
+    });
+
+    let mut client = Client::new(CFG);
+    let recv = client.call(CallSend {
+        stream: true,
+        ..get(server.port)
+    });
+
+    let expected: String = (0..100).map(|n| format!("chunk {}|", n)).collect();
+    assert_eq!(
+        read_stream(&recv, Duration::ZERO).unwrap(),
+        expected.as_bytes()
+    );
+}
+
+#[test]
+fn abandoned_stream_closes_connection() {
+    let (closed_s, closed_r) = channel();
+    let server = serve(move |conn| {
+        let mut writer = conn.try_clone().unwrap();
+        read_request(&mut BufReader::new(conn)).unwrap();
+
+        writer
+            .write_all(b"HTTP/1.1 200 OK\r\nContent-Length: 1000000000\r\n\r\n")
+            .unwrap();
+        let chunk = vec![0; 64 * 1024];
+        while writer.write_all(&chunk).is_ok() {}
+        closed_s.send(()).unwrap();
+    });
+
+    let mut client = Client::new(CFG);
+    let recv = client.call(CallSend {
+        stream: true,
+        ..get(server.port)
+    });
+
+    // Dropping the response drops its stream
+    drop(recv);
+    closed_r
+        .recv_timeout(Duration::from_secs(5))
+        .expect("connection wasn't closed");
+}
+
+#[test]
+fn streamed_body_fails_if_cut_short() {
+    let server = serve(|conn| {
+        let mut writer = conn.try_clone().unwrap();
+        read_request(&mut BufReader::new(conn)).unwrap();
+        writer
+            .write_all(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nshort")
+            .unwrap();
+    });
+
+    let mut client = Client::new(CFG);
+    let recv = client.call(CallSend {
+        stream: true,
+        ..get(server.port)
+    });
+
+    let err = read_stream(&recv, Duration::ZERO).unwrap_err();
+    assert_eq!(err.kind(), ErrorKind::UnexpectedEof);
+}
+
+// tls_cert makes a self-signed certificate for localhost,
+// which SSL_CERT_FILE has the client trust.
+fn tls_cert() -> &'static (Vec<u8>, Vec<u8>) {
+    use openssl::asn1::Asn1Time;
+    use openssl::hash::MessageDigest;
+    use openssl::pkey::PKey;
+    use openssl::rsa::Rsa;
+    use openssl::x509::extension::SubjectAlternativeName;
+    use openssl::x509::{X509Name, X509};
+
+    static CERT: OnceLock<(Vec<u8>, Vec<u8>)> = OnceLock::new();
+    CERT.get_or_init(|| {
+        let key = PKey::from_rsa(Rsa::generate(2048).unwrap()).unwrap();
+
+        let mut name = X509Name::builder().unwrap();
+        name.append_entry_by_text("CN", "localhost").unwrap();
+        let name = name.build();
+
+        let mut cert = X509::builder().unwrap();
+        cert.set_version(2).unwrap();
+        cert.set_subject_name(&name).unwrap();
+        cert.set_issuer_name(&name).unwrap();
+        cert.set_pubkey(&key).unwrap();
+        cert.set_not_before(&Asn1Time::days_from_now(0).unwrap())
+            .unwrap();
+        cert.set_not_after(&Asn1Time::days_from_now(1).unwrap())
+            .unwrap();
+        let san = SubjectAlternativeName::new()
+            .dns("localhost")
+            .build(&cert.x509v3_context(None, None))
+            .unwrap();
+        cert.append_extension(san).unwrap();
+        cert.sign(&key, MessageDigest::sha256()).unwrap();
+
+        let cert = cert.build().to_pem().unwrap();
+        let path = std::env::temp_dir().join(format!("call_loop_test_{}.pem", std::process::id()));
+        std::fs::write(&path, &cert).unwrap();
+        std::env::set_var("SSL_CERT_FILE", &path);
+
+        (cert, key.private_key_to_pem_pkcs8().unwrap())
+    })
+}
+
+#[test]
+fn tls_reuses_connection() {
+    use openssl::pkey::PKey;
+    use openssl::ssl::{SslAcceptor, SslMethod};
+    use openssl::x509::X509;
+
+    let (cert, key) = tls_cert();
+    let mut acceptor = SslAcceptor::mozilla_intermediate_v5(SslMethod::tls()).unwrap();
+    acceptor
+        .set_certificate(&X509::from_pem(cert).unwrap())
+        .unwrap();
+    acceptor
+        .set_private_key(&PKey::private_key_from_pem(key).unwrap())
+        .unwrap();
+    let acceptor = acceptor.build();
+
+    let big = "s".repeat(1024 * 1024);
+    let expected = big.clone();
+    let server = serve(move |conn| {
+        let tls = match acceptor.accept(conn) {
+            Ok(tls) => tls,
+            Err(_) => return,
+        };
+
+        let tls = Arc::new(Mutex::new(tls));
+        let mut reader = BufReader::new(TlsRead(tls.clone()));
+        while read_request(&mut reader).is_some() {
+            if tls.lock().unwrap().write_all(&ok(&big)).is_err() {
+                return;
+            }
+        }
+    });
+
+    let mut client = Client::new(CFG);
+    let tls_get = || CallSend {
+        host: "localhost".to_string(),
+        use_ssl: true,
+        ..get(server.port)
+    };
+
+    for n in 0..3 {
+        let recv = client.call(tls_get());
+        assert_eq!(body(&recv), expected.as_bytes());
+        assert_eq!(recv.reused, n > 0);
+    }
+
+    let recv = client.call(CallSend {
+        stream: true,
+        ..tls_get()
+    });
+    assert_eq!(
+        read_stream(&recv, Duration::ZERO).unwrap(),
+        expected.as_bytes()
+    );
+    assert_eq!(server.accepted.load(Ordering::SeqCst), 1);
+
+    // A name the certificate isn't for is refused
+    let recv = client.call(CallSend {
+        host: "127.0.0.1".to_string(),
+        ..tls_get()
+    });
+    assert!(recv.call_result.is_err());
+}
+
+struct TlsRead(Arc<Mutex<openssl::ssl::SslStream<TcpStream>>>);
+
+impl Read for TlsRead {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        self.0.lock().unwrap().read(buf)
+    }
+}
+
+#[test]
+fn json_bodies_decoded() {
+    let server = serve_requests(|req| match req.target.as_str() {
+        "/valid" => ok(r#"{"b": [1, 2.5, "x", null], "a": true}"#),
+        "/invalid" => ok(r#"{"a": "#),
+        _ => ok(""),
+    });
+
+    let mut client = Client::new(CFG);
+    let mut call_json = |path: &str| {
+        let recv = client.call(CallSend {
+            path_segms: vec![path.to_string()],
+            params: vec![],
+            decode_json: true,
+            ..get(server.port)
+        });
+        recv.call_result.unwrap().json
+    };
+
+    let value = call_json("valid").unwrap().unwrap();
+    assert_eq!(
+        value,
+        serde_json::json!({"b": [1, 2.5, "x", null], "a": true})
+    );
+
+    // Keys stay in the order they were sent
+    let keys: Vec<&String> = value.as_object().unwrap().keys().collect();
+    assert_eq!(keys, ["b", "a"]);
+
+    assert!(matches!(call_json("invalid"), Some(Err(_))));
+    assert_eq!(call_json("empty"), None);
+
+    let recv = client.call(CallSend {
+        path_segms: vec!["valid".to_string()],
+        ..get(server.port)
+    });
+    assert_eq!(recv.call_result.unwrap().json, None);
+}
@@ -1,21 +1,24 @@
-use std::collections::{HashMap, HashSet};
 use std::ops::Add;
-use std::panic;
-use std::sync::mpsc::{channel, Receiver, Sender};
+use std::os::raw::{c_int, c_void};
+use std::sync::mpsc::channel;
 use std::sync::Arc;
-use std::thread::sleep;
-use std::thread::Builder as ThreadBuilder;
 use std::time;
+use std::time::Instant;
 
-use pyo3::exceptions::{PyOSError, PyRuntimeError, PyTimeoutError};
+use pyo3::class::buffer::PyBufferProtocol;
+use pyo3::class::iter::PyIterProtocol;
+use pyo3::exceptions::{PyBufferError, PyOSError, PyRuntimeError, PyTimeoutError, PyValueError};
+use pyo3::ffi;
 use pyo3::prelude::*;
-use pyo3::types::{PyDict, PyList, PyTuple};
-
-mod call_loop;
+use pyo3::types::{PyBytes, PyDict, PyList, PyTuple};
+use pyo3::AsPyPointer;
 
 #[pyclass]
 struct CallResponse {
     inner: Arc<call_loop::CallRecv>,
+
+    // What get returns, built on the first call
+    value: Option<PyObject>,
 }
 
 #[pymethods]
@@ -33,81 +36,348 @@ impl CallResponse {
             }
         }
 
+        dct.set_item("pool.reused", self.inner.reused)?;
+        dct.set_item("pool.hits", self.inner.pool_hits)?;
+        dct.set_item("pool.misses", self.inner.pool_misses)?;
+
         Ok(dct.into())
     }
 
+    // since_completed is the seconds since the
+    // call loop completed the call
+    #[getter]
+    fn get_since_completed(&self) -> f64 {
+        self.inner.completed.elapsed().as_secs_f64()
+    }
+
     // get returns either a HttpResponse _or_ an exception
-    fn get(&self, py: Python) -> PyResult<PyObject> {
-        match self.inner.call_result {
-            Ok(ref resp) => {
+    fn get(&mut self, py: Python) -> PyResult<PyObject> {
+        if let Some(ref value) = self.value {
+            return Ok(value.clone_ref(py));
+        }
+
+        let value = match self.inner.call_result {
+            Ok(_) => {
                 let resp = HttpResponse {
-                    code: resp.code,
-                    headers: resp.headers.to_owned(),
-                    body: resp.body.to_owned(),
+                    inner: self.inner.clone(),
+                    json: None,
+                    body: None,
                 };
 
-                PyCell::new(py, resp).map(|v| v.to_object(py))
+                PyCell::new(py, resp)?.to_object(py)
             }
-            Err(ref e) => Ok(build_exc(e).to_object(py)),
-        }
+            Err(ref e) => build_exc(e).to_object(py),
+        };
+
+        self.value = Some(value.clone_ref(py));
+        Ok(value)
     }
 }
 
 fn build_exc(e: &call_loop::CallError) -> PyErr {
-    use mio_httpc::Error;
-    let msg = format!("{} - {:?}", e.action, e.err);
-    match e.err {
-        Error::Io(_) => PyOSError::new_err(msg),
-        Error::TimeOut => PyTimeoutError::new_err(msg),
-        _ => PyRuntimeError::new_err(msg),
+    use std::io::ErrorKind;
+    let msg = format!("{} - {}", e.action, e.err);
+    match e.err.kind() {
+        ErrorKind::TimedOut => PyTimeoutError::new_err(msg),
+        ErrorKind::InvalidData => PyRuntimeError::new_err(msg),
+        _ => PyOSError::new_err(msg),
     }
 }
 
+// HttpResponse shares the CallRecv with CallResponse,
+// the body is only copied out of it if asked for.
 #[pyclass]
 struct HttpResponse {
-    code: u16,
-    headers: Vec<(String, String)>,
-    body: Vec<u8>,
+    inner: Arc<call_loop::CallRecv>,
+    // Built from the body on first use
+    json: Option<PyObject>,
+    body: Option<Py<PyBytes>>,
+}
+
+impl HttpResponse {
+    fn resp(&self) -> &call_loop::CallResponse {
+        resp_of(&self.inner)
+    }
+
+    fn find<'a>(&'a self, name: &'a str) -> impl Iterator<Item = &'a str> + 'a {
+        self.resp()
+            .headers
+            .iter()
+            .filter(move |(h, _)| h.eq_ignore_ascii_case(name))
+            .map(|(_, v)| v.as_str())
+    }
+}
+
+fn resp_of(call_recv: &call_loop::CallRecv) -> &call_loop::CallResponse {
+    match call_recv.call_result {
+        Ok(ref resp) => resp,
+        Err(_) => unreachable!("HttpResponse built from a failed call"),
+    }
 }
 
 #[pymethods]
 impl HttpResponse {
     #[getter]
     fn get_code(&self) -> u16 {
-        self.code
+        self.resp().code
     }
 
     #[getter]
     fn get_content_length(&self) -> usize {
-        self.body.len()
+        self.resp().body.len()
+    }
+
+    // streamed is true if the body is read with chunks()
+    #[getter]
+    fn get_streamed(&self) -> bool {
+        self.resp().stream.is_some()
     }
 
+    // headers returns (name, value) tuples in response order
     fn headers(&self, py: Python) -> Py<PyList> {
         PyList::new(
             py,
-            self.headers.iter().map(|(h, v)| PyTuple::new(py, [h, v])),
+            self.resp()
+                .headers
+                .iter()
+                .map(|(h, v)| PyTuple::new(py, [h, v])),
         )
         .into()
     }
 
+    // header returns the first value of the header
+    // name, which is matched case-insensitively.
+    #[args(default = "None")]
+    fn header(&self, py: Python, name: &str, default: Option<PyObject>) -> PyObject {
+        match self.find(name).next() {
+            Some(v) => v.to_object(py),
+            None => default.unwrap_or_else(|| py.None()),
+        }
+    }
+
+    // header_values returns every value of the header name
+    fn header_values(&self, name: &str) -> Vec<String> {
+        self.find(name).map(str::to_string).collect()
+    }
+
+    // chunks iterates over the body as it arrives, for a
+    // streaming call. Otherwise it gives the whole body.
+    fn chunks(&self) -> BodyChunks {
+        BodyChunks {
+            inner: self.inner.clone(),
+            done: false,
+        }
+    }
+
+    // body is the response body as bytes,
+    // copied out of the CallRecv once.
     #[getter]
-    fn get_body(&self) -> &[u8] {
-        &self.body
+    fn get_body(&mut self, py: Python) -> Py<PyBytes> {
+        let inner = &self.inner;
+        self.body
+            .get_or_insert_with(|| PyBytes::new(py, &resp_of(inner).body).into())
+            .clone_ref(py)
+    }
+
+    // body_view returns a read-only memoryview
+    // over the body, without copying it.
+    fn body_view(&self, py: Python) -> PyResult<PyObject> {
+        let view = PyCell::new(
+            py,
+            BodyView {
+                inner: self.inner.clone(),
+            },
+        )?;
+
+        unsafe { PyObject::from_owned_ptr_or_err(py, ffi::PyMemoryView_FromObject(view.as_ptr())) }
+    }
+
+    // json is the decoded body, None unless decode_json was
+    // set and the body is non-empty. The call_loop decoded
+    // it, it's converted to Python on first use and kept.
+    #[getter]
+    fn get_json(&mut self, py: Python) -> PyResult<Option<PyObject>> {
+        self.check_json()?;
+        if let Some(ref json) = self.json {
+            return Ok(Some(json.clone_ref(py)));
+        }
+
+        let json = match self.resp().json {
+            Some(Ok(ref value)) => json_to_py(py, value)?,
+            _ => return Ok(None),
+        };
+
+        self.json = Some(json.clone_ref(py));
+        Ok(Some(json))
+    }
+
+    // check_json raises ValueError if decode_json was
+    // set and the body isn't valid JSON.
+    fn check_json(&self) -> PyResult<()> {
+        match self.resp().json {
+            Some(Err(ref e)) => Err(PyValueError::new_err(format!("invalid json body - {}", e))),
+            _ => Ok(()),
+        }
     }
 }
 
+// json_to_py builds the Python objects json.loads would
+fn json_to_py(py: Python, value: &serde_json::Value) -> PyResult<PyObject> {
+    use serde_json::Value;
+
+    Ok(match value {
+        Value::Null => py.None(),
+        Value::Bool(b) => b.to_object(py),
+        Value::Number(n) => {
+            if let Some(i) = n.as_i64() {
+                i.to_object(py)
+            } else if let Some(u) = n.as_u64() {
+                u.to_object(py)
+            } else {
+                n.as_f64().unwrap_or(f64::NAN).to_object(py)
+            }
+        }
+        Value::String(s) => s.to_object(py),
+        Value::Array(items) => {
+            let list = PyList::empty(py);
+            for item in items.iter() {
+                list.append(json_to_py(py, item)?)?;
+            }
+            list.to_object(py)
+        }
+        Value::Object(fields) => {
+            let dct = PyDict::new(py);
+            for (k, v) in fields.iter() {
+                dct.set_item(k, json_to_py(py, v)?)?;
+            }
+            dct.to_object(py)
+        }
+    })
+}
+
+// BodyView exports a response body through the buffer
+// protocol, for HttpResponse.body_view.
 #[pyclass]
-struct InnerCaller {
-    inq: Sender<call_loop::CallSend>,
-    outq: Receiver<call_loop::CallRecv>,
+struct BodyView {
+    inner: Arc<call_loop::CallRecv>,
+}
 
-    pending_reqs: HashSet<i32>,
-    completed_reqs: HashMap<i32, Arc<call_loop::CallRecv>>,
-    id: i32,
+#[pyproto]
+impl PyBufferProtocol for BodyView {
+    fn bf_getbuffer(slf: PyRefMut<Self>, view: *mut ffi::Py_buffer, flags: c_int) -> PyResult<()> {
+        if view.is_null() {
+            return Err(PyBufferError::new_err("view is null"));
+        }
+
+        // The CallRecv is immutable, and the view keeps
+        // a reference to slf, which keeps it alive.
+        let body = &resp_of(&slf.inner).body;
+        let r = unsafe {
+            ffi::PyBuffer_FillInfo(
+                view,
+                slf.as_ptr(),
+                body.as_ptr() as *mut c_void,
+                body.len() as ffi::Py_ssize_t,
+                1,
+                flags,
+            )
+        };
+
+        // PyBuffer_FillInfo has set the exception,
+        // e.g. if a writable buffer was asked for.
+        if r == -1 {
+            return Err(PyErr::fetch(slf.py()));
+        }
 
-    // trace params
-    trace: Option<(String, String)>,
-    client: Option<String>,
+        Ok(())
+    }
+
+    fn bf_releasebuffer(_slf: PyRefMut<Self>, _view: *mut ffi::Py_buffer) {}
+}
+
+// BodyChunks yields the body of a response as bytes. Waiting
+// on the next chunk releases the GIL. Closing it, or dropping
+// it, abandons the rest of a streamed body.
+#[pyclass]
+struct BodyChunks {
+    inner: Arc<call_loop::CallRecv>,
+    done: bool,
+}
+
+impl BodyChunks {
+    fn stream(&self) -> Option<&call_loop::StreamReader> {
+        match self.inner.call_result {
+            Ok(ref resp) => resp.stream.as_ref(),
+            Err(_) => None,
+        }
+    }
+}
+
+#[pymethods]
+impl BodyChunks {
+    fn close(&mut self) {
+        self.done = true;
+        if let Some(stream) = self.stream() {
+            stream.close();
+        }
+    }
+}
+
+impl Drop for BodyChunks {
+    fn drop(&mut self) {
+        self.close();
+    }
+}
+
+#[pyproto]
+impl PyIterProtocol for BodyChunks {
+    fn __iter__(slf: PyRef<Self>) -> PyRef<Self> {
+        slf
+    }
+
+    fn __next__(mut slf: PyRefMut<Self>) -> PyResult<Option<PyObject>> {
+        use call_loop::Next;
+
+        if slf.done {
+            return Ok(None);
+        }
+
+        let py = slf.py();
+        if slf.stream().is_none() {
+            slf.done = true;
+            return Ok(match slf.inner.call_result {
+                Ok(ref resp) if !resp.body.is_empty() => {
+                    Some(PyBytes::new(py, &resp.body).to_object(py))
+                }
+                _ => None,
+            });
+        }
+
+        let inner = slf.inner.clone();
+        let next = py.allow_threads(move || match inner.call_result {
+            Ok(ref resp) => resp.stream.as_ref().expect("expected a stream").next(),
+            Err(_) => Next::End,
+        });
+
+        match next {
+            Next::Chunk(chunk) => Ok(Some(PyBytes::new(py, &chunk).to_object(py))),
+            Next::End => {
+                slf.done = true;
+                Ok(None)
+            }
+            Next::Failed(e) => {
+                slf.done = true;
+                Err(build_exc(&e))
+            }
+        }
+    }
+}
+
+#[pyclass]
+struct InnerCaller {
+    call_loop: call_loop::CallLoop,
+    shared: Arc<call_loop::Shared>,
+    notify: Arc<call_loop::Notify>,
 }
 
 #[derive(serde::Serialize)]
@@ -121,49 +391,54 @@ struct LogErrorMessage<'s> {
 #[pymethods]
 impl InnerCaller {
     #[new]
-    fn new(service_name: String) -> Self {
-        let (inq_s, inq_r) = channel();
+    #[args(
+        max_idle_per_host = "8",
+        idle_timeout_ms = "4000",
+        max_per_host = "32",
+        stream_idle_ms = "30000"
+    )]
+    fn new(
+        service_name: String,
+        max_idle_per_host: usize,
+        idle_timeout_ms: u64,
+        max_per_host: usize,
+        stream_idle_ms: u64,
+    ) -> PyResult<Self> {
         let (outq_s, outq_r) = channel();
-
-        ThreadBuilder::new()
-            .name("call_loop".to_string())
-            .spawn(move || loop {
-                if let Err(e) = call_loop::run_forever(&inq_r, &outq_s) {
-                    // Log the error to stdout in JSON
-                    let msg = LogErrorMessage {
-                        service: &service_name,
-                        msg: "call_loop exited",
-                        level: "ERROR",
-                        error: format!("{:?}", e),
-                    };
-
-                    match serde_json::to_string(&msg) {
-                        Ok(s) => println!("{}", s),
-                        Err(e) => eprintln!("couldn't log error - {:?}", e),
-                    }
-
-                    // restart the loop
-                    sleep(time::Duration::from_secs(1));
-                    continue;
-                }
-
-                break;
-            })
-            .expect("couldn't spawn call_loop thread");
-
-        Self {
-            pending_reqs: HashSet::new(),
-            completed_reqs: HashMap::new(),
-            id: 0,
-            inq: inq_s,
-            outq: outq_r,
-            trace: None,
-            client: None,
-        }
+        let cfg = call_loop::Config {
+            max_idle_per_host,
+            idle_timeout_ms,
+            max_per_host: max_per_host.max(1),
+            stream_idle_ms,
+        };
+
+        let notify = Arc::new(call_loop::Notify::default());
+        let call_loop = call_loop::CallLoop::spawn(cfg, outq_s, notify.clone(), move |e| {
+            // Log the error to stdout in JSON
+            let msg = LogErrorMessage {
+                service: &service_name,
+                msg: "call_loop exited",
+                level: "ERROR",
+                error: format!("{:?}", e),
+            };
+
+            match serde_json::to_string(&msg) {
+                Ok(s) => println!("{}", s),
+                Err(e) => eprintln!("couldn't log error - {:?}", e),
+            }
+        })
+        .map_err(|e| PyRuntimeError::new_err(format!("couldn't spawn call_loop - {}", e)))?;
+
+        Ok(Self {
+            call_loop,
+            shared: Arc::new(call_loop::Shared::new(outq_r, notify.clone())),
+            notify,
+        })
     }
 
+    #[args(decode_json = "false", stream = "false")]
     fn call(
-        &mut self,
+        &self,
         method: String,
         host: String,
         port: u16,
@@ -174,31 +449,32 @@ impl InnerCaller {
         mut headers: Vec<(String, String)>,
         body: Vec<u8>,
         timeout_ms: u64,
+        trace: Option<(String, String, String)>,
+        decode_json: bool,
+        stream: bool,
     ) -> PyResult<i32> {
-        if let Some((ref trace_id, ref parent_id)) = self.trace {
+        if let Some((trace_id, parent_id, flags)) = trace {
             headers.push((
                 "Traceparent".to_string(),
-                format!("00-{}-{}-00", trace_id, parent_id),
+                format!("00-{}-{}-{}", trace_id, parent_id, flags),
             ));
         }
 
-        if let Some(ref client) = self.client {
-            headers.push(("X-Client".to_string(), client.to_owned()));
-        }
-
-        // X-Timeout header
+        // X-Timeout header - absolute unix time in seconds,
+        // with millisecond precision.
         let x_timeout = time::SystemTime::now()
             .add(time::Duration::from_millis(timeout_ms))
             .duration_since(time::UNIX_EPOCH)
-            .expect("couldn't compute system time")
-            .as_secs();
+            .expect("couldn't compute system time");
 
-        headers.push(("X-Timeout".to_string(), format!("{}", x_timeout)));
+        headers.push((
+            "X-Timeout".to_string(),
+            format!("{}.{:03}", x_timeout.as_secs(), x_timeout.subsec_millis()),
+        ));
 
-        let id = self.get_id();
-        self.pending_reqs.insert(id);
+        let id = self.shared.next_id().map_err(PyRuntimeError::new_err)?;
 
-        self.inq
+        self.call_loop
             .send(call_loop::CallSend {
                 id,
                 timeout_ms,
@@ -210,88 +486,73 @@ impl InnerCaller {
                 params,
                 headers,
                 body,
+                decode_json,
+                stream,
             })
-            .map_err(|e| PyRuntimeError::new_err(format!("couldn't send request - {:?}", e)))?;
+            .map_err(|e| PyRuntimeError::new_err(format!("couldn't send request - {}", e)))?;
         Ok(id)
     }
 
-    fn clear(&mut self) {
-        self.pending_reqs.clear();
-        self.completed_reqs.clear();
+    // notify_fd returns a new socket, readable whenever calls
+    // have completed. The caller owns it, an event loop
+    // watches it rather than polling.
+    fn notify_fd(&self) -> PyResult<i32> {
+        self.notify
+            .reader()
+            .map_err(|e| PyOSError::new_err(format!("couldn't make notify socket - {}", e)))
     }
 
-    fn set_trace(&mut self, trace_id: &str, parent_id: &str) {
-        self.trace = Some((trace_id.to_string(), parent_id.to_string()))
+    // take_ready returns the ids completed since the notify
+    // socket fd last took them. None means the event loop
+    // has to poll all of its calls.
+    fn take_ready(&self, fd: i32) -> PyResult<Option<Vec<i32>>> {
+        self.shared.take_ready(fd).map_err(PyRuntimeError::new_err)
     }
 
-    fn set_client(&mut self, client: &str) {
-        self.client = Some(client.to_string())
+    // forget drops the given ids, any response
+    // which arrives for them later is discarded.
+    fn forget(&self, ids: Vec<i32>) -> PyResult<()> {
+        self.shared.forget(&ids).map_err(PyRuntimeError::new_err)
     }
 
-    fn poll_ready(&mut self, id: i32) -> PyResult<Option<CallResponse>> {
-        self.tick()?;
+    fn poll_ready(&self, id: i32) -> PyResult<Option<CallResponse>> {
+        let call_recv = self
+            .shared
+            .poll_ready(id)
+            .map_err(PyRuntimeError::new_err)?;
 
-        Ok(self.completed_reqs.get(&id).map(|call_recv| CallResponse {
-            inner: call_recv.clone(),
-        }))
+        Ok(call_recv.map(|inner| CallResponse { inner, value: None }))
     }
 
-    fn block_on_ids(&mut self, ids: Vec<i32>) -> PyResult<i32> {
-        for id in ids.iter() {
-            if self.pending_reqs.get(id).is_none() {
-                // Invalid ID
-                panic!("id is invalid");
-            }
-        }
-
-        for &i in ids.iter() {
-            if let Some(_) = self.poll_ready(i)? {
-                return Ok(i);
-            }
+    // block_on_ids waits, without the GIL, for any of ids to
+    // complete and returns it. None is returned if timeout_ms
+    // elapses first.
+    #[args(timeout_ms = "None")]
+    fn block_on_ids(
+        &self,
+        py: Python,
+        ids: Vec<i32>,
+        timeout_ms: Option<u64>,
+    ) -> PyResult<Option<i32>> {
+        if ids.is_empty() {
+            return Err(PyValueError::new_err("no ids to wait on"));
         }
 
-        // Block, waiting for an id to become ready
-        loop {
-            match self.outq.recv() {
-                Ok(r) => {
-                    let id = r.id;
-                    self.add_call_recv(r)?;
-                    if ids.contains(&id) {
-                        break Ok(id);
-                    }
-                }
-                Err(e) => {
-                    println!("couldn't recv on outq {:?}", e);
-                    panic!("recv q crashed");
-                }
-            }
-        }
-    }
-}
-
-impl InnerCaller {
-    fn tick(&mut self) -> PyResult<()> {
-        // Do we have anything on the outq?
-        loop {
-            match self.outq.try_recv() {
-                Ok(r) => self.add_call_recv(r)?,
-                Err(_) => break,
+        for id in ids.iter() {
+            if !self
+                .shared
+                .is_pending(*id)
+                .map_err(PyRuntimeError::new_err)?
+            {
+                return Err(PyValueError::new_err(format!("id {} is invalid", id)));
             }
         }
-        Ok(())
-    }
 
-    fn add_call_recv(&mut self, r: call_loop::CallRecv) -> PyResult<()> {
-        if let Some(&id) = self.pending_reqs.get(&r.id) {
-            self.completed_reqs.insert(id, Arc::new(r));
-        }
-
-        Ok(())
-    }
+        let deadline = timeout_ms.map(|t| Instant::now() + time::Duration::from_millis(t));
+        let shared = self.shared.clone();
 
-    fn get_id(&mut self) -> i32 {
-        self.id += 1;
-        return self.id;
+        py.allow_threads(move || shared.wait_any(&ids, deadline))
+            .map_err(PyRuntimeError::new_err)
     }
 }
 
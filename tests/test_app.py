@@ -0,0 +1,380 @@
+import json
+import pstats
+from io import BytesIO
+from time import sleep, time
+
+import pytest
+
+from wsgidragon import DragonApp, StatusCode, base, caller, routes
+from wsgidragon.api import Api
+from wsgidragon.paramschema import ParamError
+from wsgidragon.pathsegment import Int
+from wsgidragon.profiling import PROFILER
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(routes, "ROUTES", [])
+    monkeypatch.setattr(routes, "ROUTE_INDEX", routes.RouteIndex())
+    return DragonApp("svc")
+
+
+def start(app, method, path, query="", headers=None, body=b"", chunked=False, file_wrapper=None):
+    """
+    start runs a WSGI request through app and returns its
+    status, headers and the unread payload. A chunked body
+    has no length.
+    """
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": None,
+    }
+
+    if body and not chunked:
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+    for (key, value) in (headers or {}).items():
+        key = key.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+
+        environ[key] = value
+
+    if file_wrapper:
+        environ["wsgi.file_wrapper"] = file_wrapper
+
+    started = []
+    payload = app(environ, lambda status, headers: started.append((status, headers)))
+    (status, resp_headers) = started[0]
+    return status, dict(resp_headers), payload
+
+
+def request(app, *args, **kwargs):
+    """
+    request returns the status, headers and body
+    of a WSGI request, see start.
+    """
+    (status, headers, payload) = start(app, *args, **kwargs)
+    try:
+        resp_body = b"".join(payload)
+    finally:
+        if hasattr(payload, "close"):
+            payload.close()
+
+    return status, headers, resp_body
+
+
+def hello(req, resp_head):
+    return b"hello"
+
+
+def test_route(app):
+    app.add(hello, methods=["GET"], path=("hello",))
+
+    (status, headers, body) = request(app, "GET", "/hello")
+    assert status == "200 Ok"
+    assert headers["Content-Length"] == "5"
+    assert body == b"hello"
+
+    (status, _, _) = request(app, "GET", "/nope")
+    assert status == "404 Not Found"
+
+
+class StrictParams(Api):
+    def build_params(self, raw_query):
+        raise ParamError("no params allowed")
+
+
+def test_headers(app):
+    def echo_header(req, resp_head):
+        return req.headers.get("X-Thing", "missing").encode()
+
+    app.add(echo_header, methods=["GET"], path=("header",))
+
+    assert request(app, "GET", "/header", headers={"x-thing": "1"})[2] == b"1"
+    assert request(app, "GET", "/header")[2] == b"missing"
+
+
+def test_metrics_opt_in(app):
+    # Not served unless WSGI_DRAGON_METRICS_DIR is set
+    (status, _, _) = request(app, "GET", "/metrics")
+    assert status == "404 Not Found"
+
+
+def test_bad_params(app):
+    app.add(hello, methods=["GET"], path=("hello",), api=StrictParams)
+
+    (status, headers, _) = request(app, "GET", "/hello", query="x=1")
+    assert status == "400 Bad Request"
+    assert headers["Error"] == "invalid params - no params allowed"
+
+
+class PathSchema(Api):
+    def schema(self, path):
+        return {"user": path[1]}
+
+
+def test_options_etag(app):
+    app.add(hello, methods=["GET"], path=("users", Int()), api=PathSchema)
+
+    (status, headers, body) = request(app, "OPTIONS", "/users/1")
+    assert status == "200 Ok"
+    assert headers["Content-Type"] == "application/json"
+    assert json.loads(body) == {"user": 1}
+    etag = headers["ETag"]
+
+    # The schema is built for each path
+    (_, other, body) = request(app, "OPTIONS", "/users/2")
+    assert json.loads(body) == {"user": 2}
+    assert other["ETag"] != etag
+
+    for if_none_match in (etag, "W/" + etag, f'"x", {etag}', "*"):
+        (status, headers, body) = request(app, "OPTIONS", "/users/1", headers={
+            "If-None-Match": if_none_match,
+        })
+        assert status == "304 Not Modified"
+        assert headers["ETag"] == etag
+        assert "Content-Length" not in headers
+        assert body == b""
+
+    (status, _, _) = request(app, "OPTIONS", "/users/1", headers={"If-None-Match": '"x"'})
+    assert status == "200 Ok"
+
+
+class HangingCaller:
+    """
+    HangingCaller places calls which never complete.
+    """
+    def call(self, *args):
+        return 1
+
+    def poll_ready(self, ref):
+        return None
+
+    def block_on_ids(self, ids, timeout_ms=None):
+        sleep(timeout_ms / 1000)
+
+    def forget(self, ids):
+        pass
+
+
+def test_route_timeout(app, monkeypatch):
+    monkeypatch.setattr(base, "INNER_CALLER", HangingCaller())
+
+    def waits(req, resp_head):
+        return caller.call("GET", "example.com").wait()
+
+    def sleeps(req, resp_head):
+        sleep(0.3)
+        return b"late"
+
+    app.add(waits, methods=["GET"], path=("waits",), timeout=0.1)
+    app.add(sleeps, methods=["GET"], path=("sleeps",), timeout=0.1)
+
+    # A wait on the caller ends at the deadline
+    start = time()
+    (status, headers, body) = request(app, "GET", "/waits")
+    assert status == "504 Gateway Timeout"
+    assert headers["Error"] == "application timeout"
+    assert time() - start < 0.25
+
+    # Anything else runs on, then its response is replaced
+    start = time()
+    (status, _, body) = request(app, "GET", "/sleeps")
+    assert status == "504 Gateway Timeout"
+    assert body == b""
+    assert time() - start >= 0.3
+
+
+def echo(req, resp_head):
+    return req.body
+
+
+def test_body_limit(app):
+    app.add(echo, methods=["POST"], path=("small",), max_body_size=4)
+    app.add(echo, methods=["POST"], path=("echo",))
+
+    (status, _, body) = request(app, "POST", "/small", body=b"1234")
+    assert status == "200 Ok"
+    assert body == b"1234"
+
+    # Rejected on its Content-Length, or once it's read past the limit
+    for chunked in (False, True):
+        (status, headers, _) = request(app, "POST", "/small", body=b"12345", chunked=chunked)
+        assert status == "413 Payload Too Large"
+        assert "exceeds 4 bytes" in headers["Error"]
+
+    (status, _, body) = request(app, "POST", "/echo", body=b"12345", chunked=True)
+    assert status == "200 Ok"
+    assert body == b"12345"
+
+
+def test_pool_config(monkeypatch):
+    made = []
+    monkeypatch.setattr(base, "InnerCaller", lambda *args: made.append(args))
+    monkeypatch.setattr(base, "INNER_LOGGER", None)
+    monkeypatch.setattr(base, "INNER_CALLER", None)
+
+    # A bad value only falls back for its own setting
+    monkeypatch.setattr(base, "environ", {
+        **dict(base.environ.items()),
+        "WSGI_DRAGON_POOL_MAX_IDLE": "lots",
+        "WSGI_DRAGON_POOL_MAX_PER_HOST": "64",
+    })
+    base.init_application("svc")
+    assert made == [("svc", 8, 4000, 64, 30000)]
+
+
+def logged(capsys, msg):
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return [line for line in lines if line["msg"] == msg]
+
+
+def test_streamed_body(app, capsys):
+    def chunks():
+        for chunk in (b"ab", b"cd"):
+            # Still logs as part of the request
+            base.logger.info("chunk")
+            yield chunk
+
+    def streams(req, resp_head):
+        return chunks()
+
+    app.add(streams, methods=["GET"], path=("streams",))
+    (status, headers, payload) = start(app, "GET", "/streams")
+    assert status == "200 Ok"
+    assert "Content-Length" not in headers
+
+    assert next(payload) == b"ab"
+    assert next(payload) == b"cd"
+    assert [line["trace_id"] for line in logged(capsys, "chunk")] == [headers["X-TraceId"]] * 2
+
+    # The request is logged once its body is closed
+    assert list(payload) == []
+    assert logged(capsys, "request complete") == []
+    payload.close()
+
+    [line] = logged(capsys, "request complete")
+    assert line["trace_id"] == headers["X-TraceId"]
+    assert "timing.stream_ms" in line
+
+
+def test_file_body(app, monkeypatch):
+    monkeypatch.setattr(base, "FILE_BLOCK_SIZE", 4)
+    files = []
+
+    def sends_file(req, resp_head):
+        f = BytesIO(b"0123456789")
+        files.append(f)
+        return f
+
+    app.add(sends_file, methods=["GET"], path=("file",))
+
+    # Read in blocks and closed once sent
+    (_, _, payload) = start(app, "GET", "/file")
+    assert list(payload) == [b"0123", b"4567", b"89"]
+    payload.close()
+    assert files[0].closed
+
+    # Or handed to the server's file_wrapper
+    wrapped = []
+    (_, _, payload) = start(app, "GET", "/file", file_wrapper=lambda f, size: wrapped.append((f, size)) or [f.read()])
+    assert wrapped == [(files[1], 4)]
+    assert payload == [b"0123456789"]
+
+
+class StreamedResponse:
+    """
+    StreamedResponse is the HttpResponse of a stream=True call
+    """
+    code = 200
+    streamed = True
+
+    def headers(self):
+        return [("Content-Type", "text/plain"), ("Content-Length", "4"), ("Connection", "close")]
+
+    def chunks(self):
+        return iter([b"ab", b"cd"])
+
+
+def test_proxy_streams(app):
+    def gateway(req, resp_head):
+        return caller.proxy(StreamedResponse(), resp_head)
+
+    app.add(gateway, methods=["GET"], path=("gateway",))
+
+    (status, headers, payload) = start(app, "GET", "/gateway")
+    assert status == "200 OK"
+    assert headers["Content-Length"] == "4"
+    assert "Connection" not in headers
+    assert list(payload) == [b"ab", b"cd"]
+    payload.close()
+
+
+def test_server_timing(app, monkeypatch, capsys):
+    def queries(req, resp_head):
+        with base.timed("db"):
+            sleep(0.02)
+
+        return b"done"
+
+    app.add(queries, methods=["GET"], path=("queries",))
+
+    # Off by default, the timings are only logged
+    (_, headers, _) = request(app, "GET", "/queries")
+    assert "Server-Timing" not in headers
+
+    [line] = logged(capsys, "request complete")
+    assert line["timing.db_ms"] >= 20
+    assert line["timing.handler_ms"] >= line["timing.db_ms"]
+    assert line["timing.total_ms"] >= line["timing.handler_ms"]
+
+    monkeypatch.setattr(base, "SERVER_TIMING", True)
+    (_, headers, _) = request(app, "GET", "/queries")
+
+    timings = {}
+    for metric in headers["Server-Timing"].split(", "):
+        (name, dur) = metric.split(";dur=")
+        timings[name] = float(dur)
+
+    assert {"params", "body", "db", "handler", "total"} <= set(timings)
+    assert timings["db"] >= 20
+    assert timings["total"] >= timings["handler"] >= timings["db"]
+
+
+def profiled_functions(path):
+    return {func for (_, _, func) in pstats.Stats(str(path)).stats}
+
+
+def test_profiling(app, monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(PROFILER, "directory", str(tmp_path))
+
+    def work():
+        return b"worked"
+
+    def profiled(req, resp_head):
+        return work()
+
+    app.add(profiled, methods=["GET"], path=("profiled",))
+
+    request(app, "GET", "/profiled")
+    assert list(tmp_path.iterdir()) == []
+    assert "profile" not in logged(capsys, "request complete")[0]
+
+    # Asked for by the request
+    (_, headers, body) = request(app, "GET", "/profiled", headers={"X-Profile": "1"})
+    assert body == b"worked"
+
+    path = tmp_path / f"{headers['X-TraceId']}.prof"
+    assert "work" in profiled_functions(path)
+    assert [line["profile"] for line in logged(capsys, "request complete")] == [str(path)]
+
+    # Or sampled
+    monkeypatch.setattr(PROFILER, "rate", 1.0)
+    (_, headers, _) = request(app, "GET", "/profiled")
+    assert (tmp_path / f"{headers['X-TraceId']}.prof").exists()
@@ -0,0 +1,222 @@
+import asyncio
+import pstats
+import socket
+from time import time
+
+import pytest
+
+from wsgidragon import DragonApp, base, caller, routes
+from wsgidragon.pathsegment import Int
+from wsgidragon.profiling import PROFILER
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(routes, "ROUTES", [])
+    monkeypatch.setattr(routes, "ROUTE_INDEX", routes.RouteIndex())
+    return DragonApp("svc")
+
+
+def request(app, method, path, headers=None, body=b"", chunks=None):
+    """
+    request runs an ASGI request through app.asgi and returns
+    its status, headers and body. chunks sends the body in
+    parts, without a Content-Length.
+    """
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "server": ("localhost", 80),
+        "headers": [
+            (k.lower().encode(), v.encode()) for (k, v) in (headers or {}).items()
+        ],
+    }
+
+    if chunks is None:
+        chunks = [body]
+        if body:
+            scope["headers"].append((b"content-length", str(len(body)).encode()))
+
+    received = [
+        {"type": "http.request", "body": c, "more_body": n < len(chunks) - 1}
+        for (n, c) in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        if received:
+            return received.pop(0)
+
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.asgi(scope, receive, send))
+
+    assert sent[0]["type"] == "http.response.start"
+    resp_headers = {k.decode(): v.decode() for (k, v) in sent[0]["headers"]}
+    resp_body = b"".join(m.get("body", b"") for m in sent[1:])
+    assert not sent[-1].get("more_body")
+
+    return sent[0]["status"], resp_headers, resp_body
+
+
+async def echo(req, resp_head):
+    return req.body
+
+
+def test_body_limit(app, monkeypatch):
+    app.add(echo, methods=["POST"], path=("small",), max_body_size=4)
+    app.add(echo, methods=["POST"], path=("echo",))
+
+    (status, _, body) = request(app, "POST", "/small", body=b"1234")
+    assert status == 200
+    assert body == b"1234"
+
+    (status, headers, _) = request(app, "POST", "/small", body=b"12345")
+    assert status == 413
+    assert headers["Error"] == "content length exceeds 4 bytes"
+
+    (status, headers, _) = request(app, "POST", "/small", chunks=[b"123", b"45"])
+    assert status == 413
+    assert headers["Error"] == "body exceeds 4 bytes"
+
+    (status, _, body) = request(app, "POST", "/echo", chunks=[b"123", b"45"])
+    assert status == 200
+    assert body == b"12345"
+
+    # The route is looked up once, for the limit and routing
+    lookups = []
+    lookup = routes.ROUTE_INDEX.lookup
+    monkeypatch.setattr(routes.ROUTE_INDEX, "lookup", lambda parts: lookups.append(parts) or lookup(parts))
+
+    request(app, "POST", "/echo", body=b"1")
+    assert lookups == [["echo"]]
+
+
+async def hello(req, resp_head):
+    return b"hello " + str(req.path[-1]).encode()
+
+
+def test_route(app):
+    app.add(hello, methods=["GET"], path=("hello", Int()))
+
+    (status, headers, body) = request(app, "GET", "/hello/7")
+    assert status == 200
+    assert body == b"hello 7"
+    assert headers["X-TraceId"]
+
+    (status, _, _) = request(app, "GET", "/hello/seven")
+    assert status == 404
+
+    (status, _, _) = request(app, "POST", "/hello/7")
+    assert status == 404
+
+
+class HangingCaller:
+    """
+    HangingCaller places calls which never complete.
+    """
+    def __init__(self):
+        self._writers = []
+
+    def call(self, *args):
+        return 1
+
+    def notify_fd(self):
+        (reader, writer) = socket.socketpair()
+        self._writers.append(writer)
+        return reader.detach()
+
+    def take_ready(self, fd):
+        return []
+
+    def poll_ready(self, ref):
+        return None
+
+    def forget(self, ids):
+        pass
+
+
+def test_timeout_cancels(app, monkeypatch):
+    monkeypatch.setattr(base, "INNER_CALLER", HangingCaller())
+    cancelled = []
+
+    async def waits(req, resp_head):
+        try:
+            return await caller.call("GET", "example.com")
+        except asyncio.CancelledError:
+            cancelled.append(req.path)
+            raise
+
+    app.add(waits, methods=["GET"], path=("waits",), timeout=0.1)
+
+    # The handler is cancelled where it awaits, at the deadline
+    start = time()
+    (status, headers, body) = request(app, "GET", "/waits")
+    assert status == 504
+    assert headers["Error"] == "application timeout"
+    assert body == b""
+    assert time() - start < 0.25
+    assert cancelled == [("waits",)]
+
+    # The request's own deadline applies too
+    (status, _, _) = request(app, "GET", "/waits", headers={"X-Timeout": str(time() + 0.05)})
+    assert status == 504
+    assert len(cancelled) == 2
+
+
+def test_streaming(app):
+    closed = []
+
+    def chunks():
+        try:
+            yield b"a"
+            yield b"b"
+            yield b"c"
+        finally:
+            closed.append(True)
+
+    async def streams(req, resp_head):
+        return chunks()
+
+    app.add(streams, methods=["GET"], path=("streams",))
+
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/streams", "headers": []}
+    asyncio.run(app.asgi(scope, receive, send))
+
+    # Each chunk is sent as it's produced
+    assert sent[0]["status"] == 200
+    assert [m["body"] for m in sent[1:]] == [b"a", b"b", b"c", b""]
+    assert [m.get("more_body", False) for m in sent[1:]] == [True, True, True, False]
+    assert closed == [True]
+
+
+def test_profiling(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(PROFILER, "directory", str(tmp_path))
+
+    def work():
+        return b"worked"
+
+    # Run off the event loop, and still profiled
+    def sync_handler(req, resp_head):
+        return work()
+
+    app.add(sync_handler, methods=["GET"], path=("sync",))
+
+    (_, headers, body) = request(app, "GET", "/sync", headers={"X-Profile": "1"})
+    assert body == b"worked"
+
+    stats = pstats.Stats(str(tmp_path / f"{headers['X-TraceId']}.prof")).stats
+    assert "work" in {func for (_, _, func) in stats}
@@ -0,0 +1,57 @@
+from time import perf_counter
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+import pytest
+
+from benchmarks import bench_caller
+from benchmarks.upstream import Upstream
+from wsgidragon import base
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    with Upstream() as upstream:
+        yield upstream
+
+
+def get(upstream, query):
+    with urlopen(f"http://{upstream.host}:{upstream.port}/?{query}", timeout=5) as resp:
+        return resp.status, resp.read()
+
+
+def test_upstream(upstream):
+    assert get(upstream, "size=10") == (200, b"x" * 10)
+
+    start = perf_counter()
+    assert get(upstream, "latency_ms=50") == (200, b"")
+    assert perf_counter() - start >= 0.05
+
+    with pytest.raises(HTTPError) as exc:
+        get(upstream, "status=404")
+    assert exc.value.code == 404
+
+    with pytest.raises(HTTPError) as exc:
+        get(upstream, "fail=1&failure=500")
+    assert exc.value.code == 500
+
+    with pytest.raises((URLError, ConnectionError)):
+        get(upstream, "fail=1&failure=reset")
+
+
+def test_bench_caller(upstream, monkeypatch):
+    made = []
+    inner_caller = base.InnerCaller
+    monkeypatch.setattr(base, "InnerCaller", lambda *args: made.append(args) or inner_caller(*args))
+    monkeypatch.setattr(base, "INNER_LOGGER", None)
+    monkeypatch.setattr(base, "INNER_CALLER", None)
+
+    bench_caller.setup()
+
+    # No bench queues behind the cap of connections per host
+    (_, _, _, max_per_host, _) = made[-1]
+    assert max_per_host >= bench_caller.IN_FLIGHT
+    assert max_per_host >= max(bench_caller.FAN_OUTS)
+
+    assert bench_caller.bench_sequential(upstream, 5)["samples"] == 5
+    assert bench_caller.bench_fan_out(upstream, 3, 2)["samples"] == 2
@@ -0,0 +1,325 @@
+import asyncio
+import gc
+import json
+import socket
+import threading
+import weakref
+from time import perf_counter, sleep, time
+
+import pytest
+
+from wsgidragon import JsonSchema, base, jsonschema
+from wsgidragon.api import Api
+from wsgidragon.base import Context, InnerLogger, Response, StatusCode, caller
+from wsgidragon.routes import complete_response
+
+
+class CallRecv:
+    def __init__(self, val):
+        self.val = val
+        self._completed = perf_counter()
+
+    @property
+    def since_completed(self):
+        return perf_counter() - self._completed
+
+    def log_tags(self):
+        return {"http.code": 200}
+
+    def get(self):
+        return self.val
+
+
+class FakeInnerCaller:
+    """
+    FakeInnerCaller completes calls when the test says so.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = {}
+        self._next = 0
+        self._notify = {}
+        self.calls = []
+
+    def call(self, *args):
+        with self._cond:
+            self._next += 1
+            self.calls.append(args)
+            return self._next
+
+    def complete(self, ref, val):
+        with self._cond:
+            self._done[ref] = CallRecv(val)
+            self._cond.notify_all()
+
+            for (sock, ready) in self._notify.values():
+                ready.append(ref)
+                sock.send(b"\x01")
+
+    def notify_fd(self):
+        (reader, writer) = socket.socketpair()
+        fd = reader.detach()
+        self._notify[fd] = (writer, [])
+        return fd
+
+    def take_ready(self, fd):
+        with self._cond:
+            ready = self._notify[fd][1]
+            self._notify[fd] = (self._notify[fd][0], [])
+            return ready
+
+    def poll_ready(self, ref):
+        with self._cond:
+            return self._done.get(ref)
+
+    def block_on_ids(self, ids, timeout_ms=None):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: any(ref in self._done for ref in ids),
+                None if timeout_ms is None else timeout_ms / 1000,
+            )
+            return next((ref for ref in ids if ref in self._done), None)
+
+    def forget(self, ids):
+        pass
+
+
+class NullWriter:
+    def write(self, line):
+        pass
+
+
+@pytest.fixture
+def inner(monkeypatch):
+    inner = FakeInnerCaller()
+    monkeypatch.setattr(base, "INNER_CALLER", inner)
+    monkeypatch.setattr(base, "INNER_LOGGER", InnerLogger("svc", NullWriter()))
+    return inner
+
+
+def calls(n):
+    return [caller.call("GET", "example.com") for _ in range(n)]
+
+
+def test_wait_any(inner):
+    futures = calls(3)
+    inner.complete(futures[1]._ref, "b")
+
+    assert caller.wait_any(futures) is futures[1]
+
+
+def test_wait_any_empty(inner):
+    with pytest.raises(ValueError):
+        caller.wait_any([])
+
+
+def test_wait_any_deadline(inner):
+    with pytest.raises(TimeoutError):
+        caller.wait_any(calls(2), deadline=time() + 0.01)
+
+
+def test_as_completed(inner):
+    futures = calls(3)
+    for (fut, val) in zip(reversed(futures), "cba"):
+        inner.complete(fut._ref, val)
+
+    done = [fut.wait() for fut in caller.as_completed(futures)]
+
+    assert sorted(done) == ["a", "b", "c"]
+
+
+def test_gather(inner):
+    futures = calls(3)
+    threading.Timer(0.01, inner.complete, (futures[2]._ref, "c")).start()
+    inner.complete(futures[0]._ref, "a")
+    inner.complete(futures[1]._ref, "b")
+
+    assert caller.gather(futures) == ["a", "b", "c"]
+    assert caller.gather([]) == []
+
+
+def test_gather_deadline(inner):
+    futures = calls(2)
+    inner.complete(futures[0]._ref, "a")
+
+    with pytest.raises(TimeoutError):
+        caller.gather(futures, deadline=time() + 0.01)
+
+
+def test_call_latency(inner, monkeypatch):
+    observed = []
+    monkeypatch.setattr(base.METRICS, "observe_call", lambda *args: observed.append(args))
+
+    fut = calls(1)[0]
+    sleep(0.05)
+    inner.complete(fut._ref, "a")
+
+    # Polled well after the call completed
+    sleep(0.1)
+    assert fut.wait() == "a"
+
+    [(host, code, secs)] = observed
+    assert (host, code) == ("example.com", 200)
+    assert 0.05 <= secs < 0.1
+
+
+def test_async(inner):
+    async def run():
+        futures = calls(3)
+        asyncio.get_running_loop().call_later(0.01, inner.complete, futures[2]._ref, "c")
+        inner.complete(futures[0]._ref, "a")
+        inner.complete(futures[1]._ref, "b")
+
+        first = await caller.wait_any_async(futures)
+        assert first in futures[:2]
+
+        assert await caller.gather_async(futures) == ["a", "b", "c"]
+
+        with pytest.raises(ValueError):
+            await caller.wait_any_async([])
+
+        with pytest.raises(TimeoutError):
+            await caller.wait_any_async(calls(1), deadline=time() + 0.01)
+
+    asyncio.run(run())
+
+
+def test_poller_follows_loop(inner):
+    async def run():
+        fut = calls(1)[0]
+        asyncio.get_running_loop().call_later(0.01, inner.complete, fut._ref, "a")
+        assert await fut == "a"
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run())
+    loop.close()
+
+    loop_ref = weakref.ref(loop)
+    del loop
+    gc.collect()
+    assert loop_ref() is None
+
+    # The loop's notify socket is closed along with it
+    (writer, _) = list(inner._notify.values())[-1]
+    with pytest.raises(OSError):
+        writer.send(b"\x01")
+
+
+class HttpResponse:
+    def __init__(self, code, headers, body, streamed=False):
+        self.code = code
+        self.body = body
+        self.streamed = streamed
+        self._headers = headers
+
+    def headers(self):
+        return self._headers
+
+    def chunks(self):
+        return iter([self.body])
+
+
+def proxied(resp):
+    response = Response(Context("trace", None, "span", None))
+    api = Api("svc", ["GET"], ("proxy",), None, None, None, [StatusCode.OK])
+    complete_response(response, api, caller.proxy(resp, response.resp_head))
+    return response
+
+
+def test_proxy():
+    # Neither 418 nor 599 are registered on the route
+    response = proxied(HttpResponse(418, [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", "99"),
+        ("Connection", "keep-alive"),
+    ], b"teapot"))
+
+    assert response.status_str() == "418 I'm a Teapot"
+    assert response.headers() == [
+        ("X-TraceId", "trace"),
+        ("Content-Type", "text/plain"),
+        ("Content-Length", "6"),
+    ]
+    assert response.payload() == (b"teapot",)
+
+    response = proxied(HttpResponse(599, [("Content-Length", "6")], b"stream", True))
+    assert response.status_str() == "599 Unknown"
+    assert response.headers() == [
+        ("X-TraceId", "trace"),
+        ("Content-Length", "6"),
+    ]
+    assert list(response.payload()) == [b"stream"]
+
+
+class JsonResponse:
+    """
+    JsonResponse is the HttpResponse of a decode_json call,
+    counting how often resp.json is built.
+    """
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+        self.built = 0
+
+    def check_json(self):
+        if self.body:
+            json.loads(self.body)
+
+    @property
+    def json(self):
+        self.check_json()
+        if not self.body:
+            return None
+
+        self.built += 1
+        return json.loads(self.body)
+
+
+class UserSchema(JsonSchema):
+    name = jsonschema.String(required=True)
+
+
+def test_call_json(inner):
+    fut = caller.call_json("POST", "example.com", json={"id": 1})
+
+    (method, host, _, _, _, _, headers, body, _, _, decode_json, stream) = inner.calls[-1]
+    assert (method, host, decode_json, stream) == ("POST", "example.com", True, False)
+    assert json.loads(body) == {"id": 1}
+    assert ("Content-Type", "application/json") in headers
+    assert ("Accept", "application/json") in headers
+
+    # Without a schema resp.json is only built if it's used
+    resp = JsonResponse(200, b'{"name": "a"}')
+    inner.complete(fut._ref, resp)
+    assert fut.wait() is resp
+    assert resp.built == 0
+    assert resp.json == {"name": "a"}
+
+    # With one it's validated as the call completes
+    fut = caller.call_json("GET", "example.com", response_schema=UserSchema)
+    resp = JsonResponse(200, b'{"name": "a"}')
+    inner.complete(fut._ref, resp)
+    assert fut.wait() is resp
+    assert resp.built == 1
+
+    fut = caller.call_json("GET", "example.com", response_schema=UserSchema)
+    inner.complete(fut._ref, JsonResponse(200, b'{"name": 1}'))
+    assert isinstance(fut.wait(), jsonschema.ValidationError)
+
+
+def test_call_json_invalid(inner):
+    fut = caller.call_json("GET", "example.com")
+    inner.complete(fut._ref, JsonResponse(200, b'{"name": '))
+    assert isinstance(fut.wait(), ValueError)
+
+    # Only 2xx bodies are checked
+    resp = JsonResponse(500, b"crashed")
+    fut = caller.call_json("GET", "example.com", response_schema=UserSchema)
+    inner.complete(fut._ref, resp)
+    assert fut.wait() is resp
+
+    # An empty body has no JSON
+    resp = JsonResponse(204, b"")
+    fut = caller.call_json("GET", "example.com", response_schema=None)
+    inner.complete(fut._ref, resp)
+    assert fut.wait().json is None
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+from time import sleep, time
+
+import pytest
+
+from wsgidragon.deadline import DeadlineScheduler, TaskDeadlineScheduler
+
+
+class Expired(BaseException):
+    pass
+
+
+def test_check_before_deadline():
+    deadline = DeadlineScheduler().arm(time() + 10, Expired)
+    deadline.check()
+
+    assert not deadline.fired
+
+
+def test_check_raises_once_passed():
+    scheduler = DeadlineScheduler()
+    deadline = scheduler.arm(time() + 0.01, Expired)
+    sleep(0.02)
+
+    with pytest.raises(Expired):
+        deadline.check()
+
+    assert deadline.fired
+    assert scheduler.disarm(deadline)
+
+
+def test_check_disarmed():
+    scheduler = DeadlineScheduler()
+    deadline = scheduler.arm(time() - 1, Expired)
+
+    assert scheduler.disarm(deadline)
+    deadline.check()
+
+
+def test_tighten():
+    deadline = DeadlineScheduler().arm(time() + 10, Expired)
+    deadline.tighten(time() - 1)
+
+    with pytest.raises(Expired):
+        deadline.check()
+
+
+def test_tighten_never_extends():
+    deadline = DeadlineScheduler().arm(time() + 1, Expired)
+    deadline.tighten(time() + 10)
+
+    assert deadline.remaining() < 1
+
+
+def test_watch_fires():
+    scheduler = DeadlineScheduler()
+    fired = threading.Event()
+    deadline = scheduler.arm(time() + 0.1, Expired)
+    deadline.watch(0.5, fired.set)
+
+    assert fired.wait(1)
+    assert not scheduler.disarm(deadline)
+
+
+def test_disarm_removes_watchdog():
+    scheduler = DeadlineScheduler()
+    fired = threading.Event()
+    for _ in range(10):
+        deadline = scheduler.arm(time() + 0.05, Expired)
+        deadline.watch(0.5, fired.set)
+        scheduler.disarm(deadline)
+
+    assert scheduler._heap == []
+    assert not fired.wait(0.1)
+
+
+def test_tighten_moves_watchdog():
+    scheduler = DeadlineScheduler()
+    fired = threading.Event()
+    deadline = scheduler.arm(time() + 10, Expired)
+    deadline.watch(0.5, fired.set)
+    deadline.tighten(time() + 0.1)
+
+    assert len(scheduler._heap) == 1
+    assert fired.wait(1)
+
+
+def test_task_deadline_cancels():
+    scheduler = TaskDeadlineScheduler()
+
+    async def run():
+        deadline = scheduler.arm(time() + 0.01, Expired)
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.sleep(1)
+
+        assert scheduler.disarm(deadline)
+
+    asyncio.run(run())
+
+
+def test_task_deadline_disarmed():
+    scheduler = TaskDeadlineScheduler()
+
+    async def run():
+        deadline = scheduler.arm(time() + 0.01, Expired)
+        assert not scheduler.disarm(deadline)
+        await asyncio.sleep(0.02)
+
+        assert not deadline.fired
+
+    asyncio.run(run())
+
+
+def test_slow_watchdog_never_delays_another():
+    scheduler = DeadlineScheduler()
+    release = threading.Event()
+    fired = threading.Event()
+    threads = []
+
+    def slow():
+        threads.append(threading.current_thread())
+        release.wait(1)
+
+    first = scheduler.arm(time() + 0.02, Expired)
+    first.watch(0.5, slow)
+    second = scheduler.arm(time() + 0.04, Expired)
+    second.watch(0.5, fired.set)
+
+    assert fired.wait(0.5)
+    release.set()
+    assert threads[0] is not scheduler._thread
@@ -0,0 +1,49 @@
+import pytest
+
+from wsgidragon.base import Headers
+
+
+ENVIRON = {
+    "REQUEST_METHOD": "POST",
+    "CONTENT_TYPE": "application/json",
+    "CONTENT_LENGTH": "2",
+    "HTTP_X_CLIENT": "tests",
+    "HTTP_ACCEPT_ENCODING": "gzip",
+    "wsgi.input": None,
+}
+
+
+def test_lookup():
+    headers = Headers(ENVIRON)
+
+    # Case-insensitive, with or without the environ prefix
+    assert headers["X-Client"] == "tests"
+    assert headers["x-client"] == "tests"
+    assert headers["Content-Type"] == "application/json"
+    assert headers.get("accept-encoding") == "gzip"
+    assert headers.get("X-Missing") is None
+
+    with pytest.raises(KeyError):
+        headers["Request-Method"]
+
+    assert "X-CLIENT" in headers
+    assert "Request-Method" not in headers
+    assert 1 not in headers
+
+
+def test_iterate():
+    headers = Headers(ENVIRON)
+
+    assert sorted(headers) == ["accept-encoding", "content-length", "content-type", "x-client"]
+    assert len(headers) == 4
+    assert dict(headers)["content-length"] == "2"
+
+
+def test_view():
+    # Nothing is copied, the environ is read on each lookup
+    environ = dict(ENVIRON)
+    headers = Headers(environ)
+    environ["HTTP_X_LATE"] = "1"
+
+    assert headers["X-Late"] == "1"
+    assert len(headers) == 5
@@ -0,0 +1,63 @@
+import json
+
+from wsgidragon.base import REQUEST_STATE, Context, InnerLogger, RequestState
+
+
+class ListWriter:
+    def __init__(self):
+        self.raw = []
+        self.lines = []
+
+    def write(self, line):
+        self.raw.append(line)
+        self.lines.append(json.loads(line))
+
+
+def log(*tags, ctx=None):
+    writer = ListWriter()
+    state = RequestState()
+    state.ctx = ctx
+    token = REQUEST_STATE.set(state)
+    try:
+        InnerLogger("svc", writer).log("INFO", "hello", *tags)
+    finally:
+        REQUEST_STATE.reset(token)
+
+    return writer.lines[0]
+
+
+def test_fields():
+    ctx = Context("a" * 32, None, "b" * 16, None)
+    line = log({"x": 1}, ctx=ctx)
+
+    assert line["service"] == "svc"
+    assert line["trace_id"] == "a" * 32
+    assert line["span_id"] == "b" * 16
+    assert "parent_id" not in line
+    assert line["level"] == "INFO"
+    assert line["msg"] == "hello"
+    assert line["x"] == 1
+
+
+def test_later_tags_win():
+    writer = ListWriter()
+    InnerLogger("svc", writer).log("INFO", "hello", {"x": 1, "y": 1}, {}, {"x": 2})
+
+    assert writer.lines[0]["x"] == 2
+    assert writer.lines[0]["y"] == 1
+
+
+def test_no_duplicate_keys():
+    writer = ListWriter()
+    InnerLogger("svc", writer).log("INFO", "hello", {"x": 1}, {"x": 2})
+
+    assert writer.raw[0].count('"x"') == 1
+
+
+def test_tags_override_fields():
+    ctx = Context("a" * 32, "c" * 16, "b" * 16, None)
+    line = log({"msg": "tagged", "trace_id": "t"}, ctx=ctx)
+
+    assert line["msg"] == "tagged"
+    assert line["trace_id"] == "t"
+    assert line["parent_id"] == "c" * 16
@@ -0,0 +1,103 @@
+import json
+import sys
+import threading
+
+import pytest
+
+from wsgidragon.logwriter import BufferedWriter, SyncWriter, make_writer
+
+
+def lines(capsys):
+    return capsys.readouterr().out.splitlines()
+
+
+class HeldOut:
+    """
+    HeldOut is stdout, holding the first write
+    until the test releases it.
+    """
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.lines = []
+        self._held = False
+
+    def write(self, text):
+        if not self._held:
+            self._held = True
+            self.entered.set()
+            self.release.wait(5)
+
+        self.lines.extend(text.splitlines())
+
+    def flush(self):
+        pass
+
+
+def hold_stdout(monkeypatch):
+    # Patched in the test itself, pytest's capture
+    # replaces sys.stdout once the test starts.
+    held = HeldOut()
+    monkeypatch.setattr(sys, "stdout", held)
+    return held
+
+
+def test_make_writer():
+    assert isinstance(make_writer("svc", 0, "drop"), SyncWriter)
+    assert make_writer("svc", 10, "block").block
+
+    with pytest.raises(ValueError):
+        make_writer("svc", 10, "spill")
+
+
+def test_close_writes_in_order(capsys):
+    writer = BufferedWriter("svc", 1000, block=True, batch_size=7)
+    for n in range(100):
+        writer.write(str(n))
+
+    writer.close()
+    assert lines(capsys) == [str(n) for n in range(100)]
+
+    # Written straight away once closed
+    writer.write("late")
+    assert lines(capsys) == ["late"]
+
+
+def test_flush_drains_queue(monkeypatch):
+    held = hold_stdout(monkeypatch)
+    writer = BufferedWriter("svc", 100, batch_size=3)
+    writer.write("0")
+    assert held.entered.wait(5)
+
+    # The thread is held writing "0", the rest is flushed
+    # here, more than a batch of it
+    for n in range(1, 10):
+        writer.write(str(n))
+
+    writer.flush()
+    assert held.lines == [str(n) for n in range(1, 10)]
+
+    held.release.set()
+    writer.close()
+    assert held.lines[9:] == ["0"]
+
+
+def test_dropped_lines_reported(monkeypatch):
+    held = hold_stdout(monkeypatch)
+    writer = BufferedWriter("svc", 2)
+    writer.write("0")
+    assert held.entered.wait(5)
+
+    # Only two fit in the queue while the thread is held
+    for n in range(1, 6):
+        writer.write(str(n))
+
+    held.release.set()
+    writer.close()
+
+    assert held.lines[:3] == ["0", "1", "2"]
+    dropped = json.loads(held.lines[3])
+    assert dropped["msg"] == "log lines dropped"
+    assert dropped["log.dropped"] == 3
+    assert dropped["log.dropped_total"] == 3
+    assert writer.dropped == 3
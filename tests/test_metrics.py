@@ -0,0 +1,118 @@
+import os
+import threading
+
+from wsgidragon.metrics import Metrics, MetricsFile, read_file
+
+
+def samples(text):
+    lines = [line for line in text.splitlines() if not line.startswith("#")]
+    return dict(line.rsplit(" ", 1) for line in lines)
+
+
+def test_render(tmp_path):
+    metrics = Metrics()
+    metrics.init(str(tmp_path), "svc")
+    metrics.observe_request("/hello", 200, 0.003)
+    metrics.observe_request("/hello", 200, 0.2)
+    metrics.observe_request("/hello", 500, 20)
+    metrics.observe_call("upstream", "error", 0.01)
+
+    text = metrics.render()
+    found = samples(text)
+
+    assert "# TYPE wsgidragon_requests_total counter" in text
+    assert "# TYPE wsgidragon_request_seconds histogram" in text
+    assert found['wsgidragon_requests_total{route="/hello",status="200"}'] == "2"
+    assert found['wsgidragon_requests_total{route="/hello",status="500"}'] == "1"
+    assert found['wsgidragon_request_seconds_count{route="/hello"}'] == "3"
+    assert found['wsgidragon_request_seconds_sum{route="/hello"}'] == repr(0.003 + 0.2 + 20)
+    assert found['wsgidragon_request_seconds_bucket{route="/hello",le="0.005"}'] == "1"
+    assert found['wsgidragon_request_seconds_bucket{route="/hello",le="0.25"}'] == "2"
+    assert found['wsgidragon_request_seconds_bucket{route="/hello",le="10.0"}'] == "2"
+    assert found['wsgidragon_request_seconds_bucket{route="/hello",le="+Inf"}'] == "3"
+    assert found['wsgidragon_calls_total{host="upstream",status="error"}'] == "1"
+
+
+def test_escaped_labels(tmp_path):
+    metrics = Metrics()
+    metrics.init(str(tmp_path), "svc")
+    metrics.observe_request('a"b\\c', 200, 0.1)
+
+    assert 'route="a\\"b\\\\c"' in metrics.render()
+
+
+def test_one_file_per_thread(tmp_path):
+    metrics = Metrics()
+    metrics.init(str(tmp_path), "svc")
+
+    def observe():
+        for _ in range(1000):
+            metrics.observe_request("/t", 200, 0.1)
+
+    threads = [threading.Thread(target=observe) for _ in range(8)]
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    # Threads never share a file, so no increment is lost
+    names = os.listdir(tmp_path)
+    assert 1 < len(names) <= 8
+    assert all(name.startswith(f"{os.getpid()}_") for name in names)
+    assert samples(metrics.render())['wsgidragon_requests_total{route="/t",status="200"}'] == "8000"
+
+
+def test_disabled_without_directory():
+    metrics = Metrics()
+    metrics.init("", "svc")
+    metrics.observe_request("/hello", 200, 0.1)
+
+    assert metrics.directory is None
+
+
+def test_sums_workers(tmp_path):
+    metrics = Metrics()
+    metrics.init(str(tmp_path), "svc")
+    metrics.observe_request("/hello", 200, 0.1)
+
+    # Another worker's file
+    [ours] = os.listdir(tmp_path)
+    other = MetricsFile(str(tmp_path / "1_1.db"))
+    for (key, val) in read_file(str(tmp_path / ours)):
+        other.inc(key, val * 2)
+
+    found = samples(metrics.render())
+
+    assert found['wsgidragon_requests_total{route="/hello",status="200"}'] == "3"
+
+
+def test_file_grows(tmp_path):
+    path = str(tmp_path / "grow.db")
+    f = MetricsFile(path)
+    for n in range(5000):
+        f.inc(f"key{n}", n)
+
+    entries = dict(read_file(path))
+
+    assert len(entries) == 5000
+    assert entries["key4999"] == 4999
+
+    # Reopened, e.g by a worker with a reused pid
+    f = MetricsFile(path)
+    f.inc("key1")
+
+    assert dict(read_file(path))["key1"] == 2
+
+
+def test_read_cut_off(tmp_path):
+    f = MetricsFile(str(tmp_path / "w.db"))
+    for n in range(3):
+        f.inc(f"key{n}", n)
+
+    # As mapped before the file grew to hold its last entry
+    cut = tmp_path / "cut.db"
+    data = (tmp_path / "w.db").read_bytes()
+    cut.write_bytes(data[:data.index(b"key2") + 4])
+
+    assert read_file(str(cut)) == [("key0", 0.0), ("key1", 1.0)]
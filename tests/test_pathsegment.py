@@ -0,0 +1,115 @@
+from collections import namedtuple
+from uuid import UUID
+
+import pytest
+
+from wsgidragon.pathsegment import Hex, Int, Regex, Segment, Uuid
+from wsgidragon.routes import Route, RouteIndex, build_path, compile_path
+
+
+USER_ID = "12345678-1234-5678-1234-567812345678"
+
+
+def test_int():
+    assert Int().convert("42") == 42
+
+    for part in ("", "-1", "4.2", "x", "٣"):
+        with pytest.raises(ValueError):
+            Int().convert(part)
+
+
+def test_uuid():
+    assert Uuid().convert(USER_ID) == UUID(USER_ID)
+
+    assert Uuid().convert(USER_ID.upper()) == UUID(USER_ID)
+
+    # UUID() parses these, but they aren't canonical
+    hex_id = USER_ID.replace("-", "")
+    for part in ("", USER_ID[:-1], USER_ID[:-1] + "x", hex_id[:32] + "----",
+                 "-".join((hex_id[:4], hex_id[4:8], hex_id[8:12], hex_id[12:16], hex_id[16:]))):
+        with pytest.raises(ValueError):
+            Uuid().convert(part)
+
+
+def test_segment_is_abstract():
+    with pytest.raises(TypeError):
+        Segment()
+
+
+def test_hex():
+    assert Hex().convert("DEADbeef") == "deadbeef"
+    assert Hex(4).convert("beef") == "beef"
+
+    for (segm, part) in ((Hex(), ""), (Hex(), "xyz"), (Hex(4), "beefs"), (Hex(4), "bee")):
+        with pytest.raises(ValueError):
+            segm.convert(part)
+
+
+def test_regex():
+    assert Regex("[a-z]+").convert("abc") == "abc"
+
+    with pytest.raises(ValueError):
+        Regex("[a-z]+").convert("abc1")
+
+
+def test_equality():
+    assert Int() == Int()
+    assert Hex(4) == Hex(4)
+    assert Hex(4) != Hex(8)
+    assert Regex("a") != Regex("b")
+    assert len({Int(), Int(), Uuid()}) == 2
+    assert str(Int()) == "{int}"
+    assert str(Regex("[a-z]+")) == "{[a-z]+}"
+
+
+def test_compile_path():
+    with pytest.raises(TypeError):
+        compile_path(("users", 1))
+
+
+UserPath = namedtuple("UserPath", ("users", "user_id"))
+
+
+def index(*paths):
+    idx = RouteIndex()
+    for (n, path) in enumerate(paths):
+        idx.add(Route(["GET"], compile_path(path), n, None))
+
+    return idx
+
+
+def lookup(idx, path):
+    found = idx.lookup(path.split("/")[1:])
+    if found is None:
+        return
+
+    (route, values) = found
+    return (route.api, build_path(route.path, values))
+
+
+def test_route_typed_segments():
+    idx = index(UserPath("users", Int()), ("users", Uuid(), "posts"))
+
+    assert lookup(idx, "/users/42") == (0, UserPath("users", 42))
+    assert lookup(idx, f"/users/{USER_ID}/posts") == (1, ("users", UUID(USER_ID), "posts"))
+    assert lookup(idx, "/users/x") is None
+    assert lookup(idx, "/users/42/posts") is None
+
+
+def test_route_literal_wins():
+    idx = index(("users", Int()), ("users", "42"))
+
+    assert lookup(idx, "/users/42") == (1, ("users", "42"))
+    assert lookup(idx, "/users/43") == (0, ("users", 43))
+
+
+def test_route_backtracks():
+    idx = index(("a", "b", "c"), ("a", Regex("[a-z]"), "d"))
+
+    assert lookup(idx, "/a/b/d") == (1, ("a", "b", "d"))
+
+
+def test_route_first_registered_wins():
+    idx = index(("users", Int()), ("users", Int()))
+
+    assert lookup(idx, "/users/1")[0] == 0
@@ -0,0 +1,60 @@
+from importlib.machinery import EXTENSION_SUFFIXES
+
+import pytest
+
+import wsgidragoncall
+from benchmarks.upstream import Upstream
+from wsgidragon import base, caller
+
+
+if not wsgidragoncall.__file__.endswith(tuple(EXTENSION_SUFFIXES)):
+    pytest.skip("needs the built wsgidragoncall extension", allow_module_level=True)
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    with Upstream() as upstream:
+        yield upstream
+
+
+@pytest.fixture
+def inner(monkeypatch):
+    monkeypatch.setattr(base, "INNER_CALLER", wsgidragoncall.InnerCaller("tests"))
+
+
+def get(upstream, **params):
+    return caller.call(
+        "GET",
+        upstream.host,
+        port=upstream.port,
+        params=[(k, str(v)) for (k, v) in params.items()],
+    ).wait_or_raise(5)
+
+
+def test_body_view(upstream, inner):
+    resp = get(upstream, size=100000)
+    view = resp.body_view()
+
+    assert view.readonly
+    assert view.nbytes == resp.content_length == 100000
+    assert view == resp.body == b"x" * 100000
+
+    with pytest.raises(TypeError):
+        view[0] = 0
+
+    # The view keeps the body alive
+    del resp
+    assert bytes(view[:3]) == b"xxx"
+
+
+def test_headers(upstream, inner):
+    resp = get(upstream, size=10)
+
+    assert ("Content-Type", "application/octet-stream") in resp.headers()
+    assert resp.header("content-type") == "application/octet-stream"
+    assert resp.header("CONTENT-LENGTH") == "10"
+    assert resp.header("X-Missing") is None
+    assert resp.header("X-Missing", "default") == "default"
+
+    assert resp.header_values("Content-Length") == ["10"]
+    assert resp.header_values("X-Missing") == []
@@ -0,0 +1,123 @@
+import pytest
+
+from wsgidragon import base
+from wsgidragon.base import (
+    REQUEST_STATE,
+    RequestState,
+    build_ctx,
+    caller,
+    parse_traceparent,
+    sample_request,
+)
+
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+def traceparent(flags):
+    return f"00-{TRACE_ID}-{PARENT_ID}-{flags}"
+
+
+class RecordingCaller:
+    def __init__(self):
+        self.traces = []
+        self.args = []
+
+    def call(self, *args):
+        self.args.append(args)
+        self.traces.append(args[9])
+        return len(self.traces)
+
+
+@pytest.fixture
+def state():
+    state = RequestState()
+    token = REQUEST_STATE.set(state)
+    yield state
+    REQUEST_STATE.reset(token)
+
+
+@pytest.fixture
+def inner_caller(monkeypatch):
+    inner = RecordingCaller()
+    monkeypatch.setattr(base, "INNER_CALLER", inner)
+    return inner
+
+
+def test_parse():
+    assert parse_traceparent(traceparent("01")) == (TRACE_ID, PARENT_ID, "01")
+    assert parse_traceparent(traceparent("0A").upper()) == (TRACE_ID, PARENT_ID, "0a")
+
+
+@pytest.mark.parametrize("header", [
+    traceparent("1"),
+    traceparent("01") + "0",
+    "01" + traceparent("01")[2:],
+    traceparent("0g"),
+    traceparent("01").replace("4bf9", "4bfz"),
+    traceparent("01").replace("-", "_"),
+])
+def test_parse_invalid(header):
+    with pytest.raises(ValueError):
+        parse_traceparent(header)
+
+
+def test_build_ctx(state):
+    ctx = build_ctx({"HTTP_TRACEPARENT": traceparent("01")})
+
+    assert ctx.trace_id == TRACE_ID
+    assert ctx.parent_id == PARENT_ID
+    assert ctx.flags == "01"
+    assert len(ctx.span_id) == 16
+    assert state.ctx is ctx
+
+
+def test_build_ctx_without_traceparent(state):
+    ctx = build_ctx({})
+
+    assert len(ctx.trace_id) == 32
+    assert ctx.parent_id is None
+    assert ctx.flags is None
+
+
+@pytest.mark.parametrize("flags,rate,sampled", [
+    # A rate of 1 always logs, whatever the peer sampled
+    ("00", 1.0, True),
+    ("00", 0.5, False),
+    ("01", 0.5, True),
+    ("01", 0.0, True),
+    ("03", 0.0, True),
+    (None, 1.0, True),
+    (None, 0.0, False),
+])
+def test_sample_request(state, flags, rate, sampled):
+    headers = {"HTTP_TRACEPARENT": traceparent(flags)} if flags else {}
+    build_ctx(headers)
+    sample_request(rate)
+
+    assert state.sampled is sampled
+
+
+@pytest.mark.parametrize("flags,rate,sent", [
+    ("00", 1.0, "00"),
+    ("01", 0.0, "01"),
+    ("03", 1.0, "03"),
+    (None, 1.0, "01"),
+    (None, 0.0, "00"),
+])
+def test_call_flags(state, inner_caller, flags, rate, sent):
+    headers = {"HTTP_TRACEPARENT": traceparent(flags)} if flags else {}
+    ctx = build_ctx(headers)
+    sample_request(rate)
+    caller.call("GET", "example.com")
+
+    assert inner_caller.traces == [(ctx.trace_id, ctx.span_id, sent)]
+
+
+def test_client_not_forwarded(state, inner_caller):
+    # The incoming X-Client names our caller, not us
+    state.client = "upstream-service"
+    caller.call("GET", "example.com")
+
+    assert "upstream-service" not in inner_caller.args[0]
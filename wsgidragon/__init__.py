@@ -6,12 +6,14 @@ from .base import (
     caller,
 )
 from .dragonapp import DragonApp
+from .asgi import make_asgi_application
 from .jsonschema import Schema as JsonSchema
 from .envvar import environ
 
 
 __all__ = [
     'make_application',
+    'make_asgi_application',
     'StatusCode',
     "logger",
     "caller",
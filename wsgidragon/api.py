@@ -3,6 +3,7 @@ from urllib.parse import parse_qs
 from hashlib import md5
 
 from .base import logger
+from .envvar import environ
 from .jsonschema import validate
 
 
@@ -10,8 +11,58 @@ class BadCode(Exception):
     pass
 
 
+class BodyTooLarge(Exception):
+    pass
+
+
+# Request bodies are read in chunks of this size
+READ_CHUNK_SIZE = 64 * 1024
+
+# Serialized schemas kept per route, by request path
+SCHEMA_CACHE_SIZE = 256
+
+
+def read_body(reader, content_length, max_body_size):
+    """
+    read_body reads at most max_body_size bytes from reader.
+    BodyTooLarge is raised as soon as the limit is crossed.
+    """
+    if content_length is not None and content_length > max_body_size:
+        raise BodyTooLarge(f"content length exceeds {max_body_size} bytes")
+
+    chunks = []
+    size = 0
+    remaining = content_length
+
+    while remaining is None or remaining > 0:
+        n = READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining)
+        chunk = reader.read(n)
+        if not chunk:
+            break
+
+        size += len(chunk)
+        if size > max_body_size:
+            raise BodyTooLarge(f"body exceeds {max_body_size} bytes")
+
+        chunks.append(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+    return b"".join(chunks)
+
+
 class Api:
-    def __init__(self, service_name, methods, path, param_schema, request_schema, response_schema, status_codes):
+    def __init__(self,
+                 service_name,
+                 methods,
+                 path,
+                 param_schema,
+                 request_schema,
+                 response_schema,
+                 status_codes,
+                 timeout=None,
+                 max_body_size=None,
+                 log_sample_rate=None):
         self.service_name = service_name
         self.methods = methods
         self.path = path
@@ -19,14 +70,18 @@ class Api:
         self.request_schema = request_schema
         self.response_schema = response_schema
         self.status_codes = status_codes
-        id_b = bytes("".join(path) + "".join(methods), encoding='utf8')
+        self.timeout = timeout
+        self.max_body_size = max_body_size or int(environ['WSGI_DRAGON_MAX_BODY_SIZE'])
+        self.log_sample_rate = log_sample_rate
+        id_b = bytes("".join(map(str, path)) + "".join(methods), encoding='utf8')
         self._id = md5(id_b).digest().hex()[:10]
+        self._schemas = {}
 
     def build_params(self, raw_query):
         return parse_qs(raw_query)
 
-    def build_req_body(self, _content_type, reader):
-        return reader.read()
+    def build_req_body(self, _content_type, reader, content_length=None):
+        return read_body(reader, content_length, self.max_body_size)
 
     def build_response(self, body):
         """
@@ -47,6 +102,25 @@ class Api:
         """
         return {}
 
+    def schema_json(self, path):
+        """
+        schema_json returns the serialized schema for path and
+        its ETag. They're kept, so repeated OPTIONS requests
+        for a path don't rebuild them.
+        """
+        cached = self._schemas.get(path)
+        if cached:
+            return cached
+
+        schema = bytes(js.dumps(self.schema(path), separators=(",", ":")), encoding='utf8')
+        cached = (schema, '"' + md5(schema).digest().hex() + '"')
+
+        if len(self._schemas) >= SCHEMA_CACHE_SIZE:
+            self._schemas.clear()
+
+        self._schemas[path] = cached
+        return cached
+
     def schema_html(self, path):
         """
         schema_html must return inner html
@@ -59,7 +133,7 @@ class Api:
     @property
     def name(self):
         if type(self.path) is tuple:
-            return "/".join(self.path)
+            return "/".join(map(str, self.path))
 
         # path is a namedtuple - use the names instead
         return "/".join(self.path._fields)
@@ -70,16 +144,16 @@ class Api:
 
 
 class JsonApi(Api):
-    def build_req_body(self, content_type, reader):
+    def build_req_body(self, content_type, reader, content_length=None):
         # Won't read if schema not set
         if self.request_schema is None:
             return b""
 
-        if content_type.lower() != "application/json":
+        if (content_type or "").lower() != "application/json":
             raise TypeError("expected json request body")
 
-        # Okay - read it
-        body = js.load(reader)
+        # Okay - read it, but never more than we allow
+        body = js.loads(read_body(reader, content_length, self.max_body_size))
 
         # validate it
         validate(body, self.request_schema)
@@ -89,7 +163,7 @@ class JsonApi(Api):
 
     def build_response(self, body):
         if body is None and self.response_schema is None:
-            return b""
+            return "", b""
 
         if body is None and self.response_schema:
             raise RuntimeError("body is empty, but schema is not")
@@ -0,0 +1,287 @@
+"""
+ASGI entry point, sharing the WSGI route table.
+"""
+
+import asyncio
+from functools import partial
+from io import BytesIO
+from traceback import StackSummary
+from sys import stderr
+
+from .base import (
+    GatewayTimeout,
+    REQUEST_STATE,
+    RequestState,
+    Response,
+    build_ctx,
+    build_req_info,
+    build_request,
+    finish_profile,
+    finish_timings,
+    get_timeout,
+    init_application,
+    log_request,
+    logger,
+    release_calls,
+    watch_slow_request,
+    SLOW_REQUEST_FRAMES,
+)
+from .api import BodyTooLarge
+from .deadline import TASK_DEADLINES
+from .profiling import PROFILER
+from .envvar import environ as dragon_environ
+
+
+async def asgi_with_timeout(environ, handler, resp):
+    timeout = get_timeout(environ, resp)
+    if timeout is None:
+        return
+
+    state = REQUEST_STATE.get()
+    deadline = TASK_DEADLINES.arm(timeout, GatewayTimeout)
+    state.deadline = deadline
+    watch_slow_request(deadline, partial(task_stack, deadline.task))
+    try:
+        try:
+            with PROFILER.profiling(environ) as profile:
+                await profiled(handler, build_request(environ, deadline), resp, profile)
+        finally:
+            state.deadline = None
+            fired = TASK_DEADLINES.disarm(deadline)
+    except asyncio.CancelledError:
+        if not deadline.fired:
+            raise
+
+        fired = True
+    except GatewayTimeout:
+        # From a check in a sync handler
+        fired = True
+
+    if fired:
+        resp.set_timeout()
+
+
+async def profiled(handler, req, resp, profile):
+    if profile is None:
+        await handler(req, resp)
+        return
+
+    state = REQUEST_STATE.get()
+    state.profile = profile
+    try:
+        # A profile also sees any other tasks
+        # which run while this request awaits.
+        with profile.enabled():
+            await handler(req, resp)
+    finally:
+        state.profile = None
+        finish_profile(profile, resp)
+
+
+def task_stack(task):
+    # Follow the chain of awaited coroutines
+    # from the task down to where it is suspended.
+    frames = []
+    coro = task.get_coro()
+    while coro is not None and getattr(coro, "cr_frame", None) is not None:
+        frames.append((coro.cr_frame, coro.cr_frame.f_lineno))
+        coro = coro.cr_await
+
+    return StackSummary.extract(frames[-SLOW_REQUEST_FRAMES:])
+
+
+async def asgi_with_response(environ, handler, receive, body_limit):
+    """
+    asgi_with_response returns the status, headers
+    and payload of the response.
+    """
+    ctx = build_ctx(environ)
+    req_info = build_req_info(environ)
+    resp = Response(ctx)
+
+    try:
+        try:
+            max_body_size = body_limit(environ["REQUEST_METHOD"], environ["PATH_INFO"])
+            environ["wsgi.input"] = await read_body(environ, receive, max_body_size)
+        except BodyTooLarge as exc:
+            # Never buffered, so rejected before the handler
+            resp.set_payload_too_large(str(exc))
+        else:
+            await asgi_with_timeout(environ, handler, resp)
+
+        finish_timings(resp)
+
+        # A streamed body is logged once it's closed
+        payload = resp.payload(None, partial(log_request, resp, req_info))
+        if type(payload) is tuple:
+            log_request(resp, req_info)
+
+        return resp.status_str(), resp.headers(), payload
+
+    except Exception as exc:
+        logger.exception("application crashed", tags={
+            **req_info,
+            "error": str(exc),
+            "http.status": 500,
+        })
+        return "500 Internal Server Error", [
+            ("X-TraceId", ctx.trace_id),
+            ("Error", str(exc)),
+        ], (b"",)
+
+
+async def asgi_application(environ, handler, receive, body_limit):
+    # Fresh state for this request only
+    state = RequestState()
+    token = REQUEST_STATE.set(state)
+
+    try:
+        return await asgi_with_response(environ, handler, receive, body_limit)
+    except Exception as exc:
+        logger.exception("application crashed")
+        return "500 Internal Server Error", [
+            ("Error", str(exc)),
+        ], (b"",)
+    finally:
+        release_calls(state)
+        REQUEST_STATE.reset(token)
+
+
+def build_environ(scope):
+    """
+    build_environ builds a WSGI style environ from the
+    ASGI scope, so the rest of the pipeline is shared.
+    The body is read into wsgi.input by read_body.
+    """
+    (server_name, server_port) = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "wsgi.input": BytesIO(),
+        "wsgi.errors": stderr,
+    }
+
+    for (key, value) in scope.get("headers", []):
+        key = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+            continue
+
+        key = "HTTP_" + key
+        if key in environ:
+            value = environ[key] + "," + value
+
+        environ[key] = value
+
+    return environ
+
+
+async def read_body(environ, receive, max_body_size):
+    """
+    read_body buffers the request body, BodyTooLarge
+    is raised once it exceeds max_body_size bytes.
+    """
+    content_length = environ.get("CONTENT_LENGTH", "")
+    if content_length.isdigit() and int(content_length) > max_body_size:
+        raise BodyTooLarge(f"content length exceeds {max_body_size} bytes")
+
+    body = BytesIO()
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+
+        body.write(message.get("body", b""))
+        if body.tell() > max_body_size:
+            raise BodyTooLarge(f"body exceeds {max_body_size} bytes")
+
+        more_body = message.get("more_body", False)
+
+    body.seek(0)
+    return body
+
+
+def default_body_limit(method, path):
+    return int(dragon_environ['WSGI_DRAGON_MAX_BODY_SIZE'])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def make_asgi_application(name, handler, body_limit=default_body_limit):
+    """
+    make_asgi_application returns an ASGI app, handler
+    must be a coroutine function of (request, response).
+    body_limit(method, path) gives the largest body
+    buffered for a request.
+    """
+    init_application(name)
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+
+        if scope["type"] != "http":
+            raise RuntimeError(f"unsupported scope type {scope['type']}")
+
+        (status, headers, payload) = await asgi_application(
+            build_environ(scope),
+            handler,
+            receive,
+            body_limit,
+        )
+
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [
+                (k.encode("latin-1"), str(v).encode("latin-1")) for (k, v) in headers
+            ],
+        })
+        await send_payload(send, payload)
+
+    return app
+
+
+async def send_payload(send, payload):
+    if type(payload) is tuple:
+        await send({
+            "type": "http.response.body",
+            "body": b"".join(payload),
+        })
+        return
+
+    # Streamed - chunks may block, so
+    # produce them off the event loop.
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, payload, None)
+            if chunk is None:
+                break
+
+            await send({
+                "type": "http.response.body",
+                "body": bytes(chunk),
+                "more_body": True,
+            })
+    finally:
+        await asyncio.to_thread(payload.close)
+
+    await send({
+        "type": "http.response.body",
+        "body": b"",
+    })
@@ -1,17 +1,28 @@
+import asyncio
 import json as js
-import signal
+import os
+import socket
 from collections import namedtuple
+from collections.abc import Mapping
 from enum import Enum
-from sys import stderr
+from sys import stderr, _current_frames
 from functools import partial
-from traceback import format_exc
-from datetime import datetime
-from random import randbytes
-from time import time
+from math import ceil
+from http import HTTPStatus
+from traceback import format_exc, extract_stack, StackSummary
+from random import randbytes, random
+from time import time, gmtime, strftime, perf_counter
+from contextvars import ContextVar, copy_context
+from weakref import WeakKeyDictionary, finalize, ref as weak_ref
 
 from wsgidragoncall import InnerCaller
 
 from .envvar import environ
+from .deadline import DEADLINES
+from .logwriter import SyncWriter, make_writer
+from .metrics import METRICS
+from .profiling import PROFILER
+from .jsonschema import validate
 
 
 WSGIHandler = namedtuple("WSGIHandler", (
@@ -25,6 +36,8 @@ Context = namedtuple("Context", (
     "trace_id",
     "parent_id",
     "span_id",
+    # flags of the incoming traceparent, or None
+    "flags",
 ))
 
 Request = namedtuple("Request", (
@@ -33,46 +46,217 @@ Request = namedtuple("Request", (
     "params",
     "headers",
     "content_type",
+    "content_length",
     "body",
+    "deadline",
 ))
 
+# ProxiedStatus is an upstream status relayed by Caller.proxy,
+# value is (code, reason) as with StatusCode.
+ProxiedStatus = namedtuple("ProxiedStatus", (
+    "value",
+))
+
+
+class RequestState:
+    """
+    RequestState holds everything scoped to a single request.
+    It lives in a contextvar, so concurrent requests on other
+    threads never see each other's state.
+    """
+    def __init__(self):
+        self.ctx = None
+        self.client = None
+        self.deadline = None
+        self.call_ids = set()
+        self.log_prefix = None
+        self.start = perf_counter()
+
+        # Seconds spent in each phase, see timed
+        self.timings = {}
+
+        # Route name for metrics, set once matched
+        self.route = None
+
+        # (path, match) of the request's route lookup,
+        # so the ASGI body limit and routing share it.
+        self.route_lookup = None
+
+        # Whether INFO request/call logs are kept,
+        # decided once the route is known.
+        self.sampled = None
+
+        # RequestProfile if the request is profiled
+        self.profile = None
+
+
+REQUEST_STATE = ContextVar("wsgidragon_request_state", default=None)
+
+
+class timed:
+    """
+    timed adds the time spent in its block to the
+    named phase of the current request.
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        add_timing(self.name, perf_counter() - self.start)
+
+
+def add_timing(name, secs):
+    state = REQUEST_STATE.get()
+    if state:
+        state.timings[name] = state.timings.get(name, 0.0) + secs
+
+
+def finish_timings(resp):
+    """
+    finish_timings adds the phase timings to the
+    request complete log, and as a Server-Timing
+    header when WSGI_DRAGON_SERVER_TIMING is set.
+    The request is also recorded in the metrics.
+    """
+    state = REQUEST_STATE.get()
+    if not state:
+        return
+
+    total = perf_counter() - state.start
+    status = resp.status_code()
+    METRICS.observe_request(
+        state.route or "unmatched",
+        status.value[0] if status else 0,
+        total,
+    )
+
+    timings = {**state.timings, "total": total}
+    for (name, secs) in timings.items():
+        resp.add_log_tag(f"timing.{name}_ms", round(secs * 1000, 3))
+
+    if SERVER_TIMING:
+        resp.add_header("Server-Timing", ", ".join(
+            f"{name};dur={secs * 1000:.3f}" for (name, secs) in timings.items()
+        ))
+
+
 # Logging
+# Tags are encoded with a single, reused encoder
+encode_json = js.JSONEncoder(separators=(",", ":")).encode
+
+
+# Fields every line has, a tag may override them
+LOG_FIELDS = frozenset({
+    "service",
+    "trace_id",
+    "span_id",
+    "parent_id",
+    "client",
+    "ts",
+    "level",
+    "msg",
+})
+
+
 class InnerLogger:
-    def __init__(self, service_name):
+    """
+    InnerLogger writes JSON lines. The fields which are fixed for
+    a request (service, trace ids and client) are encoded once per
+    request and reused as the prefix of every line.
+    """
+    def __init__(self, service_name, writer=None):
         self.service_name = service_name
-        self._ctx = None
-        self._client = None
+        self.writer = writer or SyncWriter()
+        self._service_prefix = '{"service":' + encode_json(service_name)
+        self._ts = (None, None)
+
+    def log(self, level, msg, tags, *more_tags):
+        if more_tags:
+            # Later tags win
+            tags = {**(tags or {})}
+            for t in more_tags:
+                tags.update(t)
+
+        if tags and not LOG_FIELDS.isdisjoint(tags):
+            # A tag overrides a fixed field, so
+            # the line can't reuse the prefix.
+            self.writer.write(self.encode_line(level, msg, tags))
+            return
 
-    def set_ctx(self, ctx):
-        self._ctx = ctx
+        parts = [
+            self.prefix(REQUEST_STATE.get()),
+            ',"ts":"',
+            self.timestamp(),
+            '","level":"',
+            level,
+            '","msg":',
+            encode_json(msg),
+        ]
 
-    def unset_ctx(self):
-        self._ctx = None
+        if tags:
+            parts.append(",")
+            parts.append(encode_json(tags)[1:-1])
 
-    def set_client(self, client):
-        self._client = client
+        parts.append("}")
+        self.writer.write("".join(parts))
 
-    def unset_client(self):
-        self._client = None
+    def encode_line(self, level, msg, tags):
+        line = {"service": self.service_name}
+        state = REQUEST_STATE.get()
+        if state and state.ctx:
+            line["trace_id"] = state.ctx.trace_id
+            line["span_id"] = state.ctx.span_id
+            if state.ctx.parent_id:
+                line["parent_id"] = state.ctx.parent_id
 
-    def log(self, level, msg, tags):
-        msg = {
-            "service": self.service_name,
-            "ts": datetime.utcnow().isoformat(),
-            "level": level,
-            "msg": msg,
-        }
-        if self._ctx:
-            msg['trace_id'] = self._ctx.trace_id
-            msg['span_id'] = self._ctx.span_id
-            if self._ctx.parent_id:
-                msg['parent_id'] = self._ctx.parent_id
+        if state and state.client:
+            line["client"] = state.client
+
+        line["ts"] = self.timestamp()
+        line["level"] = level
+        line["msg"] = msg
+        line.update(tags)
+
+        return encode_json(line)
+
+    def prefix(self, state):
+        if not state or not (state.ctx or state.client):
+            return self._service_prefix
+
+        key = (state.ctx, state.client)
+        if state.log_prefix and state.log_prefix[0] == key:
+            return state.log_prefix[1]
+
+        parts = [self._service_prefix]
+        if state.ctx:
+            parts.append(',"trace_id":' + encode_json(state.ctx.trace_id))
+            parts.append(',"span_id":' + encode_json(state.ctx.span_id))
+            if state.ctx.parent_id:
+                parts.append(',"parent_id":' + encode_json(state.ctx.parent_id))
 
-        if self._client:
-            msg['client'] = self._client
+        if state.client:
+            parts.append(',"client":' + encode_json(state.client))
 
-        msg.update(tags)
-        print(js.dumps(msg, separators=(",", ":")))
+        prefix = "".join(parts)
+        state.log_prefix = (key, prefix)
+        return prefix
+
+    def timestamp(self):
+        # The formatted second is cached, only
+        # the microseconds change per line.
+        now = time()
+        sec = int(now)
+        (ts_sec, ts_str) = self._ts
+        if sec != ts_sec:
+            ts_str = strftime("%Y-%m-%dT%H:%M:%S", gmtime(sec))
+            self._ts = (sec, ts_str)
+
+        return f"{ts_str}.{int((now - sec) * 1000000):06d}"
 
 
 class Logger:
@@ -83,6 +267,23 @@ class Logger:
 
         INNER_LOGGER.log("INFO", msg.format(*args), tags)
 
+    @staticmethod
+    def info_tags(msg, *tags):
+        """
+        info_tags logs with several tag dicts,
+        merged in turn so later dicts win.
+        """
+        global INNER_LOGGER
+
+        INNER_LOGGER.log("INFO", msg, *tags)
+
+    @staticmethod
+    def warn(msg, *args, tags=None):
+        global INNER_LOGGER
+        tags = tags or {}
+
+        INNER_LOGGER.log("WARN", msg.format(*args), tags)
+
     @staticmethod
     def error(msg, *args, tags=None):
         global INNER_LOGGER
@@ -110,36 +311,79 @@ def self_eval(e):
     return e
 
 
+def json_response(schema, resp):
+    """
+    json_response checks the call_loop decoded the body, and
+    validates it against schema, for 2xx responses. Without a
+    schema resp.json is only built as Python objects if it's used.
+    """
+    if 200 <= resp.code < 300:
+        resp.check_json()
+        if schema is not None:
+            validate(resp.json, schema)
+
+    return resp
+
+
 class CallFuture:
     def __init__(self, ref, log_tags, on_complete=None):
         self._ref = ref
         self._call_recv = None
+        self._ready = False
         self._on_complete = on_complete or self_eval
         self._val = None
         self._log_tags = log_tags
+        self._start = perf_counter()
+
+    @classmethod
+    def failed(cls, exc, log_tags):
+        """
+        failed returns a future which is already
+        complete - the call was never placed.
+        """
+        fut = cls(None, log_tags)
+        fut._ready = True
+        fut._val = exc
+        logger.error("call not placed", tags={
+            **log_tags,
+            "error": str(exc),
+        })
+
+        return fut
 
     def _set_call_recv(self, call_recv):
         global logger
 
         self._call_recv = call_recv
-        tags = {**self._log_tags, **call_recv.log_tags()}
-        logger.info("call complete", tags=tags)
+        self._ready = True
+        tags = call_recv.log_tags()
+
+        # Latency until the call loop completed the call,
+        # not until the request got round to polling it.
+        METRICS.observe_call(
+            self._log_tags["url.host"],
+            tags.get("http.code", "error"),
+            max(perf_counter() - self._start - call_recv.since_completed, 0.0),
+        )
+
+        if keep_call_log(tags):
+            logger.info_tags("call complete", self._log_tags, tags)
 
         val = call_recv.get()
         try:
-            if isinstance(Exception, val):
+            if isinstance(val, Exception):
                 complete_val = val
             else:
                 complete_val = self._on_complete(val)
-        except Exception:
-            self._val = val
+        except Exception as exc:
+            self._val = exc
         else:
             self._val = complete_val
 
     def is_ready(self):
         global INNER_CALLER
 
-        if self._call_recv:
+        if self._ready:
             return True
 
         call_recv = INNER_CALLER.poll_ready(self._ref)
@@ -149,26 +393,161 @@ class CallFuture:
 
         return False
 
-    def wait(self):
-        global INNER_CALLER
+    def wait(self, timeout=None):
+        """
+        wait blocks, without holding the GIL, until the call
+        completes. TimeoutError is raised if timeout (seconds)
+        passes first. It blocks the event loop too, async
+        handlers await the future instead.
+        """
+        block_on([self], timeout)
+        return self._val
+
+    def wait_or_raise(self, timeout=None):
+        val = self.wait(timeout)
+        if isinstance(val, Exception):
+            raise val
 
-        if self._call_recv:
-            return self._val
+        return val
 
-        INNER_CALLER.block_on_ids([self._ref])
-        call_recv = INNER_CALLER.poll_ready(self._ref)
-        if call_recv:
-            self._set_call_recv(call_recv)
-            return self._val
+    async def wait_async(self):
+        if not self._ready:
+            with timed("call_wait"):
+                await call_poller().wait(self._ref)
 
+            # Completes the call in the awaiting
+            # task, so it logs with its context.
+            self.is_ready()
+
+        return self._val
+
+    def __await__(self):
+        return self.wait_async().__await__()
+
+
+def block_on(futures, timeout=None):
+    """
+    block_on waits, without holding the GIL, until any of
+    futures completes and returns it. All the calls are
+    waited on in a single block_on_ids. TimeoutError is
+    raised if timeout (seconds) passes first.
+    """
+    global INNER_CALLER
+
+    if not futures:
+        raise ValueError("no futures to wait on")
+
+    for fut in futures:
+        if fut._ready:
+            return fut
+
+    # Wake up at the request deadline, so
+    # the gateway timeout is raised here.
+    state = REQUEST_STATE.get()
+    block_timeout = timeout
+    if state and state.deadline:
+        remaining = max(state.deadline.remaining(), 0)
+        block_timeout = remaining if timeout is None else min(timeout, remaining)
+
+    # Rounded up, so a wait bounded by the
+    # deadline doesn't end just short of it.
+    timeout_ms = None
+    if block_timeout is not None:
+        timeout_ms = ceil(block_timeout * 1000)
+
+    by_ref = {fut._ref: fut for fut in futures}
+    with timed("call_wait"):
+        ref = INNER_CALLER.block_on_ids(list(by_ref), timeout_ms)
+
+    if ref is None:
+        if state and state.deadline:
+            state.deadline.check()
+
+        raise TimeoutError("call not complete")
+
+    fut = by_ref[ref]
+    if not fut.is_ready():
         raise RuntimeError("didn't block waiting for call")
 
-    def wait_or_raise(self):
-        val = self.wait()
-        if isinstance(Exception, val):
-            raise val
+    return fut
 
-        return val
+
+def remaining(deadline):
+    # Seconds until the unix time deadline
+    if deadline is None:
+        return None
+
+    return max(deadline - time(), 0)
+
+
+class CallPoller:
+    """
+    CallPoller lets a CallFuture be awaited. The event loop
+    watches a socket the call loop writes to as calls complete,
+    so awaiting a call neither blocks nor polls the loop.
+    """
+    def __init__(self, loop):
+        global INNER_CALLER
+
+        # CALL_POLLERS mustn't keep the loop alive,
+        # the socket is closed along with it.
+        self._loop = weak_ref(loop)
+        self._waiters = {}
+        self._sock = socket.socket(fileno=INNER_CALLER.notify_fd())
+        self._sock.setblocking(False)
+        loop.add_reader(self._sock, self._on_notify)
+        finalize(loop, self._sock.close)
+
+    def wait(self, ref):
+        global INNER_CALLER
+
+        waiter = self._loop().create_future()
+        if INNER_CALLER.poll_ready(ref):
+            # Completed before we started watching for it
+            waiter.set_result(None)
+            return waiter
+
+        self._waiters.setdefault(ref, []).append(waiter)
+        waiter.add_done_callback(partial(self._drop, ref))
+        return waiter
+
+    def _drop(self, ref, waiter):
+        # Waiters whose request has gone away are cancelled
+        waiters = self._waiters.get(ref)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[ref]
+
+    def _on_notify(self):
+        global INNER_CALLER
+
+        try:
+            while self._sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        ready = INNER_CALLER.take_ready(self._sock.fileno())
+        if ready is None:
+            # Too many completed to be queued for us
+            ready = [ref for ref in self._waiters if INNER_CALLER.poll_ready(ref)]
+
+        for ref in ready:
+            for waiter in self._waiters.pop(ref, ()):
+                if not waiter.done():
+                    waiter.set_result(None)
+
+
+CALL_POLLERS = WeakKeyDictionary()
+
+def call_poller():
+    loop = asyncio.get_running_loop()
+    poller = CALL_POLLERS.get(loop)
+    if poller is None:
+        poller = CALL_POLLERS[loop] = CallPoller(loop)
+
+    return poller
 
 
 class Caller:
@@ -181,11 +560,19 @@ class Caller:
              params=None,
              headers=None,
              body=None,
-             timeout=10):
+             timeout=10,
+             decode_json=False,
+             on_complete=None,
+             stream=False):
+        """
+        With stream=True the call completes once the response
+        head arrives, its body follows on resp.chunks().
+        """
         global INNER_CALLER
 
         body = body or b""
         path_segms = path_segms or [""]
+        timeout_ms = int(timeout * 1000)
 
         log_tags = {
             "url.host": host,
@@ -195,26 +582,203 @@ class Caller:
             "http.ssl": use_ssl,
         }
 
-        return CallFuture(INNER_CALLER.call(method,
-                                            host,
-                                            port,
-                                            path_segms,
-                                            use_ssl,
-                                            params or [],
-                                            headers or [],
-                                            body,
-                                            timeout * 1000), log_tags)
+        state = REQUEST_STATE.get() or RequestState()
+
+        # Never wait on a call past the request deadline
+        if state.deadline:
+            state.deadline.check()
+            remaining_ms = int(state.deadline.remaining() * 1000)
+            if remaining_ms <= 0:
+                return CallFuture.failed(
+                    TimeoutError("request deadline exceeded"),
+                    log_tags,
+                )
+
+            timeout_ms = min(timeout_ms, remaining_ms)
+
+        log_tags["http.timeout_ms"] = timeout_ms
+
+        trace = None
+        if state.ctx:
+            # Incoming flags are passed on unchanged,
+            # else our sampling decision is.
+            flags = state.ctx.flags
+            if flags is None:
+                flags = "00" if state.sampled is False else "01"
+
+            trace = (state.ctx.trace_id, state.ctx.span_id, flags)
+
+        ref = INNER_CALLER.call(method,
+                                host,
+                                port,
+                                path_segms,
+                                use_ssl,
+                                params or [],
+                                headers or [],
+                                body,
+                                timeout_ms,
+                                trace,
+                                decode_json,
+                                stream)
+        state.call_ids.add(ref)
+
+        return CallFuture(ref, log_tags, on_complete)
 
     @staticmethod
-    def call_json(self, method, path, json, headers=None, params=None):
-        json = js.dumps(json)
-        headers = headers or []
-        headers.append(
-            ("Content-Type", "application/json"),
-        )
+    def wait_any(futures, deadline=None):
+        """
+        wait_any returns the first of futures to complete.
+        deadline is a unix time, TimeoutError is raised if
+        none have completed by then.
+        """
+        return block_on(list(futures), remaining(deadline))
 
-        ref = INNER_CALLER.call(method, path, headers, params or [], json)
-        return CallFuture(ref)
+    @staticmethod
+    def as_completed(futures, deadline=None):
+        """
+        as_completed yields futures as they complete. TimeoutError
+        is raised if they haven't all completed by deadline.
+        """
+        pending = list(futures)
+
+        while pending:
+            fut = block_on(pending, remaining(deadline))
+            pending.remove(fut)
+            yield fut
+
+    @staticmethod
+    def gather(futures, deadline=None):
+        """
+        gather waits for all futures and returns their values,
+        in order. Failed calls give their exception as the value.
+        """
+        futures = list(futures)
+        for _ in Caller.as_completed(futures, deadline):
+            pass
+
+        return [fut._val for fut in futures]
+
+    @staticmethod
+    async def wait_any_async(futures, deadline=None):
+        """
+        wait_any_async awaits the first of futures to complete.
+        """
+        futures = list(futures)
+        if not futures:
+            raise ValueError("no futures to wait on")
+
+        for fut in futures:
+            if fut._ready:
+                return fut
+
+        poller = call_poller()
+        waiters = {poller.wait(fut._ref): fut for fut in futures}
+        try:
+            with timed("call_wait"):
+                (done, _) = await asyncio.wait(
+                    waiters,
+                    timeout=remaining(deadline),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+        if not done:
+            raise TimeoutError("call not complete")
+
+        fut = waiters[done.pop()]
+        fut.is_ready()
+        return fut
+
+    @staticmethod
+    async def as_completed_async(futures, deadline=None):
+        """
+        as_completed_async yields futures as they complete.
+        """
+        pending = list(futures)
+
+        while pending:
+            fut = await Caller.wait_any_async(pending, deadline)
+            pending.remove(fut)
+            yield fut
+
+    @staticmethod
+    async def gather_async(futures, deadline=None):
+        """
+        gather_async awaits all futures and returns their values.
+        """
+        futures = list(futures)
+        async for _ in Caller.as_completed_async(futures, deadline):
+            pass
+
+        return [fut._val for fut in futures]
+
+    @staticmethod
+    def proxy(resp, resp_head):
+        """
+        proxy relays resp, a call's HttpResponse, as the handler's
+        response - return its value from the handler. A call made
+        with stream=True has its body piped through as it arrives.
+        The upstream status is relayed as is, it needn't be one
+        the route registered, and the body isn't validated.
+        """
+        try:
+            reason = HTTPStatus(resp.code).phrase
+        except ValueError:
+            reason = "Unknown"
+
+        # A body which isn't streamed is sent with the
+        # Content-Length of the bytes we have, not a copy.
+        streamed = resp.streamed
+        resp_head(ProxiedStatus((resp.code, reason)), [
+            (k, v) for (k, v) in resp.headers()
+            if k.lower() not in PROXY_SKIP_HEADERS
+            and (streamed or k.lower() != "content-length")
+        ])
+
+        if streamed:
+            return resp.chunks()
+
+        return resp.body
+
+    @staticmethod
+    def call_json(method,
+                  host,
+                  json=None,
+                  port=80,
+                  path_segms=None,
+                  use_ssl=False,
+                  params=None,
+                  headers=None,
+                  timeout=10,
+                  response_schema=None):
+        """
+        call_json sends json as the body and has the call_loop
+        decode the response, off the request thread. The value
+        is the HttpResponse, its decoded body is resp.json.
+        A 2xx body which isn't JSON, or doesn't match
+        response_schema, gives the exception as the value.
+        """
+        headers = list(headers or [])
+        headers.append(("Accept", "application/json"))
+
+        body = None
+        if json is not None:
+            body = bytes(encode_json(json), encoding="utf8")
+            headers.append(("Content-Type", "application/json"))
+
+        return Caller.call(method,
+                           host,
+                           port=port,
+                           path_segms=path_segms,
+                           use_ssl=use_ssl,
+                           params=params,
+                           headers=headers,
+                           body=body,
+                           timeout=timeout,
+                           decode_json=True,
+                           on_complete=partial(json_response, response_schema))
 
 
 # Our inner caller
@@ -224,12 +788,31 @@ caller = Caller
 class StatusCode(Enum):
     OK = (200, "Ok")
     CREATED = (201, "Created")
+    NOT_MODIFIED = (304, "Not Modified")
     BAD_REQUEST = (400, "Bad Request")
     NOT_FOUND = (404, "Not Found")
+    PAYLOAD_TOO_LARGE = (413, "Payload Too Large")
     INTERNAL_SERVER_ERROR = (500, "Internal Server Error")
     GATEWAY_TIMEOUT = (504, "Gateway Timeout")
 
 
+# Upstream headers which aren't relayed by Caller.proxy,
+# they describe the upstream connection, not the response.
+PROXY_SKIP_HEADERS = frozenset({
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "date",
+    "server",
+    "x-traceid",
+})
+
+
 class Response:
     def __init__(self, ctx):
         self._ctx = ctx
@@ -262,7 +845,28 @@ class Response:
         return get_status_str(self._status)
 
     def headers(self):
-        return self._headers + [("Content-Length", str(len(self._payload[0])))]
+        if self._status is StatusCode.NOT_MODIFIED:
+            # A 304 has no body, nor a length
+            return self._headers[:]
+
+        content_length = self.content_length()
+        if content_length is None:
+            # Streamed - let the server chunk it
+            return self._headers[:]
+
+        return self._headers + [("Content-Length", str(content_length))]
+
+    def content_length(self):
+        if type(self._payload) is tuple:
+            return len(self._payload[0])
+
+        if hasattr(self._payload, "read"):
+            try:
+                return os.fstat(self._payload.fileno()).st_size - self._payload.tell()
+            except (AttributeError, OSError, ValueError):
+                return None
+
+        return None
 
     def add_log_tag(self, key, val):
         self._log_tags[key] = val
@@ -275,13 +879,43 @@ class Response:
         return tags
 
     def set_body(self, content_type, body):
-        self._headers.append(
-            ("Content-Type", content_type)
-        )
-        self._payload = (body,)
+        """
+        body is either bytes, a binary file or
+        an iterable of bytes to be streamed.
+        """
+        if content_type:
+            self._headers.append(
+                ("Content-Type", content_type)
+            )
+
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            self._payload = (body,)
+        else:
+            self._payload = body
+
+    def payload(self, file_wrapper=None, on_close=None):
+        """
+        on_close is called with the seconds spent
+        streaming, once a streamed body is closed.
+        """
+        if type(self._payload) is tuple:
+            return self._payload
+
+        # Streamed bodies are produced after the request
+        # returns, keep hold of the request's context.
+        context = copy_context()
+
+        if hasattr(self._payload, "read"):
+            if file_wrapper:
+                # Lets the server use sendfile
+                return file_wrapper(self._payload, FILE_BLOCK_SIZE)
+
+            return ResponseStream(iter_file(self._payload, FILE_BLOCK_SIZE), context, on_close)
+
+        return ResponseStream(self._payload, context, on_close)
 
-    def payload(self):
-        return self._payload
+    def set_not_modified(self):
+        self._status = StatusCode.NOT_MODIFIED
 
     def set_not_found(self):
         self._status = StatusCode.NOT_FOUND
@@ -293,6 +927,13 @@ class Response:
         )
         self.set_status(StatusCode.BAD_REQUEST)
 
+    def set_payload_too_large(self, reason):
+        self.clear()
+        self._headers.append(
+            ("Error", reason),
+        )
+        self.set_status(StatusCode.PAYLOAD_TOO_LARGE)
+
     def set_internal_server_error(self, reason):
         self.clear()
         self._headers.append(
@@ -320,66 +961,239 @@ class Response:
         self.set_status(StatusCode.OK)
 
 
-def application_with_request(wsgi_handler, resp):
+def build_request(wsgi_environ, deadline):
     # Build the request tuple
-    req = Request(
-        wsgi_handler.environ['REQUEST_METHOD'],
-        wsgi_handler.environ['PATH_INFO'],
-        wsgi_handler.environ['QUERY_STRING'],
-        get_headers(wsgi_handler.environ),
+    return Request(
+        wsgi_environ['REQUEST_METHOD'],
+        wsgi_environ['PATH_INFO'],
+        wsgi_environ['QUERY_STRING'],
+        get_headers(wsgi_environ),
         # Set content-type if we have it
-        wsgi_handler.environ.get('CONTENT_TYPE'),
-        wsgi_handler.environ['wsgi.input'],
+        wsgi_environ.get('CONTENT_TYPE'),
+        get_content_length(wsgi_environ),
+        wsgi_environ['wsgi.input'],
+        deadline,
     )
 
-    wsgi_handler.handler(req, resp)
 
+# Files are streamed in blocks of this size
+FILE_BLOCK_SIZE = 64 * 1024
+
+
+class ResponseStream:
+    """
+    ResponseStream wraps a streamed response body. Chunks are
+    produced in the request's context, so the body can still log
+    with its trace_id, and close releases the request's calls.
+    The body isn't bound by the request deadline.
+    """
+    def __init__(self, iterable, context, on_close=None):
+        self._iterable = iterable
+        self._iter = None
+        self._context = context
+        self._on_close = on_close
+        self._start = perf_counter()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._context.run(self._next)
+
+    def _next(self):
+        if self._iter is None:
+            self._iter = iter(self._iterable)
+
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise
+        except Exception:
+            logger.exception("response stream crashed")
+            raise
+
+    def close(self):
+        self._context.run(self._close)
+
+    def _close(self):
+        try:
+            close = getattr(self._iterable, "close", None)
+            if close:
+                close()
+        finally:
+            state = REQUEST_STATE.get()
+            if state:
+                release_calls(state)
+
+            if self._on_close:
+                self._on_close(perf_counter() - self._start)
+
+
+def iter_file(f, block_size):
+    try:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+
+            yield chunk
+    finally:
+        f.close()
+
+
+def application_with_request(wsgi_handler, resp, deadline):
+    req = build_request(wsgi_handler.environ, deadline)
 
-class TimeoutError(BaseException):
+    with PROFILER.profiling(wsgi_handler.environ) as profile:
+        if profile is None:
+            wsgi_handler.handler(req, resp)
+            return
+
+        state = REQUEST_STATE.get()
+        state.profile = profile
+        try:
+            with profile.enabled():
+                wsgi_handler.handler(req, resp)
+        finally:
+            state.profile = None
+            finish_profile(profile, resp)
+
+
+def call_profiled(fn, *args):
+    """
+    call_profiled calls fn, profiling it if the request
+    is being profiled - e.g from a to_thread worker.
+    """
+    state = REQUEST_STATE.get()
+    if state is None or state.profile is None:
+        return fn(*args)
+
+    with state.profile.enabled():
+        return fn(*args)
+
+
+def finish_profile(profile, resp):
+    state = REQUEST_STATE.get()
+    try:
+        path = PROFILER.write(profile, state.ctx.trace_id)
+    except OSError as exc:
+        logger.warn("couldn't write profile", tags={
+            "error": str(exc),
+        })
+        return
+
+    if path:
+        resp.add_log_tag("profile", path)
+
+
+class GatewayTimeout(BaseException):
     pass
 
 
-def application_with_timeout(wsgi_handler, resp):
+# Fraction of the deadline after which the
+# stack is logged, set in init_application.
+SLOW_REQUEST_FRACTION = 0.8
+
+# Innermost frames logged for a slow request
+SLOW_REQUEST_FRAMES = 32
+
+
+def watch_slow_request(deadline, get_stack):
+    """
+    watch_slow_request logs the request's stack if it is
+    still running SLOW_REQUEST_FRACTION of the way to its
+    deadline, so we see where it is stuck before the 504.
+    get_stack returns the request's StackSummary.
+    """
+    if not 0 < SLOW_REQUEST_FRACTION < 1:
+        return
+
+    # Logs with this request's trace_id
+    ctx = copy_context()
+    deadline.watch(
+        SLOW_REQUEST_FRACTION,
+        partial(ctx.run, log_slow_request, deadline, get_stack),
+    )
+
+
+def log_slow_request(deadline, get_stack):
+    stack = get_stack()
+    tags = {
+        "timeout.elapsed_ms": int((time() - deadline.start) * 1000),
+        "timeout.remaining_ms": int(deadline.remaining() * 1000),
+        "stack": [f"{f.filename}:{f.lineno} in {f.name}" for f in stack],
+    }
+
+    if stack:
+        tags["stack.line"] = stack[-1].line
+
+    logger.warn("slow request", tags=tags)
+
+
+def thread_stack(thread_id):
+    frame = _current_frames().get(thread_id)
+    if frame is None:
+        return StackSummary()
+
+    return extract_stack(frame, SLOW_REQUEST_FRAMES)
+
+
+def get_timeout(wsgi_environ, resp):
+    """
+    get_timeout returns the absolute request deadline,
+    or None if the request has been rejected.
+    """
     global logger
 
     # Is there an X-Timeout header in the request?
-    timeout_str = wsgi_handler.environ.get('HTTP_X_TIMEOUT')
-    now = int(time())
+    # It's an absolute unix time, possibly fractional.
+    timeout_str = wsgi_environ.get('HTTP_X_TIMEOUT')
+    now = time()
     timeout = None
 
     if timeout_str:
         try:
-            timeout = int(timeout_str)
+            timeout = float(timeout_str)
         except ValueError:
             logger.warn("invalid X-Timeout header")
             timeout = None
 
     if not timeout:
         try:
-            timeout = now + int(environ['WSGI_DRAGON_GATEWAY_TIMEOUT'])
+            timeout = now + float(environ['WSGI_DRAGON_GATEWAY_TIMEOUT'])
         except ValueError:
-            logger.warn("couldn't parse timeout as int")
+            logger.warn("couldn't parse timeout as float")
             timeout = now + 10
     else:
         # Check this timeout is actually in the future
-        # and we have at least five seconds for the request
-        if timeout < now + 5:
+        if timeout <= now:
             resp.set_bad_request("timeout is in the past")
             return
 
+    return timeout
+
+
+def application_with_timeout(wsgi_handler, resp):
+    timeout = get_timeout(wsgi_handler.environ, resp)
+    if timeout is None:
+        return
+
+    state = REQUEST_STATE.get()
+    deadline = DEADLINES.arm(timeout, GatewayTimeout)
+    state.deadline = deadline
+    watch_slow_request(deadline, partial(thread_stack, deadline.thread_id))
     try:
-        active = True
-        def sighandler(_sig_num, _frame):
-            if active:
-                raise TimeoutError
-
-        signal.signal(signal.SIGALRM, sighandler)
-        signal.alarm(timeout - now)
-        application_with_request(wsgi_handler, resp)
-    except TimeoutError:
+        try:
+            application_with_request(wsgi_handler, resp, deadline)
+        finally:
+            state.deadline = None
+            expired = DEADLINES.disarm(deadline)
+    except GatewayTimeout:
+        expired = True
+
+    # Also a handler which returned after its deadline
+    if expired:
         resp.set_timeout()
-    finally:
-        active = False
 
 
 def application_with_response(wsgi_handler, ctx, req_info):
@@ -387,14 +1201,20 @@ def application_with_response(wsgi_handler, ctx, req_info):
 
     try:
         application_with_timeout(wsgi_handler, resp)
+        finish_timings(resp)
 
         # Okay write the response
         wsgi_handler.start_response(resp.status_str(), resp.headers())
-        logger.info("request complete", tags={
-            **req_info,
-            **resp.log_tags(),
-        })
-        return resp.payload()
+
+        # A streamed body is logged once it's closed
+        payload = resp.payload(
+            wsgi_handler.environ.get('wsgi.file_wrapper'),
+            partial(log_request, resp, req_info),
+        )
+        if not isinstance(payload, ResponseStream):
+            log_request(resp, req_info)
+
+        return payload
 
     except Exception as exc:
         # Send back internal server error
@@ -410,48 +1230,59 @@ def application_with_response(wsgi_handler, ctx, req_info):
         return (b"",)
 
 
-def application_with_req_info(wsgi_handler, ctx):
-    global INNER_LOGGER
+def log_request(resp, req_info, stream_secs=None):
+    if stream_secs is not None:
+        state = REQUEST_STATE.get()
+        resp.add_log_tag("timing.stream_ms", round(stream_secs * 1000, 3))
+        if state:
+            resp.add_log_tag("timing.total_ms", round((perf_counter() - state.start) * 1000, 3))
+
+    if keep_request_log(resp):
+        logger.info_tags("request complete", req_info, resp.log_tags())
 
+
+def build_req_info(wsgi_environ):
     req_info = {
-        'http.method': wsgi_handler.environ['REQUEST_METHOD'],
-        'url.path': wsgi_handler.environ['PATH_INFO'],
-        'url.port': int(wsgi_handler.environ['SERVER_PORT']),
-        'url.host': wsgi_handler.environ['SERVER_NAME'],
+        'http.method': wsgi_environ['REQUEST_METHOD'],
+        'url.path': wsgi_environ['PATH_INFO'],
+        'url.port': int(wsgi_environ['SERVER_PORT']),
+        'url.host': wsgi_environ['SERVER_NAME'],
     }
 
-    if "CONTENT_TYPE" in wsgi_handler.environ:
-        req_info['http.content_type'] = wsgi_handler.environ['CONTENT_TYPE']
+    if "CONTENT_TYPE" in wsgi_environ:
+        req_info['http.content_type'] = wsgi_environ['CONTENT_TYPE']
 
-    if "CONTENT_LENGTH" in wsgi_handler.environ:
-        req_info['http.req_content_length'] = wsgi_handler.environ['CONTENT_LENGTH']
+    if "CONTENT_LENGTH" in wsgi_environ:
+        req_info['http.req_content_length'] = wsgi_environ['CONTENT_LENGTH']
 
     client = None
-    if 'HTTP_X_CLIENT' in wsgi_handler.environ:
-        client = wsgi_handler.environ['HTTP_X_CLIENT']
-    elif 'HTTP_USER_AGENT' in wsgi_handler.environ:
-        client = wsgi_handler.environ['HTTP_USER_AGENT']
+    if 'HTTP_X_CLIENT' in wsgi_environ:
+        client = wsgi_environ['HTTP_X_CLIENT']
+    elif 'HTTP_USER_AGENT' in wsgi_environ:
+        client = wsgi_environ['HTTP_USER_AGENT']
 
-    if client:
-        INNER_LOGGER.set_client(client)
+    REQUEST_STATE.get().client = client
 
-    return application_with_response(wsgi_handler, ctx, req_info)
+    return req_info
 
 
-def application_with_ctx(wsgi_handler):
-    global INNER_LOGGER, INNER_CALLER
+def application_with_req_info(wsgi_handler, ctx):
+    req_info = build_req_info(wsgi_handler.environ)
+    return application_with_response(wsgi_handler, ctx, req_info)
 
-    traceparent = wsgi_handler.environ.get("HTTP_TRACEPARENT")
-    (trace_id, parent_id) = (None, None)
+
+def build_ctx(wsgi_environ):
+    traceparent = wsgi_environ.get("HTTP_TRACEPARENT")
+    (trace_id, parent_id, flags) = (None, None, None)
 
     if traceparent:
         try:
-            (trace_id, parent_id) = parse_traceparent(traceparent)
+            (trace_id, parent_id, flags) = parse_traceparent(traceparent)
         except ValueError as exc:
-            logger.warn("invalid traceparent header", {
+            logger.warn("invalid traceparent header", tags={
                 "error": str(exc),
             })
-            (trace_id, parent_id) = (None, None)
+            (trace_id, parent_id, flags) = (None, None, None)
 
     if not trace_id:
         trace_id = randbytes(16).hex()
@@ -461,20 +1292,23 @@ def application_with_ctx(wsgi_handler):
         parent_id,
         # span_id
         randbytes(8).hex(),
+        flags,
     )
 
-    INNER_LOGGER.set_ctx(ctx)
-    INNER_CALLER.set_trace(ctx.trace_id, ctx.span_id)
+    REQUEST_STATE.get().ctx = ctx
+
+    return ctx
 
+
+def application_with_ctx(wsgi_handler):
+    ctx = build_ctx(wsgi_handler.environ)
     return application_with_req_info(wsgi_handler, ctx)
 
 
 def application_with_logger(wsgi_handler):
-    global INNER_LOGGER, logger
+    global logger
 
     try:
-        INNER_LOGGER.unset_ctx()
-        INNER_LOGGER.unset_client()
         return application_with_ctx(wsgi_handler)
     except Exception as exc:
         logger.exception("application crashed")
@@ -488,11 +1322,11 @@ def application_with_logger(wsgi_handler):
 def application(wsgi_handler):
     global INNER_CALLER
 
-    try:
-        # Clear out INNER_CALLER for
-        # a new request
-        INNER_CALLER.clear()
+    # Fresh state for this request only
+    state = RequestState()
+    token = REQUEST_STATE.set(state)
 
+    try:
         return application_with_logger(wsgi_handler)
     except Exception as exc:
         esend = wsgi_handler.environ['wsgi.errors']
@@ -504,15 +1338,158 @@ def application(wsgi_handler):
             ("Error", str(exc)),
         ])
         return (b"",)
-        
+    finally:
+        release_calls(state)
+        REQUEST_STATE.reset(token)
 
 
-def make_application(name, handler):
-    # Create the Logger
-    global INNER_LOGGER, INNER_CALLER
+def release_calls(state):
+    global INNER_CALLER
+
+    # Drop any calls this request didn't wait on
+    if state.call_ids:
+        INNER_CALLER.forget(list(state.call_ids))
+        state.call_ids.clear()
+
+
+# Log sampling, set in init_application
+LOG_SAMPLE_RATE = 1.0
+LOG_SLOW_SECS = 1.0
+
+# Server-Timing header, set in init_application
+SERVER_TIMING = False
+
+
+def sample_request(rate):
+    """
+    sample_request decides whether the request's INFO request
+    and call logs are kept. A rate of 1 keeps them all, else
+    the sampled flag of an incoming traceparent decides, else
+    a random sample is taken at rate. A rate of None uses
+    WSGI_DRAGON_LOG_SAMPLE_RATE.
+    """
+    state = REQUEST_STATE.get()
+    if not state or state.sampled is not None:
+        return
+
+    if rate is None:
+        rate = LOG_SAMPLE_RATE
+
+    if rate >= 1:
+        # Sampling is off
+        state.sampled = True
+    elif state.ctx and state.ctx.flags is not None:
+        state.sampled = is_sampled(state.ctx.flags)
+    else:
+        state.sampled = random() < rate
+
+
+def is_sampled(flags):
+    return bool(int(flags, 16) & 1)
+
+
+def set_route(name):
+    state = REQUEST_STATE.get()
+    if state:
+        state.route = name
+
+
+def keep_request_log(resp):
+    # Non 2xx and slow requests are always logged
+    status = resp.status_code()
+    if status is None or not 200 <= status.value[0] < 300:
+        return True
+
+    state = REQUEST_STATE.get()
+    if not state or perf_counter() - state.start >= LOG_SLOW_SECS:
+        return True
 
-    INNER_LOGGER = InnerLogger(name)
-    INNER_CALLER = InnerCaller(name)
+    # e.g not routed - fall back to the default rate
+    sample_request(None)
+    return state.sampled
+
+
+def keep_call_log(call_tags):
+    # Failed calls are always logged
+    if "error" in call_tags or not 200 <= call_tags.get("http.code", 0) < 300:
+        return True
+
+    state = REQUEST_STATE.get()
+    return not state or state.sampled is not False
+
+
+def init_application(name):
+    # Create the Logger and Caller, these are shared
+    # by the WSGI and ASGI entry points of an app.
+    global INNER_LOGGER, INNER_CALLER, LOG_SAMPLE_RATE, LOG_SLOW_SECS, SERVER_TIMING
+    global SLOW_REQUEST_FRACTION
+
+    if INNER_LOGGER and INNER_LOGGER.service_name == name:
+        return
+
+    try:
+        LOG_SAMPLE_RATE = float(environ['WSGI_DRAGON_LOG_SAMPLE_RATE'])
+    except ValueError:
+        LOG_SAMPLE_RATE = 1.0
+
+    try:
+        LOG_SLOW_SECS = float(environ['WSGI_DRAGON_LOG_SLOW_MS']) / 1000
+    except ValueError:
+        LOG_SLOW_SECS = 1.0
+
+    SERVER_TIMING = environ['WSGI_DRAGON_SERVER_TIMING'] == "1"
+    METRICS.init(environ['WSGI_DRAGON_METRICS_DIR'], name)
+
+    try:
+        profile_rate = float(environ['WSGI_DRAGON_PROFILE_RATE'])
+    except ValueError:
+        profile_rate = 0.0
+
+    PROFILER.init(environ['WSGI_DRAGON_PROFILE_DIR'], profile_rate)
+
+    try:
+        SLOW_REQUEST_FRACTION = float(environ['WSGI_DRAGON_SLOW_REQUEST_FRACTION'])
+    except ValueError:
+        SLOW_REQUEST_FRACTION = 0.8
+
+    try:
+        buffer_lines = int(environ['WSGI_DRAGON_LOG_BUFFER'])
+    except ValueError:
+        buffer_lines = 0
+
+    writer = make_writer(name, buffer_lines, environ['WSGI_DRAGON_LOG_OVERFLOW'])
+    INNER_LOGGER = InnerLogger(name, writer)
+    try:
+        pool_max_idle = int(environ['WSGI_DRAGON_POOL_MAX_IDLE'])
+    except ValueError:
+        pool_max_idle = 8
+
+    try:
+        pool_idle_timeout_ms = int(environ['WSGI_DRAGON_POOL_IDLE_TIMEOUT_MS'])
+    except ValueError:
+        pool_idle_timeout_ms = 4000
+
+    try:
+        pool_max_per_host = int(environ['WSGI_DRAGON_POOL_MAX_PER_HOST'])
+    except ValueError:
+        pool_max_per_host = 32
+
+    try:
+        pool_stream_idle_ms = int(environ['WSGI_DRAGON_POOL_STREAM_IDLE_MS'])
+    except ValueError:
+        pool_stream_idle_ms = 30000
+
+    INNER_CALLER = InnerCaller(
+        name,
+        pool_max_idle,
+        pool_idle_timeout_ms,
+        pool_max_per_host,
+        pool_stream_idle_ms,
+    )
+
+
+def make_application(name, handler):
+    init_application(name)
 
     def app(environ, start_response):
         wsgi_handler = WSGIHandler(environ, start_response, name, handler)
@@ -529,13 +1506,57 @@ def get_status_str(status):
     return f"{status.value[0]} {status.value[1]}"
 
 
+def get_content_length(environ):
+    try:
+        return int(environ['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        return None
+
+
 def get_headers(environ):
-    headers = []
-    for k, v in environ.items():
-        if k.startswith("HTTP_"):
-            headers.append((k[5:], v))
+    return Headers(environ)
+
+
+class Headers(Mapping):
+    """
+    Headers is a read only, case-insensitive view of the request
+    headers in the environ. Nothing is copied, a lookup goes
+    straight to the environ, e.g headers["X-Client"].
+    Iterating yields lowercase header names.
+    """
+
+    # WSGI doesn't prefix these with HTTP_
+    UNPREFIXED = ("CONTENT_TYPE", "CONTENT_LENGTH")
+
+    def __init__(self, environ):
+        self._environ = environ
+
+    def __getitem__(self, key):
+        return self._environ[environ_key(key)]
+
+    def __contains__(self, key):
+        return isinstance(key, str) and environ_key(key) in self._environ
+
+    def __iter__(self):
+        for k in self._environ:
+            if k.startswith("HTTP_"):
+                yield k[5:].replace("_", "-").lower()
+            elif k in self.UNPREFIXED:
+                yield k.replace("_", "-").lower()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Headers({dict(self.items())!r})"
+
+
+def environ_key(header):
+    key = header.upper().replace("-", "_")
+    if key in Headers.UNPREFIXED:
+        return key
 
-    return headers
+    return "HTTP_" + key
 
 
 def parse_traceparent(traceparent):
@@ -557,10 +1578,11 @@ def parse_traceparent(traceparent):
     if len(parent_id) != 16 or not is_hexstring(parent_id):
         raise ValueError("invalid parent_id")
 
-    if len(parts[3]) != 2:
+    flags = parts[3].lower()
+    if len(flags) != 2 or not is_hexstring(flags):
         raise ValueError("invalid flags")
 
-    return (trace_id, parent_id)
+    return (trace_id, parent_id, flags)
 
 
 def is_hexstring(s):
@@ -0,0 +1,251 @@
+"""
+Request deadlines, checked at safe points rather than raised
+asynchronously - work between them isn't interrupted. ASGI
+requests are cancelled on the event loop.
+"""
+
+import asyncio
+import os
+import threading
+from heapq import heapify, heappush, heappop
+from itertools import count
+from time import time
+from traceback import print_exc
+
+
+class Deadline:
+    def __init__(self, scheduler, at, thread_id, exc, callback=None):
+        self._scheduler = scheduler
+        self.start = time()
+        self.at = at
+        self.thread_id = thread_id
+        self.exc = exc
+        self.callback = callback
+        self.armed = True
+        self.fired = False
+        self._entry = None
+
+        # Optional watchdog which fires at a fraction
+        # of the way to this deadline, see watch.
+        self.watchdog = None
+        self.fraction = None
+
+    def remaining(self):
+        """
+        remaining returns the seconds left before the deadline.
+        """
+        return self.at - time()
+
+    def expired(self):
+        return time() >= self.at
+
+    def check(self):
+        """
+        check raises exc if the deadline has passed. It's called
+        at safe points, e.g placing or waiting on a call.
+        """
+        if self.armed and self.expired():
+            self.fired = True
+            raise self.exc
+
+    def tighten(self, at):
+        """
+        tighten moves the deadline earlier, it
+        never extends an existing deadline.
+        """
+        if at < self.at:
+            if self.watchdog:
+                watchdog = self.watchdog
+                watchdog.tighten(self.start + (at - self.start) * watchdog.fraction)
+
+            self._scheduler.reschedule(self, at)
+
+    def watch(self, fraction, callback):
+        """
+        watch calls callback once fraction of the time to
+        the deadline has passed, unless disarmed first.
+        """
+        at = self.start + (self.at - self.start) * fraction
+        self.watchdog = self._scheduler.watch(at, callback)
+        self.watchdog.fraction = fraction
+
+
+class DeadlineScheduler:
+    def __init__(self):
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            # prefork servers import the application before
+            # forking - the scheduler thread isn't inherited.
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = count()
+        self._thread = None
+
+    def arm(self, at, exc):
+        """
+        arm returns a deadline for the calling thread,
+        its check raises exc once at has passed.
+        """
+        return Deadline(self, at, threading.get_ident(), exc)
+
+    def watch(self, at, callback):
+        """
+        watch calls callback, on a thread of its own,
+        at time at unless disarm is called first.
+        """
+        deadline = Deadline(self, at, threading.get_ident(), None, callback)
+
+        with self._cond:
+            self._push(deadline)
+            self._start()
+
+        return deadline
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run,
+                name="wsgidragon_deadline",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def reschedule(self, deadline, at):
+        with self._cond:
+            if not deadline.armed:
+                return
+
+            self._remove(deadline)
+            deadline.at = at
+            if deadline.callback is not None:
+                self._push(deadline)
+
+    def disarm(self, deadline):
+        """
+        disarm cancels the deadline and its watchdog.
+        It returns True if the deadline had passed.
+        """
+        with self._cond:
+            if deadline.watchdog:
+                deadline.watchdog.armed = False
+                self._remove(deadline.watchdog)
+
+            deadline.armed = False
+            self._remove(deadline)
+
+        return deadline.fired or deadline.expired()
+
+    def _push(self, deadline):
+        deadline._entry = (deadline.at, next(self._seq), deadline)
+        heappush(self._heap, deadline._entry)
+        self._cond.notify()
+
+    def _remove(self, deadline):
+        entry = deadline._entry
+        deadline._entry = None
+        if entry is not None:
+            self._heap.remove(entry)
+            heapify(self._heap)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                heap = self._heap
+                if not heap:
+                    self._cond.wait()
+                    continue
+
+                wait = heap[0][0] - time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                (_, _, deadline) = heappop(heap)
+                deadline._entry = None
+                deadline.armed = False
+                deadline.fired = True
+
+                # A slow callback never holds up the
+                # scheduler, or another callback.
+                threading.Thread(
+                    target=run_callback,
+                    args=(deadline.callback,),
+                    name="wsgidragon_watchdog",
+                    daemon=True,
+                ).start()
+
+
+class TaskDeadlineScheduler:
+    """
+    TaskDeadlineScheduler is the asyncio counterpart of
+    DeadlineScheduler, it cancels the request's task
+    rather than raising in a thread.
+    """
+    def arm(self, at, exc):
+        deadline = Deadline(self, at, None, exc)
+        deadline.task = asyncio.current_task()
+        deadline.cancelled = False
+        deadline.handle = self._schedule(deadline)
+
+        return deadline
+
+    def watch(self, at, callback):
+        """
+        watch calls callback, on the event loop,
+        at time at unless disarm is called first.
+        """
+        deadline = Deadline(self, at, None, None, callback)
+        deadline.task = asyncio.current_task()
+        deadline.cancelled = False
+        deadline.handle = self._schedule(deadline)
+
+        return deadline
+
+    def reschedule(self, deadline, at):
+        if not deadline.armed:
+            return
+
+        deadline.handle.cancel()
+        deadline.at = at
+        deadline.handle = self._schedule(deadline)
+
+    def disarm(self, deadline):
+        if deadline.watchdog:
+            self.disarm(deadline.watchdog)
+
+        deadline.armed = False
+        deadline.handle.cancel()
+        if deadline.cancelled and hasattr(deadline.task, "uncancel"):
+            deadline.task.uncancel()
+
+        return deadline.fired or deadline.expired()
+
+    def _schedule(self, deadline):
+        loop = asyncio.get_running_loop()
+        return loop.call_later(max(deadline.at - time(), 0), self._fire, deadline)
+
+    def _fire(self, deadline):
+        if not deadline.armed:
+            return
+
+        deadline.armed = False
+        deadline.fired = True
+        if deadline.callback is None:
+            deadline.cancelled = True
+            deadline.task.cancel()
+        else:
+            deadline.callback()
+
+
+def run_callback(callback):
+    try:
+        callback()
+    except Exception:
+        print_exc()
+
+
+DEADLINES = DeadlineScheduler()
+TASK_DEADLINES = TaskDeadlineScheduler()
@@ -1,5 +1,6 @@
 from .routes import (
     make_application,
+    make_asgi_application,
     add_route,
 )
 from .api import JsonApi, BadCode, Api
@@ -16,6 +17,9 @@ class DragonApp:
         self._app = make_application(name)
         self.name = name
 
+        # ASGI entry point - e.g uvicorn service:application.asgi
+        self.asgi = make_asgi_application(name)
+
     def __call__(self, environ, start_response):
         return self._app(environ, start_response)
 
@@ -27,16 +31,51 @@ class DragonApp:
             request_schema=None,
             response_schema=None,
             status_codes=None,
-            api=None):
+            api=None,
+            timeout=None,
+            max_body_size=None,
+            log_sample_rate=None):
 
         api = api or Api
         assert methods, "empty methods not allowed"
         assert isinstance(path, tuple), "path must be a tuple or namedtuple"
         assert issubclass(api, Api), "api must be Api subclass"
+        assert timeout is None or timeout > 0, "timeout must be positive"
+        assert max_body_size is None or max_body_size > 0, "max_body_size must be positive"
+        assert log_sample_rate is None or 0 <= log_sample_rate <= 1, "log_sample_rate must be in [0, 1]"
         status_codes = status_codes or [StatusCode.OK]
 
-        api = api(self.name, methods, path, param_schema, request_schema, response_schema, status_codes)
+        api = api(self.name,
+                  methods,
+                  path,
+                  param_schema,
+                  request_schema,
+                  response_schema,
+                  status_codes,
+                  timeout=timeout,
+                  max_body_size=max_body_size,
+                  log_sample_rate=log_sample_rate)
         add_route(methods, path, api, handler)
 
-    def add_json(self, handler, methods=None, path=None, request_schema=None, response_schema=None, param_schema=None, status_codes=None):
-        self.add(handler, methods, path, param_schema, request_schema, response_schema, status_codes, JsonApi)
+    def add_json(self,
+                 handler,
+                 methods=None,
+                 path=None,
+                 request_schema=None,
+                 response_schema=None,
+                 param_schema=None,
+                 status_codes=None,
+                 timeout=None,
+                 max_body_size=None,
+                 log_sample_rate=None):
+        self.add(handler,
+                 methods,
+                 path,
+                 param_schema,
+                 request_schema,
+                 response_schema,
+                 status_codes,
+                 JsonApi,
+                 timeout=timeout,
+                 max_body_size=max_body_size,
+                 log_sample_rate=log_sample_rate)
@@ -5,8 +5,56 @@ import os
 
 REGISTERED_VARS = [
     ("WSGI_DRAGON_GATEWAY_TIMEOUT", "10",
-     "Gateway Timeout is the time waited to handle a request before 504 Gateway Timeout is returned." +
+     "Gateway Timeout is the time in seconds (fractional allowed) waited to handle a request" +
+     " before 504 Gateway Timeout is returned. It's checked when a call is placed or waited" +
+     " on, and once the handler returns." +
      " This value will be ignored if X-Timeout header is sent in the request."),
+    ("WSGI_DRAGON_MAX_BODY_SIZE", "1048576",
+     "Max Body Size is the largest request body in bytes accepted by a route, unless the route" +
+     " sets its own max_body_size. Larger bodies are rejected with 413 Payload Too Large." +
+     " ASGI applications never buffer more than the route's limit."),
+    ("WSGI_DRAGON_LOG_BUFFER", "0",
+     "Log Buffer is the number of log lines queued for a background writer which writes them" +
+     " to stdout in batches. 0 writes every line synchronously."),
+    ("WSGI_DRAGON_LOG_OVERFLOW", "drop",
+     "Log Overflow is what happens when the log buffer is full, either drop (lines are dropped" +
+     " and counted in a log lines dropped message) or block."),
+    ("WSGI_DRAGON_LOG_SAMPLE_RATE", "1",
+     "Log Sample Rate is the fraction of requests whose request complete and call complete" +
+     " lines are logged, unless the route sets its own log_sample_rate. Below 1 the sampled flag" +
+     " of an incoming traceparent decides instead. Incoming flags are passed on unchanged." +
+     " Errors, non 2xx and slow requests are always logged."),
+    ("WSGI_DRAGON_LOG_SLOW_MS", "1000",
+     "Log Slow is the duration in milliseconds after which a request is always logged."),
+    ("WSGI_DRAGON_SERVER_TIMING", "0",
+     "Server Timing set to 1 adds a Server-Timing header with the time spent in each phase" +
+     " of the request. The timings are always logged on request complete."),
+    ("WSGI_DRAGON_METRICS_DIR", "",
+     "Metrics Dir is where each worker records its metrics for the metrics endpoint, every" +
+     " worker of a server must share it. Metrics are only recorded if it's set, empty it" +
+     " whenever the server starts."),
+    ("WSGI_DRAGON_METRICS_PATH", "/metrics",
+     "Metrics Path is where the metrics are served, unless a route is registered there." +
+     " Empty disables the endpoint."),
+    ("WSGI_DRAGON_PROFILE_DIR", "",
+     "Profile Dir enables profiling. Requests with an X-Profile: 1 header, or randomly sampled" +
+     " at the profile rate, are run under cProfile and the stats written here as <trace_id>.prof"),
+    ("WSGI_DRAGON_PROFILE_RATE", "0",
+     "Profile Rate is the fraction of requests profiled when Profile Dir is set."),
+    ("WSGI_DRAGON_SLOW_REQUEST_FRACTION", "0.8",
+     "Slow Request Fraction is how far through its timeout a request may run before its stack" +
+     " is logged in a slow request warning. Set to 0 to disable."),
+    ("WSGI_DRAGON_POOL_MAX_IDLE", "8",
+     "Pool Max Idle is the number of idle keep-alive connections kept per upstream host."),
+    ("WSGI_DRAGON_POOL_IDLE_TIMEOUT_MS", "4000",
+     "Pool Idle Timeout is how long, in milliseconds, an idle connection is kept. Keep it below" +
+     " the upstream's own keep-alive timeout."),
+    ("WSGI_DRAGON_POOL_MAX_PER_HOST", "32",
+     "Pool Max Per Host caps the connections open to each upstream host, further calls queue" +
+     " until one is free."),
+    ("WSGI_DRAGON_POOL_STREAM_IDLE_MS", "30000",
+     "Pool Stream Idle is how long, in milliseconds, a streamed body may go without more of it" +
+     " arriving before the call fails. A stream waiting on its reader doesn't idle out."),
 ]
 
 REGISTERED_VARS.sort(key=lambda x: x[0])
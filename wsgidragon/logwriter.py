@@ -0,0 +1,162 @@
+"""
+Log writers. InnerLogger hands each JSON line to a writer,
+either written straight to stdout or buffered and written
+in batches by a background thread.
+"""
+
+import atexit
+import json as js
+import os
+import sys
+import threading
+from datetime import datetime
+from queue import Queue, Full, Empty
+
+
+# Seconds close waits for queued lines to be written
+CLOSE_TIMEOUT = 5
+
+
+class SyncWriter:
+    def write(self, line):
+        print(line)
+
+
+class BufferedWriter:
+    """
+    BufferedWriter queues log lines for a background thread,
+    which writes them to stdout in batches. When the queue is
+    full lines are either dropped and counted, or the caller
+    blocks, depending on the overflow policy. Once closed lines
+    are written straight to stdout.
+    """
+    def __init__(self, service_name, max_lines, block=False, batch_size=256):
+        self.service_name = service_name
+        self.max_lines = max_lines
+        self.block = block
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._reset()
+
+        atexit.register(self.close)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = Queue(self.max_lines)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._reported = self.dropped
+
+    def write(self, line):
+        if self._closed:
+            # e.g logged by a later atexit handler
+            self._write_lines([line])
+            return
+
+        if self._thread is None:
+            self._start()
+
+        try:
+            self._queue.put(line, block=self.block)
+        except Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self):
+        """
+        flush writes the queued lines from the calling thread,
+        in batches, until the queue is empty.
+        """
+        while True:
+            lines = self._drain([])
+            self._write_lines([line for line in lines if line is not None])
+            if len(lines) < self.batch_size:
+                return
+
+    def close(self):
+        """
+        close stops the background thread once it has written
+        the lines queued so far, then flushes any stragglers.
+        """
+        with self._lock:
+            thread = self._thread
+            self._closed = True
+
+        if thread is not None:
+            try:
+                # None tells the thread to stop
+                self._queue.put(None, timeout=CLOSE_TIMEOUT)
+            except Full:
+                pass
+            else:
+                thread.join(CLOSE_TIMEOUT)
+
+        self.flush()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(
+                target=self._run,
+                name="wsgidragon_logwriter",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            lines = self._drain([self._queue.get()])
+            if None in lines:
+                # Stopped by close
+                self._write_lines([line for line in lines if line is not None])
+                return
+
+            self._write_lines(lines)
+
+    def _drain(self, lines):
+        try:
+            while len(lines) < self.batch_size:
+                lines.append(self._queue.get_nowait())
+        except Empty:
+            pass
+
+        return lines
+
+    def _write_lines(self, lines):
+        with self._lock:
+            (count, total) = (self.dropped - self._reported, self.dropped)
+            self._reported = total
+
+        if count:
+            lines.append(self._dropped_line(count, total))
+
+        if not lines:
+            return
+
+        out = sys.stdout
+        out.write("\n".join(lines) + "\n")
+        out.flush()
+
+    def _dropped_line(self, count, total):
+        return js.dumps({
+            "service": self.service_name,
+            "ts": datetime.utcnow().isoformat(),
+            "level": "WARN",
+            "msg": "log lines dropped",
+            "log.dropped": count,
+            "log.dropped_total": total,
+        }, separators=(",", ":"))
+
+
+def make_writer(service_name, buffer_lines, overflow):
+    if buffer_lines <= 0:
+        return SyncWriter()
+
+    if overflow not in ("drop", "block"):
+        raise ValueError(f"unknown log overflow policy {overflow}")
+
+    return BufferedWriter(service_name, buffer_lines, block=overflow == "block")
@@ -0,0 +1,244 @@
+"""
+Request and call metrics. Each thread of each worker records
+into its own mmap backed file, so recording takes no lock. The
+metrics endpoint sums every file.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from math import inf
+
+
+INITIAL_SIZE = 64 * 1024
+
+# Upper bounds (seconds) of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, inf)
+
+HELP = {
+    "wsgidragon_requests_total": ("counter", "Requests by route and status."),
+    "wsgidragon_request_seconds": ("histogram", "Request latency by route."),
+    "wsgidragon_calls_total": ("counter", "Calls by upstream host and status."),
+    "wsgidragon_call_seconds": ("histogram", "Call latency by upstream host."),
+}
+
+USED = struct.Struct("q")
+KEY_LEN = struct.Struct("i")
+VALUE = struct.Struct("d")
+
+
+class MetricsFile:
+    """
+    MetricsFile is an append only table of (key, float)
+    entries in an mmap, written by a single thread. The
+    first 8 bytes hold the bytes used, updated only once
+    an entry is complete, so readers in other processes
+    never see a torn entry.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "a+b")
+        if os.fstat(self._f.fileno()).st_size < INITIAL_SIZE:
+            self._f.truncate(INITIAL_SIZE)
+
+        self._map()
+        self._used = USED.unpack_from(self._m, 0)[0] or USED.size
+        self._offsets = {
+            key: offset for (key, offset, _) in read_entries(self._m, self._used)
+        }
+
+    def _map(self):
+        size = os.fstat(self._f.fileno()).st_size
+        self._m = mmap.mmap(self._f.fileno(), size)
+
+    def inc(self, key, amount=1.0):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._add(key)
+
+        m = self._m
+        VALUE.pack_into(m, offset, VALUE.unpack_from(m, offset)[0] + amount)
+
+    def _add(self, key):
+        encoded = key.encode()
+        offset = align(self._used + KEY_LEN.size + len(encoded))
+        used = offset + VALUE.size
+
+        if used > len(self._m):
+            self._m.close()
+            self._f.truncate(max(used, 2 * os.fstat(self._f.fileno()).st_size))
+            self._map()
+
+        m = self._m
+        KEY_LEN.pack_into(m, self._used, len(encoded))
+        m[self._used + KEY_LEN.size:self._used + KEY_LEN.size + len(encoded)] = encoded
+        VALUE.pack_into(m, offset, 0.0)
+
+        # Publish the entry
+        USED.pack_into(m, 0, used)
+        self._used = used
+        self._offsets[key] = offset
+
+        return offset
+
+
+def align(n):
+    return (n + 7) & ~7
+
+
+def read_entries(m, used):
+    pos = USED.size
+    while pos + KEY_LEN.size <= used:
+        (n,) = KEY_LEN.unpack_from(m, pos)
+        offset = align(pos + KEY_LEN.size + n)
+        if n < 0 or offset + VALUE.size > used:
+            # Cut off, the file grew after we mapped it
+            return
+
+        key = m[pos + KEY_LEN.size:pos + KEY_LEN.size + n].decode()
+        yield (key, offset, VALUE.unpack_from(m, offset)[0])
+        pos = offset + VALUE.size
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < USED.size:
+            return []
+
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+            used = min(USED.unpack_from(m, 0)[0], size)
+            return [(key, val) for (key, _, val) in read_entries(m, used)]
+
+
+class Metrics:
+    def __init__(self):
+        self.directory = None
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            # Children must never write to the parent's files
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+        # (prefix, label value, status) -> keys
+        self._keys = {}
+
+    def init(self, directory, service_name):
+        """
+        init sets the directory the metrics files are kept
+        in, metrics aren't recorded without one.
+        """
+        if not directory:
+            self.directory = None
+            return
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.directory = directory
+
+    def _file(self):
+        # A thread which has gone leaves its file, the
+        # counts in it are still summed. A new thread
+        # with its id appends to it.
+        f = getattr(self._local, "f", None)
+        if f is None:
+            name = f"{os.getpid()}_{threading.get_native_id()}.db"
+            f = self._local.f = MetricsFile(os.path.join(self.directory, name))
+
+        return f
+
+    def observe_request(self, route, status, secs):
+        self._observe("wsgidragon_request", "route", route, status, secs)
+
+    def observe_call(self, host, status, secs):
+        self._observe("wsgidragon_call", "host", host, status, secs)
+
+    def _observe(self, prefix, label, value, status, secs):
+        if self.directory is None:
+            return
+
+        keys = self._keys.get((prefix, value, status))
+        if keys is None:
+            keys = self._keys[(prefix, value, status)] = build_keys(prefix, label, value, status)
+
+        (total, total_sum, count, buckets) = keys
+
+        f = self._file()
+        f.inc(total)
+        f.inc(total_sum, secs)
+        f.inc(count)
+
+        # Buckets are stored non-cumulative, so
+        # an observation is a single increment.
+        for (le, key) in buckets:
+            if secs <= le:
+                f.inc(key)
+                break
+
+    def render(self):
+        """
+        render returns the metrics of every worker,
+        in the Prometheus text format.
+        """
+        totals = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".db"):
+                continue
+
+            try:
+                entries = read_file(os.path.join(self.directory, name))
+            except (OSError, ValueError, struct.error):
+                # e.g removed while we were reading
+                continue
+
+            for (key, val) in entries:
+                totals[key] = totals.get(key, 0.0) + val
+
+        samples = {}
+        buckets = {}
+        for (key, val) in totals.items():
+            (name, labels, *le) = key.split("\0")
+            if le:
+                buckets.setdefault((name, labels), {})[float(le[0])] = val
+            else:
+                samples.setdefault(name, []).append((labels, val))
+
+        for ((name, labels), counts) in buckets.items():
+            cumulative = 0.0
+            for le in LATENCY_BUCKETS:
+                cumulative += counts.get(le, 0.0)
+                le = "+Inf" if le == inf else repr(le)
+                samples.setdefault(name, []).append((f'{labels},le="{le}"', cumulative))
+
+        lines = []
+        for (metric, (kind, doc)) in HELP.items():
+            lines.append(f"# HELP {metric} {doc}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name in sorted(n for n in samples if n.startswith(metric)):
+                for (labels, val) in samples[name]:
+                    lines.append(f"{name}{{{labels}}} {format_value(val)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def build_keys(prefix, label, value, status):
+    labels = f'{label}="{escape(value)}"'
+    return (
+        f'{prefix}s_total\0{labels},status="{status}"',
+        f"{prefix}_seconds_sum\0{labels}",
+        f"{prefix}_seconds_count\0{labels}",
+        [(le, f"{prefix}_seconds_bucket\0{labels}\0{le}") for le in LATENCY_BUCKETS],
+    )
+
+
+def format_value(val):
+    return str(int(val)) if val.is_integer() else repr(val)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Metrics()
@@ -0,0 +1,118 @@
+"""
+Typed path segments. A route path may contain these
+in place of a literal string, for example
+
+    UserPath = namedtuple("UserPath", ("users", "user_id"))
+    app.add(handler, methods=["GET"], path=UserPath("users", Int()))
+
+The handler is then passed UserPath("users", 42).
+"""
+
+import re
+from abc import ABC, abstractmethod
+from uuid import UUID
+
+
+__all__ = [
+    "Segment",
+    "Int",
+    "Uuid",
+    "Hex",
+    "Regex",
+]
+
+
+class Segment(ABC):
+    """
+    Segment is the base class of all typed path segments.
+    convert must return the decoded value or raise ValueError.
+    """
+    name = "segment"
+
+    @abstractmethod
+    def convert(self, part):
+        pass
+
+    def key(self):
+        return (self.__class__,)
+
+    def __eq__(self, other):
+        return isinstance(other, Segment) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        return "{" + self.name + "}"
+
+
+class Int(Segment):
+    name = "int"
+
+    def convert(self, part):
+        if not part.isdigit() or not part.isascii():
+            raise ValueError("expected an integer")
+
+        return int(part)
+
+
+# Only the canonical 8-4-4-4-12 form, UUID() takes others
+UUID_RE = re.compile("[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+class Uuid(Segment):
+    name = "uuid"
+
+    def convert(self, part):
+        if not UUID_RE.fullmatch(part):
+            raise ValueError("expected a uuid")
+
+        return UUID(part)
+
+
+class Hex(Segment):
+    name = "hex"
+
+    def __init__(self, length=None):
+        self.length = length
+
+    def convert(self, part):
+        if self.length is not None and len(part) != self.length:
+            raise ValueError(f"expected hexstring of length {self.length}")
+
+        part = part.lower()
+        if not part or not is_hexstring(part):
+            raise ValueError("expected a hexstring")
+
+        return part
+
+    def key(self):
+        return (self.__class__, self.length)
+
+
+class Regex(Segment):
+    name = "regex"
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._regex = re.compile(pattern)
+
+    def convert(self, part):
+        if not self._regex.fullmatch(part):
+            raise ValueError(f"doesn't match {self.pattern}")
+
+        return part
+
+    def key(self):
+        return (self.__class__, self.pattern)
+
+    def __str__(self):
+        return "{" + self.pattern + "}"
+
+
+def is_hexstring(s):
+    for c in s:
+        if c not in "0123456789abcdef":
+            return False
+
+    return True
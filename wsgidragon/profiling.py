@@ -0,0 +1,102 @@
+"""
+Request profiling. When WSGI_DRAGON_PROFILE_DIR is set a
+request is run under cProfile if it has an X-Profile: 1
+header, or is randomly sampled. The stats are written to
+the directory as <trace_id>.prof
+"""
+
+import cProfile
+import os
+import pstats
+import threading
+from contextlib import contextmanager
+from random import random
+
+
+class RequestProfile:
+    """
+    RequestProfile profiles a request in every thread
+    it runs in, e.g a sync handler run by to_thread.
+    """
+    def __init__(self):
+        self.profiles = []
+
+    @contextmanager
+    def enabled(self):
+        """
+        enabled profiles its block in the calling thread.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # e.g a debugger is using the profiling hooks, or
+            # this request is already profiled in every thread.
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.profiles.append(profile)
+
+
+class Profiler:
+    def __init__(self):
+        self.directory = None
+        self.rate = 0.0
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Only one request can be profiled in a process
+        self._lock = threading.Lock()
+
+    def init(self, directory, rate):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory or None
+        self.rate = rate
+
+    @contextmanager
+    def profiling(self, wsgi_environ):
+        """
+        profiling yields a RequestProfile if this request should
+        be profiled. None is yielded if not, or if another request
+        is already being profiled.
+        """
+        if self.directory is None:
+            yield None
+            return
+
+        if wsgi_environ.get("HTTP_X_PROFILE") != "1" and random() >= self.rate:
+            yield None
+            return
+
+        if not self._lock.acquire(blocking=False):
+            yield None
+            return
+
+        try:
+            yield RequestProfile()
+        finally:
+            self._lock.release()
+
+    def write(self, request_profile, trace_id):
+        """
+        write writes the stats and returns their path,
+        or None if nothing was profiled.
+        """
+        if not request_profile.profiles:
+            return
+
+        path = os.path.join(self.directory, f"{trace_id}.prof")
+        pstats.Stats(*request_profile.profiles).dump_stats(path)
+
+        return path
+
+
+PROFILER = Profiler()
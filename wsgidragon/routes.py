@@ -1,13 +1,27 @@
+import asyncio
 from collections import namedtuple
+from inspect import iscoroutinefunction
+from time import time
 
 from .base import (
     make_application as base_make_application,
+    REQUEST_STATE,
+    ProxiedStatus,
     StatusCode,
+    call_profiled,
     logger,
+    sample_request,
+    set_route,
+    timed,
 )
-from .api import Api, BadCode
+from .metrics import METRICS
+from .asgi import make_asgi_application as base_make_asgi_application
+from .api import Api, BadCode, BodyTooLarge
 from .dochandler import doc_handler
+from .envvar import environ
 from .jsonschema import ValidationError
+from .paramschema import ParamError
+from .pathsegment import Segment
 
 
 DragonRequest = namedtuple("DragonRequest", (
@@ -24,76 +38,257 @@ Route = namedtuple("Route", (
     "clb",
 ))
 
+class RouteNode:
+    """
+    RouteNode is a single level of the route trie, children
+    are keyed by the literal path segment or typed Segment.
+    """
+    def __init__(self):
+        self.children = {}
+        self.segments = {}
+        self.route = None
+
+
+class RouteIndex:
+    """
+    RouteIndex compiles registered routes into a segment
+    trie, keyed first by the number of path segments.
+    Literal segments are a dictionary lookup and take
+    precedence over typed segments at the same level.
+    """
+    def __init__(self):
+        self._roots = {}
+
+    def add(self, route):
+        node = self._roots.setdefault(len(route.path), RouteNode())
+        for segm in route.path:
+            if isinstance(segm, Segment):
+                node = node.segments.setdefault(segm, RouteNode())
+            else:
+                node = node.children.setdefault(segm, RouteNode())
+
+        # The first registered route wins - as it
+        # did when we scanned the routes in order
+        if node.route is None:
+            node.route = route
+
+    def lookup(self, path_parts):
+        """
+        lookup returns the matched route and the decoded
+        path values, or None if no route matches.
+        """
+        node = self._roots.get(len(path_parts))
+        if node is None:
+            return
+
+        return lookup_node(node, path_parts, 0, [])
+
+    def clear(self):
+        self._roots.clear()
+
+
+def lookup_node(node, path_parts, n, values):
+    if n == len(path_parts):
+        if node.route is None:
+            return
+
+        return (node.route, values)
+
+    part = path_parts[n]
+    child = node.children.get(part)
+    if child is not None:
+        found = lookup_node(child, path_parts, n + 1, values + [part])
+        if found:
+            return found
+
+    for (segm, child) in node.segments.items():
+        try:
+            value = segm.convert(part)
+        except ValueError:
+            continue
+
+        found = lookup_node(child, path_parts, n + 1, values + [value])
+        if found:
+            return found
+
+
 ROUTES = []
+ROUTE_INDEX = RouteIndex()
 
 def add_route(methods, path, api, clb):
-    global ROUTES
+    global ROUTES, ROUTE_INDEX
     if methods and "OPTIONS" in methods:
         raise RuntimeError("can't register OPTIONS method")
 
+    route = Route(methods, compile_path(path), api, clb)
+    ROUTES.append(route)
+    ROUTE_INDEX.add(route)
 
-    ROUTES.append(Route(methods, path, api, clb))
 
-
-def route_handler(request, response):
-    global ROUTES
+def match_route(request, response):
+    """
+    match_route handles everything up to calling the handler.
+    It returns (path, api, clb) if the handler should be
+    called, otherwise the response is already complete.
+    """
+    global ROUTES, ROUTE_INDEX
 
     if request.path.startswith("/doc") and request.method == "GET":
         # return the documentation
         doc_handler(request, response, ROUTES)
         return
 
-    for (methods, path, api, clb) in ROUTES:
-        path = build_path(path, request.path.split('/')[1:])
-        if path:
-            # Log the path components
-            for n, p in enumerate(path):
-                response.add_log_tag(f"url.path.{n}", p)
-
-            if request.method == "OPTIONS":
-                schema_handler(path, response, api)
-            elif request.method in methods:
-                clb_handler(path, request, response, api, clb)
-            else:
-                response.set_not_found()
+    path_parts = request.path.split('/')[1:]
+    found = lookup_route(request.path, path_parts)
+    if found is None:
+        if (request.method == "GET" and METRICS.directory
+                and request.path == environ['WSGI_DRAGON_METRICS_PATH']):
+            set_route(request.path)
+            metrics_handler(response)
+            return
+
+        response.set_not_found()
+        return
+
+    ((methods, path, api, clb), values) = found
+
+    set_route("/" + api.name)
+    sample_request(api.log_sample_rate)
+
+    # Routes may have a tighter deadline than the gateway
+    if api.timeout:
+        request.deadline.tighten(time() + api.timeout)
 
-            # break due to path matched
-            break
+    path = build_path(path, values)
+
+    # Log the raw path components
+    for n, p in enumerate(path_parts):
+        response.add_log_tag(f"url.path.{n}", p)
+
+    if request.method == "OPTIONS":
+        schema_handler(path, request, response, api)
+    elif request.method in methods:
+        return (path, api, clb)
     else:
         response.set_not_found()
 
 
+def metrics_handler(response):
+    response.set_status(StatusCode.OK)
+    response.set_body(
+        "text/plain; version=0.0.4",
+        METRICS.render().encode(),
+    )
+
+
+def route_handler(request, response):
+    matched = match_route(request, response)
+    if matched:
+        clb_handler(*matched, request, response)
+
+
+async def async_route_handler(request, response):
+    matched = match_route(request, response)
+    if matched:
+        await async_clb_handler(*matched, request, response)
+
+
 def make_application(name):
     return base_make_application(name, route_handler)
 
 
-def build_path(path, path_parts):
-    if len(path) != len(path_parts):
-        return
+def make_asgi_application(name):
+    return base_make_asgi_application(name, async_route_handler, route_body_limit)
 
-    for (a, b) in zip(path, path_parts):
-        if not check_regex(a, b):
-            return
 
-    # Okay - we need to build the path
+def route_body_limit(method, path):
+    # The route's limit applies before its body is buffered
+    found = lookup_route(path, path.split('/')[1:])
+    if found is None:
+        return int(environ['WSGI_DRAGON_MAX_BODY_SIZE'])
+
+    return found[0].api.max_body_size
+
+
+def lookup_route(path, path_parts):
+    """
+    lookup_route looks up the request's route once,
+    later lookups of the same path reuse the match.
+    """
+    global ROUTE_INDEX
+
+    state = REQUEST_STATE.get()
+    if state and state.route_lookup and state.route_lookup[0] == path:
+        return state.route_lookup[1]
+
+    found = ROUTE_INDEX.lookup(path_parts)
+    if state:
+        state.route_lookup = (path, found)
+
+    return found
+
+
+def compile_path(path):
+    """
+    compile_path checks every segment of a route path
+    is either a literal string or a typed Segment.
+    """
+    for segm in path:
+        if not isinstance(segm, (str, Segment)):
+            raise TypeError(f"invalid path segment {segm!r}")
+
+    return path
+
+
+def build_path(path, values):
+    # values have already been matched
+    # and decoded by the route index
     if type(path) is tuple:
-        return tuple(path_parts)
+        return tuple(values)
 
     # It's a namedtuple
-    return path.__class__(*path_parts)
-        
+    return path.__class__(*values)
 
-def check_regex(a, b):
-    return a == b
 
+def schema_handler(path, request, response, api):
+    (schema, etag) = api.schema_json(path)
+    response.add_header("ETag", etag)
 
-def schema_handler(path, response, api):
-    response.set_json(api.schema(path))
+    if etag_matches(request.headers, etag):
+        response.set_not_modified()
+        return
+
+    response.set_body("application/json", schema)
+    response.set_status(StatusCode.OK)
+
+
+def etag_matches(headers, etag):
+    value = headers.get("If-None-Match")
+    if not value:
+        return False
+
+    if value.strip() == "*":
+        return True
 
+    for tag in value.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
 
-def clb_handler(path, request, response, api, clb):
+        if tag == etag:
+            return True
+
+    return False
+
+
+def build_dragon_request(path, request, response, api):
+    """
+    build_dragon_request parses and validates the request
+    for the handler, it returns None if the request is bad.
+    """
     try:
-        params = api.build_params(request.params)
+        with timed("params"):
+            params = api.build_params(request.params)
     except ParamError as exc:
         response.set_bad_request("invalid params - " + str(exc))
         return
@@ -115,26 +310,69 @@ def clb_handler(path, request, response, api, clb):
                         pass
 
     try:
-        body = api.build_req_body(request.content_type, request.body)
+        with timed("body"):
+            body = api.build_req_body(request.content_type, request.body, request.content_length)
+    except BodyTooLarge as exc:
+        response.set_payload_too_large(str(exc))
+        return
     except Exception as exc:
         response.set_bad_request("invalid body - " + str(exc))
         return
 
-    req = DragonRequest(path, params, request.headers, body)
+    return DragonRequest(path, params, request.headers, body)
+
+
+def clb_handler(path, api, clb, request, response):
+    req = build_dragon_request(path, request, response, api)
+    if req is None:
+        return
+
+    try:
+        with timed("handler"):
+            resp_body = clb(req, response.resp_head)
+    except Exception as exc:
+        logger.exception("handler crashed")
+        response.set_internal_server_error("handler crashed - " + str(exc))
+        return
+
+    complete_response(response, api, resp_body)
+
+
+async def async_clb_handler(path, api, clb, request, response):
+    req = build_dragon_request(path, request, response, api)
+    if req is None:
+        return
 
     try:
-        resp_body = clb(req, response.resp_head)
+        with timed("handler"):
+            if iscoroutinefunction(clb):
+                resp_body = await clb(req, response.resp_head)
+            else:
+                # Don't block the event loop on a sync handler. If
+                # the request times out the thread runs on, it
+                # can't be cancelled.
+                resp_body = await asyncio.to_thread(call_profiled, clb, req, response.resp_head)
     except Exception as exc:
         logger.exception("handler crashed")
         response.set_internal_server_error("handler crashed - " + str(exc))
         return
 
+    complete_response(response, api, resp_body)
+
+
+def complete_response(response, api, resp_body):
+    # Proxied responses are relayed as the upstream sent them
+    if isinstance(response.status_code(), ProxiedStatus):
+        response.set_body("", resp_body)
+        return
+
     # Is the response status code valid?
     try:
-        if response.status_code() is None:
-            response.set_status(StatusCode.OK)
+        with timed("status"):
+            if response.status_code() is None:
+                response.set_status(StatusCode.OK)
 
-        api.validate_status_code(response.status_code())
+            api.validate_status_code(response.status_code())
     except BadCode:
         logger.error("invalid status code from handler")
         response.set_internal_server_error("unregistered status code")
@@ -142,7 +380,8 @@ def clb_handler(path, request, response, api, clb):
 
     # Sanity check the response
     try:
-        content_type, resp_body = api.build_response(resp_body)
+        with timed("response"):
+            content_type, resp_body = api.build_response(resp_body)
     except ValidationError as exc:
         logger.error("invalid response body", tags={
             "error": str(exc),
@@ -151,4 +390,3 @@ def clb_handler(path, request, response, api, clb):
         return
 
     response.set_body(content_type, resp_body)
-        
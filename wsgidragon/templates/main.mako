@@ -2,6 +2,7 @@
 All WSGI Dragon applications can return the following status codes.
 <li>400 Bad Request</li>
 <li>404 Not Found</li>
+<li>413 Payload Too Large</li>
 <li>500 Internal Server Error</li>
 <li>504 Gateway Timeout</li>
 
@@ -1,6 +1,6 @@
 <h2>${route.api.name}</h2>
 <div class="route-path">
-${"/".join(route.api.path)}
+${"/".join(map(str, route.api.path))}
 </div>
 
 <div class="handler-docstring">